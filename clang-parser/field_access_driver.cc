@@ -21,6 +21,7 @@
 #include <llvm/Support/Host.h>
 #include <llvm/Support/raw_ostream.h>
 #include <llvm/Support/FileSystem.h>
+#include <llvm/Support/Path.h>
 
 #include <regex>
 #include <sstream>
@@ -32,15 +33,100 @@ using namespace clang;
 using namespace std;
 
 
+// parses one file of a batch, the access info is kept after the AST is released
+class FieldAccessAction : public ASTFrontendAction {
+public:
+  nlohmann::json access;
 
+protected:
+  unique_ptr<ASTConsumer> CreateASTConsumer(CompilerInstance &CI,
+                                            StringRef file) override {
+    rewriter.setSourceMgr(CI.getSourceManager(), CI.getLangOpts());
+    auto newConsumer =
+        make_unique<MyFieldAccessConsumer>(CI.getASTContext(), rewriter);
+    consumer = newConsumer.get();
+    return newConsumer;
+  }
+
+  // called before the consumer is destroyed
+  void EndSourceFileAction() override {
+    if (consumer != nullptr) {
+      access = consumer->getAccessJson();
+    }
+    consumer = nullptr;
+  }
+
+private:
+  Rewriter rewriter;
+  MyFieldAccessConsumer *consumer = nullptr;
+};
+
+
+// parse every file listed in manifest (one path per line) with the same options and file manager,
+// and write {<file name without .c> -> access info} of each file to outfile, one JSON object per line.
+// "[FILE] <path>" is printed before a file is parsed and each line of outfile is flushed, so the caller
+// can stop the tool on a file that takes too long and keep the output of the files before it
+int runBatch(const string &manifest, const string &outfile,
+             const string &pchFile) {
+  ifstream manifestFile(manifest);
+  if (!manifestFile) {
+    cerr << "Cannot open the manifest " << manifest << endl;
+    return 1;
+  }
+  ofstream out(outfile);
+  if (!out) {
+    cerr << "Cannot open the output " << outfile << endl;
+    return 1;
+  }
+
+  auto baseInvocation = createBaseInvocation(pchFile);
+  IntrusiveRefCntPtr<FileManager> fileMgr(
+      new FileManager(FileSystemOptions()));
+  string infile;
+  while (getline(manifestFile, infile)) {
+    if (infile.empty()) {
+      continue;
+    }
+    cout << "[FILE] " << infile << endl;
+    CompilerInstance theCompiler;
+    theCompiler.setInvocation(
+        make_shared<CompilerInvocation>(*baseInvocation));
+    theCompiler.getFrontendOpts().Inputs.push_back(
+        FrontendInputFile(infile, InputKind(Language::C)));
+    theCompiler.createDiagnostics();
+    theCompiler.setFileManager(fileMgr.get());
+
+    // like the single file mode, the access info is kept even if the file has errors
+    FieldAccessAction action;
+    if (!theCompiler.ExecuteAction(action)) {
+      cerr << "[ERROR] (field_access) errors in " << infile << endl;
+    }
+    if (!action.access.empty()) {
+      nlohmann::json line = nlohmann::json::object();
+      line[llvm::sys::path::stem(infile).str()] = action.access;
+      out << line.dump() << endl;
+    }
+  }
+  return 0;
+}
 
 
 int main(int argc, char **argv) {
   if (argc < 3) {
     cout << "Usage: ./field_access <infile> <outfile>" << endl;
+    cout << "       ./field_access --batch <manifest> <outfile> [<pchfile>]" << endl;
+    cout << "       ./field_access --gen-pch <defs.hh> <pchfile>" << endl;
     return 1;
   }
 
+  string mode = argv[1];
+  if (mode == "--batch" && argc >= 4) {
+    return runBatch(argv[2], argv[3], argc >= 5 ? argv[4] : "");
+  }
+  if (mode == "--gen-pch" && argc >= 4) {
+    return generatePCH(argv[2], argv[3]) ? 0 : 1;
+  }
+
   string infile = argv[1];
   string outfile = argv[2];
 
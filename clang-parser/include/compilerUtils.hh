@@ -10,6 +10,7 @@
 #include <clang/Basic/TargetOptions.h>
 #include <clang/Frontend/CompilerInstance.h>
 #include <clang/Frontend/FrontendAction.h>
+#include <clang/Frontend/FrontendActions.h>
 #include <clang/Lex/Preprocessor.h>
 #include <clang/Parse/ParseAST.h>
 #include <clang/Rewrite/Core/Rewriter.h>
@@ -33,6 +34,13 @@ void createCompilerInstance(CompilerInstance &theCompiler,
 
 Rewriter createRewriter(CompilerInstance &CI);
 
+// options shared by all files of a batch, the same as createCompilerInstance
+// pchFile: implicitly include this precompiled header (defs.hh) if not empty
+std::shared_ptr<CompilerInvocation> createBaseInvocation(const string &pchFile);
+
+// precompile header into pchFile with the options of createBaseInvocation
+bool generatePCH(const string &header, const string &pchFile);
+
 bool writeRewriterOutputToFile(Rewriter& rewriter, const string &filename);
 
 
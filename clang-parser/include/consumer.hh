@@ -30,8 +30,12 @@ public:
         fieldAccessVisitor.TraverseDecl(context.getTranslationUnitDecl());
     }
     
+    nlohmann::json getAccessJson(){
+      return fieldAccessVisitor.dumpAccessToJson();
+    }
+
     void dumpAccessToJson(const string &filename){
-      nlohmann::json j = fieldAccessVisitor.dumpAccessToJson();
+      nlohmann::json j = getAccessJson();
       if(!j.empty()){
         writeJSONToFile(j, filename);
       }
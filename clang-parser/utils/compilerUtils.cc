@@ -31,6 +31,30 @@ void createCompilerInstance(CompilerInstance &theCompiler,
   theCompiler.getLangOpts().CommentOpts.ParseAllComments = true;
 }
 
+std::shared_ptr<CompilerInvocation> createBaseInvocation(const string &pchFile) {
+  auto invocation = std::make_shared<CompilerInvocation>();
+  auto &options = *invocation->getLangOpts();
+  options.C17 = true;
+  options.CommentOpts.ParseAllComments = true;
+  invocation->getTargetOpts().Triple = llvm::sys::getDefaultTargetTriple();
+  if (!pchFile.empty()) {
+    invocation->getPreprocessorOpts().ImplicitPCHInclude = pchFile;
+  }
+  return invocation;
+}
+
+bool generatePCH(const string &header, const string &pchFile) {
+  CompilerInstance theCompiler;
+  theCompiler.setInvocation(createBaseInvocation(""));
+  auto &frontendOpts = theCompiler.getFrontendOpts();
+  frontendOpts.Inputs.push_back(
+      FrontendInputFile(header, InputKind(Language::C).getHeader()));
+  frontendOpts.OutputFile = pchFile;
+  theCompiler.createDiagnostics();
+  GeneratePCHAction action;
+  return theCompiler.ExecuteAction(action);
+}
+
 Rewriter createRewriter(CompilerInstance &theCompiler) {
   Rewriter rewriter;
   rewriter.setSourceMgr(theCompiler.getSourceManager(),
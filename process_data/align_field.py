@@ -4,7 +4,10 @@ from utils import *
 from tqdm import tqdm
 from error import FileAlignException, VarAlignException
 from typing import List, Dict
-from gen_train_field import gen_fielddecoder_data
+from gen_train_field import gen_prompt
+from type_table import TypeTable
+from field_access import load_field_access
+from shard_store import FolderReader, open_writer
 
 def search_by_name(align_data, varname):
     for arg_data in align_data['argument']:
@@ -158,36 +161,67 @@ def align_heap_access(fname, align_data, field_access_data) -> List[Dict]:
     return save_data
 
 
-def main(align_folder, filed_access_folder, save_dir, target_bin):
+def align_field_fun(f, align_data, field_access_data) -> Dict:
+    # f: <binname>-<addr>.json
+    # return the data used to generate FieldDecoder data, None if no field access is aligned
+    save_data = {
+        'funname': align_data['funname'],
+        'code': align_data['code']
+    }
+    aligned_data = align_heap_access(f, align_data, field_access_data)
+    if not aligned_data:
+        return None
+    save_data['aligned'] = aligned_data
+    return save_data
+
+
+def default_type_dir(align_folder):
+    # the subprogram folder next to the align folder (see process_data.sh)
+    return os.path.join(os.path.dirname(os.path.normpath(align_folder)), 'debuginfo_subprograms')
+
+
+def main(align_folder, filed_access_folder, save_dir, target_bin, type_dir=None, sharded=False):
+    # align_folder can be in either layout (see shard_store.py), sharded: save one shard per binary instead of one file per function
+    # type_dir: the folder of the type tables, for the align data of `parse_dwarf.py --type_table` (see type_table.py)
+    align_reader = FolderReader(align_folder)
+    # the records that refer to their type by type_id fail if the type table of their binary cannot be found
+    type_table = TypeTable(type_dir if type_dir else default_type_dir(align_folder))
     success_cnt = 0
     fail_cnt = 0
     unavailable = 0
+    bin_field_access = {}   # the output of field_access.py for the current binary
+    writing_bin = None   # the binary of writer
    
-
-    for f in tqdm(get_file_list(align_folder), disable=target_bin):
+    # the binaries are processed one after the other, the order of the files of a binary is kept
+    align_files = sorted(align_reader.files(target_bin), key=lambda f: f.split('-')[0])
+    for f in tqdm(align_files, disable=target_bin):
         if not f.endswith('.json'):
             continue
 
-        if target_bin and not f.startswith(target_bin):
-            continue
-
         fname = f.replace('.json', '')
+        binname = fname.split('-')[0]
+        if binname != writing_bin:
+            if writing_bin is not None:
+                writer.close()
+            writing_bin = binname
+            writer = open_writer(save_dir, binname, sharded, index=False)
         try:
-            align_data = read_json(os.path.join(align_folder, f))
-            save_data = {
-                'funname': align_data['funname'],
-                'code': align_data['code']
-            }
-            if not os.path.exists(os.path.join(filed_access_folder, f)):
+            align_data = align_reader.read(f)
+            type_table.resolve_align_data(binname, align_data)
+            if binname not in bin_field_access:
+                bin_field_access = {binname: load_field_access(filed_access_folder, binname)}
+            # field_access.py saves one file per binary, the single file mode of the tool one file per function
+            if fname in bin_field_access[binname]:
+                field_access_data = bin_field_access[binname][fname]
+            elif os.path.exists(os.path.join(filed_access_folder, f)):
+                field_access_data = read_json(os.path.join(filed_access_folder, f))
+            else:
                 unavailable += 1
                 print(f"Cannot find the beyond access info file in {os.path.join(filed_access_folder, f)}")
                 continue
-            field_access_data = read_json(os.path.join(filed_access_folder, f))
-
-            aligned_data = align_heap_access(f, align_data, field_access_data)
-            if aligned_data: 
-                save_data['aligned'] = aligned_data
 
+            save_data = align_field_fun(f, align_data, field_access_data)
+            if save_data is not None: 
                 success_cnt += 1 
             else:
                 unavailable += 1
@@ -201,7 +235,9 @@ def main(align_folder, filed_access_folder, save_dir, target_bin):
             fail_cnt += 1
             continue
 
-        gen_fielddecoder_data(fname, save_data, save_dir)
+        writer.write(fname + '.json', gen_prompt(save_data))
+    if writing_bin is not None:
+        writer.close()
     print(f'Success: {success_cnt}, Fail: {fail_cnt}, Unavailable: {unavailable}')
 
 
@@ -212,6 +248,8 @@ if __name__=='__main__':
     parser.add_argument('filed_access_folder')
     parser.add_argument('save_dir')
     parser.add_argument('--bin', required=False, default=None)
+    parser.add_argument('--type_dir', required=False, default=None, help='the folder holding the type tables of `parse_dwarf.py --type_table`, by default debuginfo_subprograms next to align_dir')
+    parser.add_argument('--sharded', required=False, default=False, action='store_true', help='save one shard per binary instead of one file per function, see shard_store.py')
     args = parser.parse_args()
     
-    main(args.align_dir, args.filed_access_folder, args.save_dir, target_bin = args.bin)
+    main(args.align_dir, args.filed_access_folder, args.save_dir, target_bin = args.bin, type_dir = args.type_dir, sharded = args.sharded)
@@ -5,14 +5,20 @@ from tqdm import tqdm
 from error import FileAlignException, VarAlignException
 from typing import List, Dict
 import re
+from type_table import compact_align_data
 
 def get_decompiled_code(code_dir, binname, hex_addr) -> str:
 
     fpath = os.path.join(code_dir, f"{binname}-{hex_addr.upper()}.c")
     if not os.path.exists(fpath):
         raise FileAlignException(f'File {fpath} not found.')
-    file_content = read_file(fpath, readlines=True)
-    return ''.join(file_content[1:]).strip()
+    file_content = read_file(fpath, readlines=False)
+    return strip_header(file_content)
+
+def strip_header(code_with_header: str) -> str:
+    # remove the first line (HEADER of decompiled_files/*.c)
+    file_content = code_with_header.split('\n', 1)
+    return file_content[1].strip() if len(file_content) > 1 else ''
 
 def array_element_cnt (array_dims: List[int]) -> int:
     cnt = 1
@@ -306,10 +312,13 @@ def process_vars(var_data: List[Dict], fname:str) -> List[Dict]:
 
 
 
-def align_stack(align_data:Dict, binname, hex_addr, code_dir, save_dir):
+def align_stack(align_data:Dict, binname, hex_addr, code_dir, save_dir, code:str=None):
+    # code: the decompiled code (without HEADER), read from code_dir if not given
+    # save_dir: the align data is not saved if save_dir is None
 
     fname = f"{binname}-{hex_addr}"
-    code:str = get_decompiled_code(code_dir, binname, hex_addr)
+    if code is None:
+        code:str = get_decompiled_code(code_dir, binname, hex_addr)
     args: List[Dict] = process_args(align_data['argument'], fname)  
     vars, complex_var = process_vars(align_data['variable'], fname)
 
@@ -318,13 +327,15 @@ def align_stack(align_data:Dict, binname, hex_addr, code_dir, save_dir):
     align_data['variable'] = vars
     align_data['complex_var'] = complex_var
 
-    dump_json(os.path.join(save_dir, fname + '.json'), align_data)
+    if save_dir is not None:
+        dump_json(os.path.join(save_dir, fname + '.json'), compact_align_data(align_data))
     return align_data
    
 
 
-def gen_vardecoder_data(fname, align_stack_data, save_dir, ignore_complex=False) -> bool:
+def build_vardecoder_data(fname, align_stack_data, ignore_complex=False) -> Dict:
     # fname: <binname>-<addr>
+    # return the VarDecoder data of the function, None if no variable is labeled
 
     def _process_label(fname, align_data)->(int, Dict):
         label_cnt = 0
@@ -381,13 +392,10 @@ def gen_vardecoder_data(fname, align_stack_data, save_dir, ignore_complex=False)
         return prompt, code,  oracle
 
 
-    success = False
-
     label_cnt, label_data = _process_label(fname, align_stack_data)
     if label_cnt == 0:
-        return success
+        return None
     
-    success = True
     prompt, code, oracle = _gen_prompt(label_data)
     
 
@@ -400,9 +408,17 @@ def gen_vardecoder_data(fname, align_stack_data, save_dir, ignore_complex=False)
         }
     if label_data['complex_var']:
         save_data['complex_var'] = label_data['complex_var']
+    return save_data
+
+
+def gen_vardecoder_data(fname, align_stack_data, save_dir, ignore_complex=False) -> bool:
+    # fname: <binname>-<addr>
+    save_data = build_vardecoder_data(fname, align_stack_data, ignore_complex=ignore_complex)
+    if save_data is None:
+        return False
+
     dump_json(os.path.join(save_dir, fname+'.json'), save_data)
-    
-    return success
+    return True
 
 
 if __name__=='__main__':
@@ -0,0 +1,228 @@
+import argparse
+import os
+import re
+import time
+from utils import *
+from typing import Dict, List
+from error import ParseError
+
+# Parsing of the Hex-Rays functions, shared by prep_decompiled.py and parse_decompiled.py.
+# The patterns are compiled once, and parse_function reads the lines of a function once:
+# the signature is looked for in the first lines, and the variable declarations (with their array size and rbp offset) in all lines.
+
+FUNNAME_RE = re.compile(r'^sub_([\w\d]+)$')   # sub_<g1>
+HEX_RE = re.compile(r'^-?[0-9a-fA-F]+$')
+SUB_SIGNATURE_RE = re.compile(r'((sub_[\d\w]+)|main)\((.*?)\)')  # <g1> (<g2>)
+VAR_DECL_RE = re.compile(r'^(.+?\s+\**)(\S+);\s+\/\/(.*)$')  # <g1> <g2>; // <g3>
+RBP_OFFSET_RE = re.compile(r'\[rbp(-[\d\w]+?)h\]')   # [rbp-<g1>h]
+ARRAY_NAME_RE = re.compile(r'^(.*?)\[(\d+)\]$')  # <g1>[<g2>]
+ARG_RE = re.compile(r'^(.*?)(a\d+)$')    # xxxx a1: <g1><g2>
+ARG_RE2 = re.compile(r'^((struct\s|const\s)?\w+?\s+\*?)(\w+)$')  # (struct/const )?xxx *?<g3>
+
+SIGNATURE_LINES = 3   # the signature is in the first SIGNATURE_LINES lines of a function
+
+
+def process_funname(raw_addr:str) -> str:
+    # sub_401220 -> 401220
+    if raw_addr == 'main':
+        return raw_addr
+    match = FUNNAME_RE.search(raw_addr)
+    if match:
+        return match.group(1)
+    else:
+        return None
+
+
+def hex_to_decimal(hex_str : str) -> int:
+    # Check if the input hex string is valid
+    if not HEX_RE.match(hex_str):
+        return None
+
+    # Convert the hex string to decimal
+    decimal_num = int(hex_str, 16)
+    return decimal_num
+
+
+def _match_signature(line, funname=None):
+    # return the argument list of the signature in line, None if there is no signature
+    if not funname:
+        match = SUB_SIGNATURE_RE.search(line)
+        return match.group(3) if match else None
+
+    # <funname>(<g>) or main(<g>), the first one in the line, funname is matched as is
+    start = 0
+    while True:
+        positions = [(pos, len(name)) for pos, name in ((line.find(funname + '(', start), funname), (line.find('main(', start), 'main')) if pos >= 0]
+        if not positions:
+            return None
+        pos, name_len = min(positions)
+        open_pos = pos + name_len + 1
+        close_pos = line.find(')', open_pos)
+        if close_pos >= 0:
+            return line[open_pos: close_pos]
+        start = pos + 1
+
+
+def _parse_arglist(arglist) -> List[Dict]:
+    arg_info = []
+    if not arglist:
+        return arg_info
+
+    for arg in arglist.split(','):
+        arg = arg.strip()
+        if arg == '...':
+            arg_info.append({
+                'name': arg,
+                'original_line': arg
+            })
+            continue
+
+        if arg == 'void':
+            continue
+
+        arg_match = ARG_RE.match(arg)
+        if arg_match:
+            argtype, argname = arg_match.group(1).strip(), arg_match.group(2)
+        else:
+            arg_match = ARG_RE2.match(arg)
+            if arg_match:
+                argtype, argname = arg_match.group(1).strip(), arg_match.group(3)
+            else:
+                raise ParseError(f'Cannot find the declaration of argument {arg}.')
+
+        if argname in arg_info:
+            raise ParseError(f'{argname} duplicate')
+
+        arg_info.append({
+            'name': argname,
+            'type': argtype,
+            'original_line': arg
+        })
+    return arg_info
+
+
+def _parse_var_decl(line) -> Dict:
+    # return the variable declared in line, None if it is not a declaration
+    if '//' not in line:
+        # most lines of a function are not declarations
+        return None
+    line = line.strip()
+    match = VAR_DECL_RE.match(line)
+    if not match:
+        return None
+    var_type = match.group(1).strip()
+    var_name = match.group(2).strip()
+    comment = match.group(3).strip()
+
+    # parse var_name (handle array)
+    array_size = None
+    if var_name.endswith(']'):
+        array_name_match = ARRAY_NAME_RE.match(var_name)
+        if array_name_match:
+            var_name = array_name_match.group(1)
+            array_size = int(array_name_match.group(2))
+
+    # parse comment, get rbp offset
+    rbp_offset = None
+    if '[rbp' in comment:
+        rbp_offset_match = RBP_OFFSET_RE.search(comment)
+        if rbp_offset_match:
+            rbp_offset = rbp_offset_match.group(1)
+
+    rbp_offset_dec = hex_to_decimal(rbp_offset) if rbp_offset is not None else None
+
+    # handle *
+    ptr_level = var_name.count("*")
+    var_name = var_name.replace('*', "")
+
+    return {
+        'name': var_name,
+        'type': var_type,
+        'comment': comment.replace('"',"`").replace("'", '`'),
+        'array_size': array_size,
+        'ptr_level': ptr_level,
+        'rbp_offset_hex': rbp_offset,
+        'rbp_offset_dec': rbp_offset_dec,
+        'original_line': line.replace('"',"`").replace("'", '`')
+    }
+
+
+def parse_function(fun_content:List[str], funname:str=None) -> (List[Dict], List[Dict]):
+    # fun_content: the lines of a function, funname: None for sub_<addr> functions
+    # return the arguments (in order) and the variable declarations of the function
+    if isinstance(fun_content, str):
+        fun_content = fun_content.split('\n')
+    arglist = None
+    var_decl_info = []
+    for l_index, line in enumerate(fun_content):
+        if arglist is None and l_index < SIGNATURE_LINES:
+            arglist = _match_signature(line, funname)
+        var_decl = _parse_var_decl(line)
+        if var_decl is not None:
+            var_decl_info.append(var_decl)
+    if arglist is None:
+        raise ParseError('Fail to parse the signature.')
+    return _parse_arglist(arglist), var_decl_info
+
+
+def extract_comments(fun_content:List[str]) -> List[Dict]:
+    # fun_content should be the content of a function, not a file
+    var_decl_info = []
+    for line in fun_content:
+        var_decl = _parse_var_decl(line)
+        if var_decl is not None:
+            var_decl_info.append(var_decl)
+    return var_decl_info
+
+
+def parse_signature(file_content:List[str], funname:str=None) -> List[Dict]:
+    # return list (in order)
+    if isinstance(file_content, str):
+        file_content = file_content.split('\n')
+    for line in file_content[:SIGNATURE_LINES]:
+        arglist = _match_signature(line, funname)
+        if arglist is not None:
+            return _parse_arglist(arglist)
+    raise ParseError('Fail to parse the signature.')
+
+
+def fun_parse_name(funname) -> str:
+    # the name given to parse_function for a function of a decompiled file, None for sub_<addr> functions
+    if funname.startswith('sub_'):
+        return None
+    if funname.startswith('.'):
+        return funname[1:]
+    return funname
+
+
+def benchmark(src_dir_or_file, repeat=3):
+    # time parse_function on the functions of the .decompiled files
+    if os.path.isdir(src_dir_or_file):
+        files = [os.path.join(src_dir_or_file, f) for f in get_file_list(src_dir_or_file) if f.endswith('.decompiled')]
+    else:
+        files = [src_dir_or_file]
+    funs = []
+    for f in files:
+        funs += [(fun['code'].split('\n'), fun_parse_name(fun['funname'])) for fun in iter_json_records(f)]
+    num_lines = sum(len(lines) for lines, _ in funs)
+    print(f'{len(funs)} functions, {num_lines} lines in {len(files)} files')
+
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for lines, funname in funs:
+            try:
+                parse_function(lines, funname)
+            except ParseError:
+                pass
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'best of {repeat}: {best:.4f}s, {len(funs) / best:.0f} functions/s, {num_lines / best:.0f} lines/s')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src_dir_or_file', help='.decompiled file or folder to benchmark the parser on (e.g. ../sample_data/decompiled)')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    benchmark(args.src_dir_or_file, repeat=args.repeat)
@@ -0,0 +1,259 @@
+import argparse
+import contextlib
+import json
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import *
+from shard_store import FolderReader
+from typing import Dict, List
+from tqdm import tqdm
+
+# Runs the clang field_access tool in batch mode: a tool run parses many decompiled files
+# with the same compiler setup and a precompiled defs.hh. The files of a binary are split into shards run in parallel,
+# and their outputs are merged into one output file per binary. The tool reports each file it starts and is killed if a file takes
+# more than the timeout, a file that times out or crashes the tool is reported as a failure record and the tool is restarted after it.
+# Replaces gen_command.py and the <bin>_command.sh scripts it generated.
+
+CLANG_BUILD_DIR = '/home/ReSym/clang-parser/build'
+FIELD_ACCESS_BIN = os.path.join(CLANG_BUILD_DIR, 'field_access')
+DEFS_HH = os.path.join(os.path.dirname(CLANG_BUILD_DIR), 'defs.hh')   # included by the decompiled files, see prep_decompiled.HEADER
+PCH_FPATH = os.path.join(CLANG_BUILD_DIR, 'defs.hh.pch')
+
+# the files of a binary are split into shards of SHARD_SIZE files, each shard is one batch run of the tool
+SHARD_SIZE = 256
+FILE_TIMEOUT = 60   # seconds per file
+FILE_MARKER = '[FILE] '   # printed by the tool before it parses a file
+FAILURE_DIR = 'failures'   # <field_access folder>/failures/<binname>.json: the failure records of a binary
+
+# process-wide limit of the concurrent tool runs, shared by the scheduler workers (see set_slots)
+_SLOTS = None
+
+
+def set_slots(slots):
+    # slots: a multiprocessing semaphore, every tool run holds one
+    global _SLOTS
+    _SLOTS = slots
+
+
+def default_num_workers() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def field_access_path(save_dir, binname):
+    # output of a binary: {<binname>-<addr> -> field access data}
+    return os.path.join(save_dir, binname + '.json')
+
+
+def ensure_pch(pch_fpath=PCH_FPATH):
+    # precompile defs.hh if it is missing or older than defs.hh, return None if it cannot be built
+    try:
+        if os.path.exists(pch_fpath) and os.path.getmtime(pch_fpath) >= os.path.getmtime(DEFS_HH):
+            return pch_fpath
+        # other workers may use the same file
+        tmp_fpath = f'{pch_fpath}.{os.getpid()}.tmp'
+        ret = subprocess.run([FIELD_ACCESS_BIN, '--gen-pch', DEFS_HH, tmp_fpath], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if ret.returncode != 0 or not os.path.exists(tmp_fpath):
+            print(f'[ERROR] (field_access) Cannot precompile {DEFS_HH}, parse it for every file - {ret.stdout}')
+            if os.path.exists(tmp_fpath):
+                os.remove(tmp_fpath)
+            return None
+        os.replace(tmp_fpath, pch_fpath)
+    except OSError as e:
+        print(f'[ERROR] (field_access) Cannot precompile {DEFS_HH} - {e}')
+        return None
+    return pch_fpath
+
+
+def failure_record(binname, src_fpath, status, message='', returncode=None) -> Dict:
+    # status: timeout, crash (the tool failed without output), error (clang errors, the accesses found are kept),
+    # warning (the tool timed out or crashed after writing the output of the file, e.g. on teardown, the output is kept)
+    return {'bin': binname, 'file': os.path.basename(src_fpath), 'status': status, 'returncode': returncode, 'message': message}
+
+
+def _read_lines(stream, lines: queue.Queue):
+    for line in stream:
+        lines.put(line.rstrip('\n'))
+    lines.put(None)
+
+
+def _run_tool(src_fpaths: List[str], out_fpath, pch_fpath, file_timeout) -> (int, str, int):
+    # run the tool on the given files until it is done, crashes, or parses a file for more than file_timeout seconds (then it is killed),
+    # return (returncode, output, index of the file it stopped on), returncode is None on timeout, the index is len(src_fpaths) if it is done
+    with tempfile.NamedTemporaryFile('w', suffix='.manifest', delete=False) as fp:
+        fp.write(''.join(fpath + '\n' for fpath in src_fpaths))
+        manifest = fp.name
+    command = [FIELD_ACCESS_BIN, '--batch', manifest, out_fpath] + ([pch_fpath] if pch_fpath else [])
+    if _SLOTS is not None:
+        _SLOTS.acquire()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+        lines = queue.Queue()
+        reader = threading.Thread(target=_read_lines, args=(process.stdout, lines), daemon=True)
+        reader.start()
+        output = []
+        current = -1   # the file being parsed, the tool prints FILE_MARKER before each file
+        deadline = time.time() + file_timeout
+        timed_out = False
+        while True:
+            try:
+                line = lines.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                process.kill()
+                timed_out = True
+                break
+            if line is None:
+                break
+            if line.startswith(FILE_MARKER):
+                current += 1
+                deadline = time.time() + file_timeout
+            else:
+                output.append(line)
+        process.wait()
+        reader.join()
+        process.stdout.close()
+        returncode = None if timed_out else process.returncode
+        if returncode == 0:
+            current = len(src_fpaths)
+        return returncode, '\n'.join(output), max(current, 0)
+    finally:
+        if _SLOTS is not None:
+            _SLOTS.release()
+        os.remove(manifest)
+
+
+def _read_results(out_fpath) -> Dict[str, List[Dict]]:
+    # the output of a tool run, one {<file name without .c> -> field access data} per line,
+    # the last line may be cut if the tool was killed
+    results = {}
+    if not os.path.exists(out_fpath):
+        return results
+    with open(out_fpath, 'r') as fp:
+        for line in fp:
+            try:
+                results.update(json.loads(line))
+            except ValueError:
+                continue
+    os.remove(out_fpath)
+    return results
+
+
+def _file_messages(src_fpaths: List[str], output) -> Dict[str, str]:
+    # split the output of the tool into the clang diagnostics of each file
+    messages = {}
+    for line in output.splitlines():
+        fpath = line.split(':', 1)[0]
+        if line.startswith('[ERROR] (field_access) errors in '):
+            fpath = line[len('[ERROR] (field_access) errors in '):]
+        messages.setdefault(fpath, []).append(line)
+    return {fpath: '\n'.join(messages[fpath]) for fpath in src_fpaths if fpath in messages}
+
+
+def run_shard(binname, src_fpaths: List[str], out_fpath, pch_fpath=None, file_timeout=FILE_TIMEOUT) -> (Dict[str, List[Dict]], List[Dict]):
+    # run the tool on a shard, return {<file name without .c> -> field access data} and the failure records
+    # a file that crashes the tool or takes more than file_timeout is a failure, the tool is restarted on the files after it
+    results = {}
+    failures = []
+    start = 0
+    while start < len(src_fpaths):
+        fpaths = src_fpaths[start:]
+        returncode, output, stop = _run_tool(fpaths, out_fpath, pch_fpath, file_timeout)
+        run_results = _read_results(out_fpath)
+        results.update(run_results)
+        messages = _file_messages(fpaths[: stop + 1], output)
+        failures += [failure_record(binname, fpath, 'error', messages[fpath], returncode)
+                     for fpath in fpaths[: stop] if '[ERROR] (field_access)' in messages.get(fpath, '')]
+        if stop < len(fpaths):
+            status = 'timeout' if returncode is None else 'crash'
+            message = messages.get(fpaths[stop], output[-2000:])
+            name = os.path.splitext(os.path.basename(fpaths[stop]))[0]
+            if name in run_results:
+                # the output of the file is complete (one JSON line per file), the tool failed after it
+                failures.append(failure_record(binname, fpaths[stop], 'warning', f'{status} after the output of the file\n{message}'.strip(), returncode))
+            else:
+                failures.append(failure_record(binname, fpaths[stop], status, message, returncode))
+        start += stop + 1
+    return results, failures
+
+
+def run_batch(binname, src_fpaths: List[str], out_fpath, pch_fpath=None, num_workers=None, shard_size=SHARD_SIZE, file_timeout=FILE_TIMEOUT) -> (Dict[str, List[Dict]], List[Dict]):
+    # run the tool on the .c files of a binary, split into shards run by at most num_workers tools at a time,
+    # save the merged output to out_fpath and return it, with the failure records
+    if num_workers is None:
+        num_workers = default_num_workers()
+    shards = [src_fpaths[i: i + shard_size] for i in range(0, len(src_fpaths), shard_size)]
+    results = {}
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir, ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        # the tools run in subprocesses, threads are enough to drive them
+        futures = [executor.submit(run_shard, binname, shard, os.path.join(tmp_dir, f'{i}.json'), pch_fpath, file_timeout) for i, shard in enumerate(shards)]
+        # merged in the order of the files
+        for future in futures:
+            shard_results, shard_failures = future.result()
+            results.update(shard_results)
+            failures += shard_failures
+    dump_json(out_fpath, results)
+    return results, failures
+
+
+def load_field_access(field_access_dir, binname) -> Dict[str, List[Dict]]:
+    # the output of a binary, {} if there is none
+    fpath = field_access_path(field_access_dir, binname)
+    if not os.path.exists(fpath):
+        return {}
+    return read_json(fpath)
+
+
+def failure_path(save_dir, binname):
+    return os.path.join(save_dir, FAILURE_DIR, binname + '.json')
+
+
+def save_failures(save_dir, binname, failures: List[Dict]):
+    fpath = failure_path(save_dir, binname)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    dump_json(fpath, failures)
+
+
+def main(src_dir, save_dir, target_bin=None, num_workers=None, shard_size=SHARD_SIZE, file_timeout=FILE_TIMEOUT):
+    # src_dir: the decompiled files (.c, either layout, see shard_store.py), save_dir: the field access folder, one output file per binary
+    pch_fpath = ensure_pch()
+    os.makedirs(save_dir, exist_ok=True)
+    reader = FolderReader(src_dir)
+    bin_files = {}
+    for f in reader.files(target_bin):
+        if not f.endswith('.c'):
+            continue
+        bin_files.setdefault(f.split('-')[0], []).append(f)
+
+    for binname, fnames in tqdm(bin_files.items(), disable=len(bin_files)==1):
+        with contextlib.ExitStack() as stack:
+            bin_src_dir = src_dir
+            if reader.sharded(binname):
+                # the tool needs the .c files on disk
+                bin_src_dir = stack.enter_context(tempfile.TemporaryDirectory())
+                for f in fnames:
+                    write_file(os.path.join(bin_src_dir, f), reader.read(f))
+            _, failures = run_batch(binname, [os.path.join(bin_src_dir, f) for f in fnames], field_access_path(save_dir, binname), pch_fpath,
+                num_workers=num_workers, shard_size=shard_size, file_timeout=file_timeout)
+        save_failures(save_dir, binname, failures)
+        if failures:
+            print(f'{binname}: {len(failures)} files failed, see {failure_path(save_dir, binname)}')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src_dir', help='the folder of the decompiled files (.../decompiled_files)')
+    parser.add_argument('save_dir', help='the field access folder (.../field_access)')
+    parser.add_argument('--bin', required=False, default=None)
+    parser.add_argument('--workers', required=False, default=None, type=int, help='number of tool runs at a time, by default the number of cores')
+    parser.add_argument('--shard_size', required=False, default=SHARD_SIZE, type=int, help='number of files per tool run')
+    parser.add_argument('--timeout', required=False, default=FILE_TIMEOUT, type=float, help='timeout (seconds) per file')
+    args = parser.parse_args()
+
+    main(args.src_dir, args.save_dir, args.bin, num_workers=args.workers, shard_size=args.shard_size, file_timeout=args.timeout)
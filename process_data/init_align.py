@@ -5,7 +5,9 @@ import os
 from typing import List, Dict
 import re
 from error import FileAlignException, VarAlignException
-from align_stack import align_stack, gen_vardecoder_data
+from align_stack import align_stack, build_vardecoder_data, strip_header
+from type_table import TypeTable, compact_align_data
+from shard_store import FolderReader, open_writer
 
 OFFSET = 16   
 DEBUG = False
@@ -184,24 +186,62 @@ def align(var_file, subprogram_file, fname, is_main: bool):
 
     return {'argument': aligned_args, 'variable': aligned_vars, 'funname': subprogram_file['funname'], 'fun_start_addr': subprogram_file['fun_start_addr']} 
 
-def main(var_dir, subprogram_dir, code_dir, align_save_dir, stack_data_save_dir, target_bin, ignore_complex):
+def align_fun(f, var_file, subprogram_file, code_dir, align_save_dir, code=None) -> Dict:
+    # f: <binname>-<addr>.json
+    # align the variables of one function, return the align data, None if it fails (the error is printed)
+    # var_file and subprogram_file are modified in place
+    fname = f.replace('.json', '')
+    proj_name, fun_addr = fname.split('-')
+    var_fname = proj_name + '-' + fun_addr.upper()  + '_var.json'
+    try:
+        align_data = align(var_file, subprogram_file, f, is_main = False)
+    except FileAlignException as e:
+        print(f'Error: {var_fname} - {e.msg}')
+        return None
+    except Exception as e:
+        print(f'[ERROR] (init_align) Other error {var_fname} - {e}')
+        return None
+
+    try:
+        align_data = align_stack(align_data, proj_name, fun_addr.upper(), code_dir, align_save_dir, code=code)
+    except FileAlignException as e:
+        print(f'Error: {var_fname} - {e.msg}')
+        return None
+    except Exception as e:
+        print(f'[ERROR] (align) Other error {var_fname} - {e}')
+        return None
+    return align_data
+
 
+def main(var_dir, subprogram_dir, code_dir, align_save_dir, stack_data_save_dir, target_bin, ignore_complex, sharded=False):
+    # the input folders can be in either layout (see shard_store.py), sharded: save one shard per binary instead of one file per function
 
-    var_files = get_file_list(var_dir)
+    var_reader = FolderReader(var_dir)
+    subprogram_reader = FolderReader(subprogram_dir)
+    code_reader = FolderReader(code_dir)
+    # with target_bin, only the files of the binary are listed (see get_bin_file_list)
+    var_files = set(var_reader.files(target_bin))
+    type_table = TypeTable(subprogram_dir)
     error_cnt = 0
     success_cnt = 0
     train_data_cnt = 0
-    is_main = False 
-    for f in tqdm(get_file_list(subprogram_dir), disable=(target_bin)):
+    writing_bin = None   # the binary of align_writer and train_writer
+    # the binaries are processed one after the other, the order of the files of a binary is kept
+    subprogram_files = sorted(subprogram_reader.files(target_bin), key=lambda f: f.split('-')[0])
+    for f in tqdm(subprogram_files, disable=(target_bin)):
         if not f.endswith('.json'):
             continue
 
-        if target_bin and not f.startswith(target_bin):
-            continue
-
         fname = f.replace('.json', '')
         proj_name, fun_addr = fname.split('-')
         var_fname = proj_name + '-' + fun_addr.upper()  + '_var.json'
+        if proj_name != writing_bin:
+            if writing_bin is not None:
+                align_writer.close()
+                train_writer.close()
+            writing_bin = proj_name
+            align_writer = open_writer(align_save_dir, proj_name, sharded)
+            train_writer = open_writer(stack_data_save_dir, proj_name, sharded, index=False)
 
         try:
 
@@ -210,9 +250,9 @@ def main(var_dir, subprogram_dir, code_dir, align_save_dir, stack_data_save_dir,
                 continue
             
 
-            var_file = read_json(os.path.join(var_dir, var_fname))
-            subprogram_file = read_json(os.path.join(subprogram_dir, f))
-            align_data = align(var_file, subprogram_file, f, is_main = is_main)
+            var_file = var_reader.read(var_fname)
+            subprogram_file = subprogram_reader.read(f)
+            type_table.resolve_subprogram(proj_name, subprogram_file)
 
         except FileAlignException as e:
             print(f'Error: {var_fname} - {e.msg}')
@@ -223,23 +263,28 @@ def main(var_dir, subprogram_dir, code_dir, align_save_dir, stack_data_save_dir,
             error_cnt += 1
             continue
 
-        try:
-            align_data = align_stack(align_data, proj_name, fun_addr.upper(), code_dir, align_save_dir)
-        except FileAlignException as e:
-            print(f'Error: {var_fname} - {e.msg}')
-            error_cnt += 1
-            continue
-        except Exception as e:
+        code = None
+        code_fname = proj_name + '-' + fun_addr.upper() + '.c'
+        if code_reader.sharded(proj_name) and code_reader.exists(code_fname):
+            # same as reading decompiled_files/*.c in text mode, the other files are read by align_stack
+            code = strip_header(code_reader.read(code_fname).replace('\r\n', '\n').replace('\r', '\n'))
+        align_data = align_fun(f, var_file, subprogram_file, code_dir, None, code=code)
+        if align_data is None:
             error_cnt += 1
-            print(f'[ERROR] (align) Other error {var_fname} - {e}')
             continue
+        align_writer.write(proj_name + '-' + fun_addr.upper() + '.json', compact_align_data(align_data))
 
         # generate training data
-        train_data_generated = gen_vardecoder_data(fname, align_data, stack_data_save_dir, ignore_complex=ignore_complex)
+        save_data = build_vardecoder_data(fname, align_data, ignore_complex=ignore_complex)
+        if save_data is not None:
+            train_writer.write(fname + '.json', save_data)
         train_data_cnt += 1
 
         success_cnt += 1
 
+    if writing_bin is not None:
+        align_writer.close()
+        train_writer.close()
     print(f'Success: {success_cnt}, Training data generated: {train_data_cnt}, Fail: {error_cnt}')
         
 def _test():
@@ -258,7 +303,8 @@ if __name__=='__main__':
     
     parser.add_argument('--bin', required=False, default=None)
     parser.add_argument('--ignore_complex', required=False, default=False, action='store_true', help="ignore variable clusters. Skip the head as well.")
+    parser.add_argument('--sharded', required=False, default=False, action='store_true', help='save one shard per binary instead of one file per function, see shard_store.py')
     args = parser.parse_args()
 
-    main(args.var_dir, args.subprogram_dir, args.code_dir, args.align_save_dir, args.stack_data_save_dir, args.bin, args.ignore_complex)
+    main(args.var_dir, args.subprogram_dir, args.code_dir, args.align_save_dir, args.stack_data_save_dir, args.bin, args.ignore_complex, sharded=args.sharded)
 
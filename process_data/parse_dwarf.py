@@ -1,6 +1,6 @@
 from elftools.elf.elffile import ELFFile
 import argparse
-import io
+import mmap
 from elftools.dwarf.locationlists import (
     LocationEntry, LocationExpr, LocationParser)
 from elftools.dwarf.descriptions import (
@@ -8,8 +8,11 @@ from elftools.dwarf.descriptions import (
 from pathlib import Path
 from typing import Dict, List
 from utils import *
+from type_table import type_table_path
+from shard_store import open_writer
 from tqdm import tqdm
 import re
+import copy
 
 
 POINTER_SIZE = 8
@@ -33,16 +36,44 @@ def show_loclist(loclist, dwarfinfo, indent, cu_offset):
 
 
 def read_elf(fpath):
-    # Read the ELF file data into memory
+    # Map the ELF file into memory instead of copying it (the mapping keeps its own file descriptor).
+    # Note that pyelftools still copies the DWARF sections it reads.
     with open(fpath, 'rb') as f:
-        elfdata = f.read()
+        elfdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    # Create a file-like object from the byte data
-    elffile = ELFFile(io.BytesIO(elfdata))
+    elffile = ELFFile(elfdata)
     return elffile
 
 
+class DIELookup():
+    # Lookup from .debug_info offset to DIE within the CU being processed. A DIE is parsed only when it is referenced,
+    # by pyelftools' public CompileUnit.get_DIE_from_refaddr, which also caches it in the CU (see release_cu).
+    def __init__(self):
+        self.cu = None
 
+    def set_cu(self, cu):
+        # DIEs are looked up within the CU being processed
+        self.cu = cu
+
+    def get(self, offset, default=None):
+        if self.cu is None or not (self.cu.cu_die_offset <= offset < self.cu.cu_offset + self.cu.size):
+            return default
+        try:
+            return self.cu.get_DIE_from_refaddr(offset)
+        except Exception:
+            return default
+
+
+def release_cu(cu):
+    # Drop the DIEs that pyelftools cached in the CU while it was traversed, only keep the top DIE:
+    # the DWARFInfo keeps every CU it parsed, with all their DIEs, until the binary is closed.
+    # pyelftools has no public API for this, it relies on the per-CU cache of pyelftools 0.27 to 0.33
+    # (the parallel _dielist/_diemap lists, sorted by offset, see CompileUnit._get_cached_DIE),
+    # with another layout the DIEs are kept, which only costs memory.
+    dielist, diemap = getattr(cu, '_dielist', None), getattr(cu, '_diemap', None)
+    if isinstance(dielist, list) and isinstance(diemap, list) and len(dielist) == len(diemap) > 1:
+        cu._dielist = dielist[:1]
+        cu._diemap = diemap[:1]
 
 
 def print_tree(s):
@@ -52,8 +83,10 @@ def print_tree(s):
 def debug_print(s):
     if DEBUG:
         print(s)
-# global dict, from offset to its DieDecription
-STRUCT_DICT = {}
+# global dict, from offset to its DieDecription (all type tags, reset per binary)
+TYPE_DICT = {}
+# hit/miss counters of TYPE_DICT (reset per binary)
+TYPE_CACHE_STATS = {'hit': 0, 'miss': 0}
 
 
 class DieDecription():
@@ -88,6 +121,13 @@ class DieDecription():
                 attr_dict['point_to_struct_fileds'] = [ {k: v.attr_dict(skip_recursive=True) if isinstance(v, DieDecription) else v for k, v in d.items()} for d in self.point_to_struct_fileds]
         return attr_dict
 
+    def table_dict(self, type_ref) -> Dict:
+        # like attr_dict, but the field types are replaced by type_ref(field description), i.e., their type_id
+        table_dict = self.__dict__.copy()
+        table_dict['struct_fields'] = [ {k: type_ref(v) if isinstance(v, DieDecription) else v for k, v in d.items()} for d in self.struct_fields]
+        table_dict['point_to_struct_fileds'] = [ {k: type_ref(v) if isinstance(v, DieDecription) else v for k, v in d.items()} for d in self.point_to_struct_fileds]
+        return table_dict
+
     def __str__(self) -> str:
         return f"DieDescription({self.attr_dict()})"
 
@@ -104,22 +144,43 @@ def process_addr(raw_addr:str) -> str:
         assert False
 
 
-def main(fpath, save_dir = None):
+def main(fpath, save_dir = None, print_stats = False, use_type_table = False, emit_subprogram = None, emit_types = None, sharded = False):
+    # emit_subprogram(unique_addr, subprogram) and emit_types(binname, type_table) receive the extracted data,
+    # by default they are dumped to save_dir, in one shard per binary with sharded (see shard_store.py)
+    writers = []   # the writer of the current binary used by _dump_subprogram
+    def _dump_subprogram(unique_addr, subprogram):
+        writers[-1].write(unique_addr +'.json', subprogram)
+
+    def _dump_types(binname, binary_types):
+        fpath = type_table_path(save_dir, binname)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        dump_json(fpath, binary_types)
 
-    def describe_die(die, die_dict) -> DieDecription:   
+    if emit_subprogram is None:
+        emit_subprogram = _dump_subprogram
+    if emit_types is None:
+        emit_types = _dump_types
+
+    def describe_die(die, die_lookup) -> DieDecription:   
         def _get_type(tmp_die) -> DieDecription:
             if 'DW_AT_type' in tmp_die.attributes:
-                target_type_die = die_dict.get(CU.cu_offset + tmp_die.attributes['DW_AT_type'].value)
+                target_type_die = die_lookup.get(CU.cu_offset + tmp_die.attributes['DW_AT_type'].value)
                 if target_type_die is not None:
-                    return describe_die(target_type_die, die_dict)
+                    return describe_die(target_type_die, die_lookup)
             return DieDecription()
 
 
-        # Check STRUCT_DICT first
-        if die.offset in STRUCT_DICT:
-            return STRUCT_DICT[die.offset]
-
+        # Check TYPE_DICT first. Cached descriptions are shared, so they must never be modified in place.
+        if die.offset in TYPE_DICT:
+            TYPE_CACHE_STATS['hit'] += 1
+            return TYPE_DICT[die.offset]
+        TYPE_CACHE_STATS['miss'] += 1
 
+        # types_in_progress[-1]: types being described since the innermost structure.
+        # Structures are registered before their fields, so only a cycle without a structure gets here.
+        if die.offset in types_in_progress[-1]:
+            return DieDecription()
+        types_in_progress[-1].add(die.offset)
 
         die_description = DieDecription()
 
@@ -168,16 +229,18 @@ def main(fpath, save_dir = None):
             if 'DW_AT_name' in die.attributes:
                 die_description.type_name = die.attributes['DW_AT_name'].value.decode()
 
-            STRUCT_DICT[die.offset] = die_description
+            # register the structure before its fields are described, so recursive structures terminate
+            TYPE_DICT[die.offset] = die_description
 
 
             die_description.struct_fields = []
+            types_in_progress.append(set())
             for child_die in die.iter_children():
                 if child_die.tag == 'DW_TAG_member':
                     member_name = child_die.attributes.get('DW_AT_name').value.decode() if 'DW_AT_name' in child_die.attributes else "<unknown>"  #TODO: should be fresh name
                     member_d = _get_type(child_die)
                     die_description.struct_fields.append({'field_name': member_name, 'field_attr': member_d})
-            STRUCT_DICT[die.offset] = die_description
+            types_in_progress.pop()
 
 
         elif die.tag == 'DW_TAG_base_type':
@@ -211,7 +274,7 @@ def main(fpath, save_dir = None):
                     die_description.point_to_struct_fileds = tmp_d.struct_fields
 
             else:
-                die_description = tmp_d
+                die_description = copy.copy(tmp_d)
 
 
                 if die.tag == 'DW_TAG_const_type':
@@ -227,6 +290,10 @@ def main(fpath, save_dir = None):
 
             
 
+        # a recursive structure may have described this type already, keep that (equivalent) description
+        die_description = TYPE_DICT.setdefault(die.offset, die_description)
+        types_in_progress[-1].discard(die.offset)
+
         debug_print(die.tag)
         debug_print(die_description)
         return die_description
@@ -264,7 +331,12 @@ def main(fpath, save_dir = None):
             curr_tag_info['Attr'][attr_name] = description.type_name if description.type_name is not None else '<unknown>'
             print_tree(child_indent + '|_' + '%s=%s' % (attr_name, curr_tag_info['Attr'][attr_name]))
             if description.istype:
-                curr_tag_info['Attr']['type_attr'] = description.attr_dict()
+                if use_type_table:
+                    # refer to the type by the offset of its DIE, the type itself goes to the type table
+                    type_offsets.add(CU.cu_offset + attr_value.value)
+                    curr_tag_info['Attr']['type_id'] = str(CU.cu_offset + attr_value.value)
+                else:
+                    curr_tag_info['Attr']['type_attr'] = description.attr_dict()
               
 
         for child in die.iter_children():
@@ -283,10 +355,10 @@ def main(fpath, save_dir = None):
 
         elif attr_name == 'DW_AT_type' and 'ref' in attr_value.form:
            
-            type_die = global_die_dict.get(CU.cu_offset + attr_value.value )
+            type_die = die_lookup.get(CU.cu_offset + attr_value.value )
             if type_die is not None:
-                type_description = describe_die(type_die, global_die_dict)
-                ret_d = type_description
+                type_description = describe_die(type_die, die_lookup)
+                ret_d = copy.copy(type_description)
                 ret_d.istype = True
                 return ret_d
             else:
@@ -316,7 +388,30 @@ def main(fpath, save_dir = None):
 
 
 
-    def _find_subprogram(json_block, binname):
+    def build_type_table(type_offsets) -> Dict:
+        # type_id -> type description, where the field types refer to other entries by their type_id.
+        # Referenced types are added as well, see type_table.TypeTable for how they are resolved.
+        desc_offsets = {id(desc): offset for offset, desc in TYPE_DICT.items()}
+        worklist = list(type_offsets)
+
+        def _type_ref(desc):
+            if id(desc) not in desc_offsets:
+                return desc.attr_dict()   # not a cached type (e.g., missing DIE), inline it
+            worklist.append(desc_offsets[id(desc)])
+            return str(desc_offsets[id(desc)])
+
+        binary_types = {}
+        while worklist:
+            offset = worklist.pop()
+            if str(offset) in binary_types:
+                continue
+            # DW_AT_type pointing to a missing DIE is described as an empty type
+            binary_types[str(offset)] = TYPE_DICT.get(offset, DieDecription()).table_dict(_type_ref)
+        return binary_types
+
+    def _find_subprogram(json_block, binname) -> int:
+        # dump every subprogram in the tree, return the number of subprograms dumped
+        emitted = 0
         if json_block['Tag'] == 'DW_TAG_subprogram' and 'funname' in json_block and 'fun_start_addr' in json_block:
             if json_block['funname'] != "<unknown>" and json_block['fun_start_addr'] != "<unknown>":
                 # functions strcat/strcpy have addr as unknown
@@ -324,9 +419,11 @@ def main(fpath, save_dir = None):
                 unique_addr = binname + '-' + curr_addr.upper()
                 if unique_addr not in visited_addr:
                     visited_addr.add(unique_addr)   
-                dump_json(os.path.join(save_dir, unique_addr +'.json'), json_block)
+                emit_subprogram(unique_addr, json_block)
+                emitted += 1
         for child in json_block['child']:
-            _find_subprogram(child, binname)
+            emitted += _find_subprogram(child, binname)
+        return emitted
 
 
 
@@ -338,59 +435,87 @@ def main(fpath, save_dir = None):
         file_list = [fpath]
 
     
+    emitted_per_cu = {}   # binname -> {cu path -> number of subprograms dumped}
     for f in tqdm(file_list, disable = len(file_list)==1):
-        STRUCT_DICT = {} # init struct_dict
-        debug_info ={}
+        # init the type cache
+        TYPE_DICT.clear()
+        TYPE_CACHE_STATS['hit'] = TYPE_CACHE_STATS['miss'] = 0
+        types_in_progress = [set()]
 
         elffile = read_elf(f)
-        if not elffile.has_dwarf_info():
-            print('file has no DWARF info')
-            return
-        # get_dwarf_info returns a DWARFInfo context object, which is the
-        # starting point for all DWARF-based processing in pyelftools.
-        dwarfinfo = elffile.get_dwarf_info()
+        try:
+            if not elffile.has_dwarf_info():
+                print('file has no DWARF info')
+                return emitted_per_cu
+            # get_dwarf_info returns a DWARFInfo context object, which is the
+            # starting point for all DWARF-based processing in pyelftools.
+            dwarfinfo = elffile.get_dwarf_info()
         
-        # The location lists are extracted by DWARFInfo from the .debug_loc
-        # section, and returned here as a LocationLists object.
-        location_lists = dwarfinfo.location_lists()
-        # print(location_lists)  # None
+            # The location lists are extracted by DWARFInfo from the .debug_loc
+            # section, and returned here as a LocationLists object.
+            location_lists = dwarfinfo.location_lists()
+            # print(location_lists)  # None
 
-        # This is required for the descriptions module to correctly decode
-        # register names contained in DWARF expressions.
-        set_global_machine_arch(elffile.get_machine_arch())
+            # This is required for the descriptions module to correctly decode
+            # register names contained in DWARF expressions.
+            set_global_machine_arch(elffile.get_machine_arch())
 
-        # Create a LocationParser object that parses the DIE attributes and
-        # creates objects representing the actual location information.
-        loc_parser = LocationParser(location_lists)
+            # Create a LocationParser object that parses the DIE attributes and
+            # creates objects representing the actual location information.
+            loc_parser = LocationParser(location_lists)
 
 
-        global_die_dict = {} 
-        for CU in dwarfinfo.iter_CUs():
-            for die in CU.iter_DIEs():
-                global_die_dict[die.offset] = die
-
-        # Traverse every DIE (Debugging Information Entry) in the .debug_info section
-        for CU in tqdm(dwarfinfo.iter_CUs(), disable = len(file_list)==1):
-            top_DIE = CU.get_top_DIE()
-            curr_file_path = Path(top_DIE.get_full_path()).as_posix()
-
-            debug_print(CU.cu_offset)         
-
-            debug_info[curr_file_path] = die_info_rec(top_DIE)
-           
+            # DIEs referenced by DW_AT_type are parsed on demand
+            die_lookup = DIELookup()
 
             binname = os.path.basename(f)
             visited_addr = set()
-            for cu in debug_info:
-                _find_subprogram(debug_info[cu], binname)
+            if emit_subprogram is _dump_subprogram:
+                writers.append(open_writer(save_dir, binname, sharded))
+            emitted_per_cu[binname] = {}
+            type_offsets = set()   # offsets of the types referenced by DW_AT_type, only used with use_type_table
+
+            # Traverse every DIE (Debugging Information Entry) in the .debug_info section.
+            # Subprograms are dumped as soon as their CU is processed, and the CU tree is dropped afterwards.
+            for CU in tqdm(dwarfinfo.iter_CUs(), disable = len(file_list)==1):
+                die_lookup.set_cu(CU)
+                top_DIE = CU.get_top_DIE()
+                curr_file_path = Path(top_DIE.get_full_path()).as_posix()
+
+                debug_print(CU.cu_offset)         
+
+                cu_tree = die_info_rec(top_DIE)
+                emitted = _find_subprogram(cu_tree, binname)
+                emitted_per_cu[binname][curr_file_path] = emitted_per_cu[binname].get(curr_file_path, 0) + emitted
+                del cu_tree
+                release_cu(CU)
+
+            if use_type_table:
+                emit_types(binname, build_type_table(type_offsets))
+            if emit_subprogram is _dump_subprogram:
+                writers.pop().close()
+
+            if print_stats:
+                for cu_path, emitted in emitted_per_cu[binname].items():
+                    print(f'{binname} - {cu_path}: {emitted} subprograms')
+                print(f'{binname}: {sum(emitted_per_cu[binname].values())} subprograms from {len(emitted_per_cu[binname])} CUs')
+                print(f"{binname}: type cache hit {TYPE_CACHE_STATS['hit']}, miss {TYPE_CACHE_STATS['miss']}, {len(TYPE_DICT)} types")
+        finally:
+            # the mapping of the ELF file, also when the file has no DWARF info
+            elffile.stream.close()
+
+    return emitted_per_cu
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('fpath')
     parser.add_argument('--save_dir', default=None, help='Optional save directory')
+    parser.add_argument('--stats', default=False, action='store_true', help='print the number of subprograms dumped per CU')
+    parser.add_argument('--sharded', default=False, action='store_true', help='save the subprograms of a binary in one shard instead of one file each, see shard_store.py')
+    parser.add_argument('--type_table', default=False, action='store_true', help='refer to types by `type_id` and save them once per binary in <save_dir>/types/<bin>.json')
     args = parser.parse_args()
 
-    main(args.fpath, args.save_dir if args.save_dir is not None else None)
+    main(args.fpath, args.save_dir if args.save_dir is not None else None, print_stats=args.stats, use_type_table=args.type_table, sharded=args.sharded)
 
     
 
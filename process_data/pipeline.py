@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import tempfile
+import contextlib
+from utils import *
+from tqdm import tqdm
+from typing import Dict, List
+from error import FileAlignException
+from prep_decompiled import prep_fun
+import parse_dwarf
+from type_table import TypeTable, type_table_path, compact_align_data
+from init_align import align_fun
+from align_stack import build_vardecoder_data, strip_header
+from align_field import align_field_fun
+from gen_train_field import gen_prompt
+from field_access import FIELD_ACCESS_BIN, DEFS_HH, ensure_pch, run_batch, field_access_path, save_failures
+from stage_cache import StageCache, run_cached, file_hash, source_hash
+from shard_store import open_writer
+
+# Runs all stages of process_data.sh for one binary in a single process.
+# The data is passed between stages as objects, intermediate results are only saved with save_intermediate.
+# With sharded, the files of a binary in each folder are saved in one shard instead (see shard_store.py).
+
+# version and source files of each cached stage (see stage_cache.py),
+# bump the version to invalidate the cached results of a stage when its source files are not enough to tell
+# (the field_access key also holds the hashes of the tool binary and of defs.hh, see stage_keys)
+# every stage is run by this file (run_prep_decompiled, ...) with the helpers of utils.py
+COMMON_SOURCES = ['pipeline.py', 'utils.py']
+STAGE_VERSIONS = {
+    'prep_decompiled': (1, ['prep_decompiled.py', 'decompiled_parser.py'] + COMMON_SOURCES),
+    'parse_dwarf': (1, ['parse_dwarf.py', 'type_table.py'] + COMMON_SOURCES),
+    'init_align': (1, ['init_align.py', 'align_stack.py', 'type_table.py'] + COMMON_SOURCES),
+    'field_access': (3, ['field_access.py'] + COMMON_SOURCES),
+}
+
+# log file (in log_dir) of each stage, same as process_data.sh
+STAGE_LOGS = {
+    'prep_decompiled': 'parse_decompiled_errors',
+    'init_align': 'align_errors',
+    'field_access': 'field_access_failures',   # one JSON failure record per line
+    'align_field': 'align_field_errors',
+}
+
+
+@contextlib.contextmanager
+def stage_log(log_dir, stage):
+    # append the output of a stage to its log file, print it if log_dir is None
+    if log_dir is None:
+        yield
+        return
+    with open(os.path.join(log_dir, STAGE_LOGS[stage]), 'a') as fp, contextlib.redirect_stdout(fp):
+        yield
+
+
+def get_dirs(source_dir) -> Dict[str, str]:
+    # folders used by process_data.sh
+    return {
+        'bin': os.path.join(source_dir, 'bin'),
+        'decompiled': os.path.join(source_dir, 'decompiled'),
+        'decompiled_files': os.path.join(source_dir, 'decompiled_files'),
+        'decompiled_vars': os.path.join(source_dir, 'decompiled_vars'),
+        'debuginfo_subprograms': os.path.join(source_dir, 'debuginfo_subprograms'),
+        'align': os.path.join(source_dir, 'align'),
+        'train_var': os.path.join(source_dir, 'train_var'),
+        'field_access': os.path.join(source_dir, 'field_access'),
+        'train_field': os.path.join(source_dir, 'train_field'),
+    }
+
+
+def run_prep_decompiled(decompiled_fpath) -> (Dict[str, str], Dict[str, Dict]):
+    # return {addr -> code with HEADER}, {addr -> parsed variables}
+    fname = os.path.basename(decompiled_fpath)
+    codes = {}
+    var_files = {}
+    for fun in iter_json_records(decompiled_fpath):
+        addr, code_with_header, save_data = prep_fun(fname, fun)
+        codes[addr] = code_with_header
+        if save_data is not None:
+            var_files[addr] = save_data
+    return codes, var_files
+
+
+def save_prep_decompiled(binname, codes, var_files, file_save_dir, parsed_save_dir, sharded=False):
+    # same files as prep_decompiled.py
+    with open_writer(file_save_dir, binname, sharded) as writer:
+        for addr, code_with_header in codes.items():
+            writer.write(binname + '-' + str(addr) + '.c', code_with_header)
+    with open_writer(parsed_save_dir, binname, sharded) as writer:
+        for addr, save_data in var_files.items():
+            writer.write(binname + '-' + str(addr) + '_var.json', save_data)
+
+
+def run_parse_dwarf(bin_fpath) -> (Dict[str, Dict], TypeTable):
+    # return {<binname>-<addr> -> subprogram}, and the type table of the binary
+    subprograms = {}
+    type_table = TypeTable(None)
+
+    def _emit_subprogram(unique_addr, subprogram):
+        subprograms[unique_addr] = subprogram
+
+    def _emit_types(binname, binary_types):
+        type_table.tables[binname] = binary_types
+
+    parse_dwarf.main(bin_fpath, use_type_table=True, emit_subprogram=_emit_subprogram, emit_types=_emit_types)
+    return subprograms, type_table
+
+
+def save_parse_dwarf(binname, subprograms, type_table, save_dir, sharded=False):
+    # same files as parse_dwarf.py --type_table
+    with open_writer(save_dir, binname, sharded) as writer:
+        for unique_addr, subprogram in subprograms.items():
+            writer.write(unique_addr + '.json', subprogram)
+    for table_binname, binary_types in type_table.tables.items():
+        fpath = type_table_path(save_dir, table_binname)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        dump_json(fpath, binary_types)
+
+
+def run_init_align(subprograms, type_table, codes, var_files, ignore_complex=False) -> (Dict[str, Dict], Dict[str, Dict]):
+    # same as init_align.main, return {<binname>-<addr> -> align data}, {<binname>-<addr> -> training data}
+    # subprograms and var_files are modified in place
+    error_cnt = 0
+    success_cnt = 0
+    train_data_cnt = 0
+    align_results = {}
+    train_data = {}
+    for unique_addr, subprogram_file in subprograms.items():
+        f = unique_addr + '.json'
+        proj_name, fun_addr = unique_addr.split('-')
+        var_fname = proj_name + '-' + fun_addr.upper()  + '_var.json'
+        try:
+            if fun_addr.upper() not in var_files:
+                raise FileAlignException(f'Cannot find file {var_fname}. Skip')
+            var_file = var_files[fun_addr.upper()]
+            type_table.resolve_subprogram(proj_name, subprogram_file)
+        except FileAlignException as e:
+            print(f'Error: {var_fname} - {e.msg}')
+            error_cnt += 1
+            continue
+        except Exception as e:
+            print(f'[ERROR] (init_align) Other error {var_fname} - {e}')
+            error_cnt += 1
+            continue
+
+        # same as reading decompiled_files/*.c in text mode
+        code = strip_header(codes[fun_addr.upper()].replace('\r\n', '\n').replace('\r', '\n'))
+        align_data = align_fun(f, var_file, subprogram_file, None, None, code=code)
+        if align_data is None:
+            error_cnt += 1
+            continue
+        align_results[unique_addr] = align_data
+
+        # generate training data
+        save_data = build_vardecoder_data(unique_addr, align_data, ignore_complex=ignore_complex)
+        if save_data is not None:
+            train_data[unique_addr] = save_data
+        train_data_cnt += 1
+        success_cnt += 1
+
+    print(f'Success: {success_cnt}, Training data generated: {train_data_cnt}, Fail: {error_cnt}')
+    return align_results, train_data
+
+
+def save_init_align(binname, align_results, train_data, train_var_dir, align_save_dir=None, sharded=False):
+    # same files as init_align.py, the align data is saved only if align_save_dir is given
+    if align_save_dir is not None:
+        with open_writer(align_save_dir, binname, sharded) as writer:
+            for unique_addr, align_data in align_results.items():
+                proj_name, fun_addr = unique_addr.split('-')
+                writer.write(proj_name + '-' + fun_addr.upper() + '.json', compact_align_data(align_data))
+    with open_writer(train_var_dir, binname, sharded, index=False) as writer:
+        for unique_addr, save_data in train_data.items():
+            writer.write(unique_addr + '.json', save_data)
+
+
+def run_field_access(binname, unique_addrs, codes, src_dir, save_dir, num_workers=None) -> (Dict[str, List[Dict]], List[Dict]):
+    # run the clang field_access tool on the given functions in parallel shards (see field_access.py),
+    # return {<binname>-<addr> -> field access data} and the failure records, which are printed one per line
+    # src_dir: where the .c files are (written if missing), save_dir: where the output of the binary is saved
+    src_fpaths = []
+    for unique_addr in unique_addrs:
+        src_fpath = os.path.join(src_dir, unique_addr + '.c')
+        if not os.path.exists(src_fpath):
+            write_file(src_fpath, codes[unique_addr.split('-')[1]])
+        src_fpaths.append(src_fpath)
+    field_access_results, failures = run_batch(binname, src_fpaths, field_access_path(save_dir, binname), ensure_pch(), num_workers=num_workers)
+    for failure in failures:
+        print(json.dumps(failure))
+    return field_access_results, failures
+
+
+def run_align_field(binname, align_results, field_access_results, train_field_dir, sharded=False):
+    # same as align_field.main
+    writer = open_writer(train_field_dir, binname, sharded, index=False)
+    success_cnt = 0
+    fail_cnt = 0
+    unavailable = 0
+    for unique_addr, align_data in align_results.items():
+        f = unique_addr + '.json'
+        try:
+            if unique_addr not in field_access_results:
+                unavailable += 1
+                print(f"Cannot find the beyond access info of {unique_addr}")
+                continue
+            save_data = align_field_fun(f, align_data, field_access_results[unique_addr])
+            if save_data is not None:
+                success_cnt += 1
+            else:
+                unavailable += 1
+                continue
+        except FileAlignException as e:
+            print(f'Error: {unique_addr} - {e.msg}')
+            fail_cnt += 1
+            continue
+        except Exception as e:
+            print(f'[ERROR] (align heap) Other error {unique_addr} - {e}')
+            fail_cnt += 1
+            continue
+
+        writer.write(unique_addr + '.json', gen_prompt(save_data))
+    writer.close()
+    print(f'Success: {success_cnt}, Fail: {fail_cnt}, Unavailable: {unavailable}')
+
+
+def stage_keys(cache: StageCache, binname, bin_fpath, decompiled_fpath, ignore_complex) -> Dict[str, str]:
+    # cache key of each stage, a stage key depends on the keys of the stages it reads from
+    def _key(stage, *inputs):
+        version, sources = STAGE_VERSIONS[stage]
+        return cache.key(stage, version, source_hash(sources), binname, *inputs)
+
+    keys = {}
+    keys['prep_decompiled'] = _key('prep_decompiled', file_hash(decompiled_fpath))
+    keys['parse_dwarf'] = _key('parse_dwarf', file_hash(bin_fpath))
+    keys['init_align'] = _key('init_align', keys['prep_decompiled'], keys['parse_dwarf'], ignore_complex)
+    # the compiled tool and the header it parses the files with, rebuilding either invalidates the stage
+    tool_hashes = [file_hash(fpath) if os.path.exists(fpath) else None for fpath in (FIELD_ACCESS_BIN, DEFS_HH)]
+    keys['field_access'] = _key('field_access', keys['prep_decompiled'], keys['init_align'], *tool_hashes)
+    return keys
+
+
+def run_binary(source_dir, binname, field=False, save_intermediate=False, log_dir=None, cache_dir=None, field_workers=None, sharded=False) -> bool:
+    # process one binary of source_dir (see process_data.sh), return False if it has no decompiled file
+    # cache_dir: reuse the results of the stages whose inputs did not change (see stage_cache.py)
+    # field_workers: number of field_access tool runs at a time, by default the number of cores
+    # sharded: save one shard per binary in each folder instead of one file per function (see shard_store.py)
+    dirs = get_dirs(source_dir)
+    bin_fpath = os.path.join(dirs['bin'], binname)
+    decompiled_fpath = os.path.join(dirs['decompiled'], binname + '.decompiled')
+    if not os.path.exists(decompiled_fpath):
+        return False
+
+    output_dirs = ['train_var', 'train_field'] if field else ['train_var']
+    if save_intermediate:
+        output_dirs += ['decompiled_files', 'decompiled_vars', 'debuginfo_subprograms', 'align']
+        if field:
+            output_dirs.append('field_access')
+    for d in output_dirs:
+        os.makedirs(dirs[d], exist_ok=True)
+
+    cache = StageCache(cache_dir) if cache_dir is not None else None
+    keys = stage_keys(cache, binname, bin_fpath, decompiled_fpath, not field) if cache is not None else {}
+
+    with stage_log(log_dir, 'prep_decompiled'):
+        codes, var_files = run_cached(cache, 'prep_decompiled', keys.get('prep_decompiled'), lambda: run_prep_decompiled(decompiled_fpath))
+    if save_intermediate:
+        save_prep_decompiled(binname, codes, var_files, dirs['decompiled_files'], dirs['decompiled_vars'], sharded=sharded)
+
+    # DWARF parsing is skipped when the align results are cached and the subprograms are not saved
+    def _parse_dwarf():
+        return run_cached(cache, 'parse_dwarf', keys.get('parse_dwarf'), lambda: run_parse_dwarf(bin_fpath))
+
+    dwarf_results = None
+    if save_intermediate:
+        dwarf_results = _parse_dwarf()
+        save_parse_dwarf(binname, *dwarf_results, dirs['debuginfo_subprograms'], sharded=sharded)
+
+    def _init_align():
+        subprograms, type_table = dwarf_results if dwarf_results is not None else _parse_dwarf()
+        return run_init_align(subprograms, type_table, codes, var_files, ignore_complex=not field)
+
+    with stage_log(log_dir, 'init_align'):
+        align_results, train_data = run_cached(cache, 'init_align', keys.get('init_align'), _init_align)
+    save_init_align(binname, align_results, train_data, dirs['train_var'], dirs['align'] if save_intermediate else None, sharded=sharded)
+    del dwarf_results, train_data
+
+    if field:
+        # the clang tool needs the .c files on disk, they are written to a temporary folder when they are not saved as files
+        with contextlib.ExitStack() as stack:
+            if save_intermediate and not sharded:
+                src_dir = dirs['decompiled_files']
+            else:
+                src_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            field_access_dir = dirs['field_access'] if save_intermediate else src_dir
+            with stage_log(log_dir, 'field_access'):
+                field_access_results, failures = run_cached(cache, 'field_access', keys.get('field_access'),
+                    lambda: run_field_access(binname, align_results.keys(), codes, src_dir, field_access_dir, num_workers=field_workers))
+            if save_intermediate:
+                if not os.path.exists(field_access_path(field_access_dir, binname)):
+                    dump_json(field_access_path(field_access_dir, binname), field_access_results)
+                save_failures(field_access_dir, binname, failures)
+
+        with stage_log(log_dir, 'align_field'):
+            run_align_field(binname, align_results, field_access_results, dirs['train_field'], sharded=sharded)
+    return True
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_dir', help='the data folder, must include `bin` and `decompiled` folders')
+    parser.add_argument('--bin', required=False, default=None, help='only process this binary')
+    parser.add_argument('--field', required=False, default=False, action='store_true', help='extract field access information as well')
+    parser.add_argument('--save_intermediate', required=False, default=False, action='store_true', help='save the intermediate results of every stage')
+    parser.add_argument('--log_dir', required=False, default=None, help='append the output of each stage to its log file in this folder')
+    parser.add_argument('--cache_dir', required=False, default=None, help='reuse the cached results of the unchanged stages, see stage_cache.py')
+    parser.add_argument('--field_workers', required=False, default=None, type=int, help='number of field_access tool runs at a time, by default the number of cores')
+    parser.add_argument('--sharded', required=False, default=False, action='store_true', help='save one shard per binary in each folder instead of one file per function, see shard_store.py')
+    args = parser.parse_args()
+
+    if args.bin:
+        binnames = [args.bin]
+    else:
+        binnames = get_file_list(os.path.join(args.source_dir, 'bin'))
+    for binname in tqdm(binnames, disable=len(binnames)==1):
+        run_binary(args.source_dir, binname, field=args.field, save_intermediate=args.save_intermediate, log_dir=args.log_dir, cache_dir=args.cache_dir, field_workers=args.field_workers, sharded=args.sharded)
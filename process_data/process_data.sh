@@ -3,31 +3,51 @@
 # Ensure at least one argument is provided (the required parameter)
 if [ -z "$1" ]; then
     echo "Error: Missing required parameter."
-    echo "Usage: $0 <required_param> [--field]"
+    echo "Usage: $0 <required_param> [--field] [--clean] [--resume]"
     exit 1
 fi
 source_dir=$1    
 field_flag=""
 clean_flag=""
+resume_flag=""
+
+for arg in "${@:2}"; do
+    case "$arg" in
+        --field) field_flag="--field" ;;
+        --clean) clean_flag="--clean" ;;
+        --resume) resume_flag="--resume" ;;
+    esac
+done
 
 # Check if the optional "field" parameter is provided
-if [[ "$2" == "--field" || "$3" == "--field" ]]; then
+if [ -n "$field_flag" ]; then
     echo "Extracting both stack variables and field access information."
-    field_flag="--field"
 else
     echo "Extracting stack variables only."
 fi
 
 
 # Check if the optional "clean" parameter is provided
-if [[ "$2" == "--clean" || "$3" == "--clean" ]]; then
+if [ -n "$clean_flag" ]; then
     echo "Clean flag is set. Will clean intermediate results after processing."
-    clean_flag="--clean"
 fi
 
 
-MAX_PROC=20
-check_interval=1
+# Check if the optional "resume" parameter is provided
+if [ -n "$resume_flag" ]; then
+    echo "Resume flag is set. The binaries in $source_dir/completed_files are skipped and the output folders are kept."
+fi
+
+
+# number of binaries processed in parallel, empty to size it to the available cores and memory
+MAX_PROC=
+# the stage results are cached in $source_dir/stage_cache across runs, entries unused for CACHE_MAX_AGE_DAYS are removed
+# and the least recently used ones beyond CACHE_MAX_SIZE_GB (empty for no limit)
+CACHE_MAX_AGE_DAYS=30
+CACHE_MAX_SIZE_GB=
+# set to save one shard per binary in each folder instead of one file per function (see shard_store.py),
+# `python shard_store.py <folder>` exports the shards of a folder back to files
+SHARDED=
 
 check_dir_exist() {
     target_dir=$1
@@ -55,9 +75,13 @@ create_dir() {
 create_and_clean_dir() {
     target_dir=$1
     create_dir $target_dir
+    # the results of the completed binaries are kept when resuming
+    if [ -n "$resume_flag" ]; then
+        return
+    fi
     # Check if the directory contains any files before trying to remove them
     if [ "$(ls -A "$target_dir")" ]; then
-        rm "$target_dir"/*
+        rm -r "$target_dir"/*
         if [ $? -ne 0 ]; then
             echo "Warning: Could not remove some files in '$target_dir'."
         fi
@@ -78,6 +102,7 @@ debuginfo_subprograms_dir="$source_dir/debuginfo_subprograms"
 align_var="$source_dir/align"
 train_var="$source_dir/train_var"
 logs_dir="$source_dir/logs"
+cache_dir="$source_dir/stage_cache"
 
 create_and_clean_dir $decompiled_files_dir
 create_and_clean_dir $decompiled_vars_dir
@@ -87,80 +112,41 @@ create_and_clean_dir $train_var
 create_and_clean_dir $logs_dir
 
 if [ -n "$field_flag" ]; then
-    commands_dir="$source_dir/commands"
     field_access_dir="$source_dir/field_access/"
     train_field="$source_dir/train_field"
-    create_and_clean_dir $commands_dir
     create_and_clean_dir $field_access_dir
     create_and_clean_dir $train_field
 fi
 
-
-process_file() {
-    local FILE=$1
-
-    binname=$(basename "$FILE")
-    
-    # Check if the corresponding decompiled file exists, if not, skip processing
-    if [ ! -f "$decompiled_dir/$binname.decompiled" ]; then
-        return
-    fi
-
-    python prep_decompiled.py "$decompiled_dir/$binname.decompiled" $decompiled_files_dir $decompiled_vars_dir >> "$logs_dir/parse_decompiled_errors"
-
-    python parse_dwarf.py $bin_dir"/$binname" --save_dir=$debuginfo_subprograms_dir
-
-
-    if [ -n "$field_flag" ]; then
-        python init_align.py $decompiled_vars_dir $debuginfo_subprograms_dir $decompiled_files_dir $align_var $train_var --bin $binname >> "$source_dir/logs/align_errors"
-
-
-        echo "#!/bin/bash" > "$commands_dir/$binname"_command.sh
-        python gen_command.py $decompiled_files_dir "$source_dir" --bin $binname >> "$commands_dir/$binname"_command.sh
-        bash "$commands_dir/$binname"_command.sh >> "$logs_dir/clang_errors" 2>&1
-
-        python align_field.py $align_var $field_access_dir $train_field --bin $binname >> $logs_dir/align_field_errors
-    else
-        python init_align.py $decompiled_vars_dir $debuginfo_subprograms_dir $decompiled_files_dir $align_var $train_var --bin $binname --ignore_complex >> "$source_dir/logs/align_errors"
-    fi
-
-    echo "$binname" >> "$donefiles"
-}
+# intermediate results are only saved when they are kept after processing
+intermediate_flag="--save_intermediate"
+if [ -n "$clean_flag" ]; then
+    intermediate_flag=""
+fi
 
 
-# Create an array of all files in the bin directory
-files=($bin_dir/*)
-jobs_cntr=0
-jobs_to_run_num=${#files[@]}
+workers_flag=""
+if [ -n "$MAX_PROC" ]; then
+    workers_flag="--workers $MAX_PROC"
+fi
+sharded_flag=""
+if [ -n "$SHARDED" ]; then
+    sharded_flag="--sharded"
+fi
 donefiles=$source_dir/"completed_files"
-rm -f $donefiles
-touch $donefiles
-
-# Main processing loop with multithreading logic
-while ((jobs_cntr < jobs_to_run_num)); do
-    # Get the current number of running jobs
-    cur_jobs_num=$(wc -l < <(jobs -r))
-
-    # Get the current file to process
-    current_file="${files[jobs_cntr]}"
-
-    # Check if the file has already been processed
-    if ! grep -q -F "$current_file" "$donefiles"; then
-        if ((cur_jobs_num < MAX_PROC)); then
-            echo "=== Progress: $jobs_cntr/$jobs_to_run_num ==="
-            process_file "$current_file" &
-            ((jobs_cntr++))
-        else
-            sleep "$check_interval"
-        fi
-    else
-        # File already processed, so just increase the counter
-        ((jobs_cntr++))
-    fi
-done
 
-# Wait for all background jobs to complete
-wait
+# all stages (prep_decompiled, parse_dwarf, init_align, field_access, align_field) of a binary run in one worker,
+# the binaries are dispatched largest first to a process pool
+python scheduler.py "$source_dir" $field_flag $intermediate_flag $workers_flag $sharded_flag $resume_flag --log_dir "$logs_dir" --cache_dir "$cache_dir"
+
+evict_flags=""
+if [ -n "$CACHE_MAX_AGE_DAYS" ]; then
+    evict_flags="$evict_flags --max_age_days $CACHE_MAX_AGE_DAYS"
+fi
+if [ -n "$CACHE_MAX_SIZE_GB" ]; then
+    evict_flags="$evict_flags --max_size_gb $CACHE_MAX_SIZE_GB"
+fi
+python stage_cache.py "$cache_dir" $evict_flags
 
 
 
@@ -171,10 +157,9 @@ if [ -n "$clean_flag" ]; then
     rm -r $debuginfo_subprograms_dir
     rm -r $align_var
     rm -r $logs_dir
-    rm $donefiles
+    rm -f $donefiles
     if [ -n "$field_flag" ]; then
         rm -r $field_access_dir
-        rm -r $commands_dir
     fi
 fi
 
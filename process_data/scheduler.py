@@ -0,0 +1,135 @@
+import argparse
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from utils import *
+from tqdm import tqdm
+from typing import List, Set
+from pipeline import run_binary, get_dirs
+from field_access import set_slots
+
+# Runs pipeline.run_binary for every binary of the data folder on a process pool.
+# Binaries are dispatched largest first, and an idle worker takes the next pending binary,
+# so the big ones do not end up as a serial tail. Finished binaries are recorded in a completion index.
+# A task is a binary, not a stage: the stages of a binary depend on each other and pass their results in memory (see pipeline.py),
+# running them as separate tasks would pickle these results between processes. The parallelism comes from the binaries,
+# and from the field_access tool runs, which are shared by all workers (see set_slots).
+
+MEM_PER_WORKER = 2   # estimated peak memory (GB) of one worker, used to size the pool
+COMPLETION_INDEX = 'completed_files'   # in the data folder, one finished binary per line
+
+
+def available_cores() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory() -> int:
+    # available memory in bytes, None if unknown
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def default_num_workers(mem_per_worker=MEM_PER_WORKER) -> int:
+    # as many workers as cores, as long as they fit into the available memory
+    num_workers = available_cores()
+    memory = available_memory()
+    if memory is not None:
+        num_workers = min(num_workers, memory // int(mem_per_worker * 1024 ** 3))
+    return max(1, num_workers)
+
+
+def load_completed(index_path) -> Set[str]:
+    if not os.path.exists(index_path):
+        return set()
+    return set(line.strip() for line in read_file(index_path, readlines=True) if line.strip())
+
+
+def mark_completed(index_path, binname):
+    # only called by the scheduler process, so the index has a single writer
+    with open(index_path, 'a') as f:
+        f.write(binname + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def get_jobs(source_dir, completed: Set[str]) -> List[str]:
+    # binaries that have a decompiled file and are not completed yet, largest first
+    dirs = get_dirs(source_dir)
+    jobs = []
+    for binname in get_file_list(dirs['bin']):
+        if binname in completed:
+            continue
+        decompiled_fpath = os.path.join(dirs['decompiled'], binname + '.decompiled')
+        if not os.path.exists(decompiled_fpath):
+            continue
+        size = os.path.getsize(os.path.join(dirs['bin'], binname)) + os.path.getsize(decompiled_fpath)
+        jobs.append((size, binname))
+    return [binname for _, binname in sorted(jobs, reverse=True)]
+
+
+def process_binary(source_dir, binname, field, save_intermediate, log_dir, cache_dir, sharded=False):
+    # task run by a worker, return (binname, error message or None)
+    try:
+        run_binary(source_dir, binname, field=field, save_intermediate=save_intermediate, log_dir=log_dir, cache_dir=cache_dir, sharded=sharded)
+    except Exception as e:
+        return binname, f'{type(e).__name__}: {e}'
+    return binname, None
+
+
+def schedule(source_dir, field=False, save_intermediate=False, log_dir=None, num_workers=None, resume=False, cache_dir=None, sharded=False):
+    index_path = os.path.join(source_dir, COMPLETION_INDEX)
+    if not resume and os.path.exists(index_path):
+        os.remove(index_path)
+    completed = load_completed(index_path)
+    jobs = get_jobs(source_dir, completed)
+    if num_workers is None:
+        num_workers = default_num_workers()
+    num_workers = max(1, min(num_workers, len(jobs)))
+    print(f'{len(jobs)} binaries to process ({len(completed)} already completed) with {num_workers} workers')
+    if not jobs:
+        return
+
+    failed = []
+    # the field_access tool runs of all workers share the cores, so that the shards of the last binaries use the idle ones
+    slots = multiprocessing.BoundedSemaphore(available_cores())
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=set_slots, initargs=(slots,)) as executor:
+        futures = {executor.submit(process_binary, source_dir, binname, field, save_intermediate, log_dir, cache_dir, sharded): binname for binname in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                binname, error = future.result()
+            except BrokenProcessPool as e:
+                # a worker died (e.g., killed for memory), the remaining binaries are left for --resume
+                binname, error = futures[future], f'worker died: {e}'
+            if error is None:
+                mark_completed(index_path, binname)
+            else:
+                failed.append(binname)
+                print(f'[ERROR] (scheduler) {binname} - {error}')
+
+    print(f'Completed: {len(jobs) - len(failed)}, Failed: {len(failed)}')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source_dir', help='the data folder, must include `bin` and `decompiled` folders')
+    parser.add_argument('--field', required=False, default=False, action='store_true', help='extract field access information as well')
+    parser.add_argument('--save_intermediate', required=False, default=False, action='store_true', help='save the intermediate results of every stage')
+    parser.add_argument('--log_dir', required=False, default=None, help='append the output of each stage to its log file in this folder')
+    parser.add_argument('--workers', required=False, default=None, type=int, help='number of workers, by default sized to the available cores and memory')
+    parser.add_argument('--mem_per_worker', required=False, default=MEM_PER_WORKER, type=float, help='estimated memory (GB) per worker used to size the pool')
+    parser.add_argument('--cache_dir', required=False, default=None, help='reuse the cached results of the unchanged stages, see stage_cache.py')
+    parser.add_argument('--sharded', required=False, default=False, action='store_true', help='save one shard per binary in each folder instead of one file per function, see shard_store.py')
+    parser.add_argument('--resume', required=False, default=False, action='store_true', help=f'skip the binaries recorded in <source_dir>/{COMPLETION_INDEX}')
+    args = parser.parse_args()
+
+    num_workers = args.workers if args.workers else default_num_workers(args.mem_per_worker)
+    schedule(args.source_dir, field=args.field, save_intermediate=args.save_intermediate, log_dir=args.log_dir, num_workers=num_workers, resume=args.resume, cache_dir=args.cache_dir, sharded=args.sharded)
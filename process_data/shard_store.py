@@ -0,0 +1,195 @@
+import argparse
+import os
+from utils import *
+from typing import Dict, Iterator, List, Tuple
+from tqdm import tqdm
+
+# Sharded layout of the per-function files (decompiled_files, decompiled_vars, debuginfo_subprograms, align, train_var, train_field).
+# All the files of a binary in a folder are the records of one shard, <folder>/shards/<binname>.jsonl,
+# one {"name": <file name>, "data": <content>} per line, the text of a .c file, the JSON data of a .json file.
+# <folder>/shards/<binname>.offsets ({<file name>: [offset, length]}) gives the position of every record.
+# open_writer and FolderReader have the same interface for both layouts, export_shards converts the shards back to files.
+
+SHARD_DIR = 'shards'
+
+
+def shard_path(folder, binname):
+    return os.path.join(folder, SHARD_DIR, binname + '.jsonl')
+
+
+def offsets_path(folder, binname):
+    return os.path.join(folder, SHARD_DIR, binname + '.offsets')
+
+
+def has_shard(folder, binname) -> bool:
+    return os.path.exists(offsets_path(folder, binname))
+
+
+def shard_binnames(folder) -> List[str]:
+    shard_dir = os.path.join(folder, SHARD_DIR)
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(f[:-len('.offsets')] for f in get_file_list(shard_dir) if f.endswith('.offsets'))
+
+
+class FileWriter:
+    # one file per record, and the index of the binary (see write_bin_index) on close if index is set
+    def __init__(self, folder, binname, index=True):
+        self.folder = folder
+        self.binname = binname
+        self.index = index
+        self.fnames = []
+
+    def write(self, fname, data):
+        fpath = os.path.join(self.folder, fname)
+        if fname.endswith('.json'):
+            dump_json(fpath, data)
+        else:
+            write_file(fpath, data)
+        self.fnames.append(fname)
+
+    def close(self):
+        if self.index:
+            write_bin_index(self.folder, self.binname, self.fnames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShardWriter:
+    # the records of a binary in one shard, written to temporary files that replace the shard on close
+    def __init__(self, folder, binname):
+        self.fpath = shard_path(folder, binname)
+        self.offsets_fpath = offsets_path(folder, binname)
+        os.makedirs(os.path.dirname(self.fpath), exist_ok=True)
+        self.tmp_fpath = f'{self.fpath}.{os.getpid()}.tmp'
+        self.fp = open(self.tmp_fpath, 'wb')
+        self.offsets = {}
+
+    def write(self, fname, data):
+        line = (json_dumps({'name': fname, 'data': data}, pretty=False) + '\n').encode()
+        self.offsets[fname] = [self.fp.tell(), len(line)]
+        self.fp.write(line)
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.fp.close()
+        self.fp = None
+        tmp_offsets_fpath = f'{self.offsets_fpath}.{os.getpid()}.tmp'
+        with open(tmp_offsets_fpath, 'w') as fp:
+            fp.write(json_dumps(self.offsets, pretty=False))
+        # the offsets are replaced last, a shard is only read through its offsets
+        os.replace(self.tmp_fpath, self.fpath)
+        os.replace(tmp_offsets_fpath, self.offsets_fpath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_writer(folder, binname, sharded=False, index=True):
+    # index: write the index of the binary in the per-file layout (the shard offsets are always written)
+    if sharded:
+        return ShardWriter(folder, binname)
+    return FileWriter(folder, binname, index=index)
+
+
+class ShardReader:
+    def __init__(self, folder, binname):
+        self.binname = binname
+        self.fpath = shard_path(folder, binname)
+        self.offsets: Dict[str, List[int]] = read_json(offsets_path(folder, binname))
+
+    def names(self) -> List[str]:
+        return list(self.offsets)
+
+    def __contains__(self, fname):
+        return fname in self.offsets
+
+    def read(self, fname):
+        offset, length = self.offsets[fname]
+        with open(self.fpath, 'rb') as fp:
+            fp.seek(offset)
+            return json_loads(fp.read(length))['data']
+
+    def items(self) -> Iterator[Tuple[str, object]]:
+        # all records in the order of the shard, read sequentially
+        with open(self.fpath, 'rb') as fp:
+            for offset, length in sorted(self.offsets.values()):
+                fp.seek(offset)
+                record = json_loads(fp.read(length))
+                yield record['name'], record['data']
+
+
+class FolderReader:
+    # the files of a folder in either layout, a binary with a shard is read from it, the other ones from their files
+    def __init__(self, folder):
+        self.folder = folder
+        self.shard = None   # the ShardReader of the last binary read from a shard
+
+    def _shard(self, binname):
+        if self.shard is None or self.shard.binname != binname:
+            if not has_shard(self.folder, binname):
+                return None
+            self.shard = ShardReader(self.folder, binname)
+        return self.shard
+
+    def sharded(self, binname) -> bool:
+        return self._shard(binname) is not None
+
+    def files(self, binname=None) -> List[str]:
+        # same as get_bin_file_list, the records of the shards are listed as files
+        if binname is not None:
+            shard = self._shard(binname)
+            return shard.names() if shard is not None else get_bin_file_list(self.folder, binname)
+        files = []
+        for shard_binname in shard_binnames(self.folder):
+            files += self._shard(shard_binname).names()
+        return files + get_file_list(self.folder)
+
+    def exists(self, fname) -> bool:
+        shard = self._shard(fname.split('-')[0])
+        if shard is not None:
+            return fname in shard
+        return os.path.exists(os.path.join(self.folder, fname))
+
+    def read(self, fname):
+        # the JSON data of a .json file, the text of the other files
+        shard = self._shard(fname.split('-')[0])
+        if shard is not None:
+            return shard.read(fname)
+        fpath = os.path.join(self.folder, fname)
+        if fname.endswith('.json'):
+            return read_json(fpath)
+        return read_file(fpath, readlines=False)
+
+
+def export_shards(folder, binname=None, remove=False, index=True):
+    # write the records of the shards of folder (only the one of binname if given) as files, remove the shards if remove is set
+    binnames = [binname] if binname is not None else shard_binnames(folder)
+    for shard_binname in tqdm(binnames, disable=len(binnames)==1):
+        with FileWriter(folder, shard_binname, index=index) as writer:
+            for fname, data in ShardReader(folder, shard_binname).items():
+                writer.write(fname, data)
+        if remove:
+            os.remove(shard_path(folder, shard_binname))
+            os.remove(offsets_path(folder, shard_binname))
+    if remove and not shard_binnames(folder) and not os.listdir(os.path.join(folder, SHARD_DIR)):
+        os.rmdir(os.path.join(folder, SHARD_DIR))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='export the shards of a folder to one file per record')
+    parser.add_argument('folder', help='e.g. .../train_var')
+    parser.add_argument('--bin', required=False, default=None, help='only export the shard of this binary')
+    parser.add_argument('--remove', required=False, default=False, action='store_true', help='remove the shards once exported')
+    parser.add_argument('--no_index', required=False, default=False, action='store_true', help='do not write the index of the binaries (see write_bin_index)')
+    args = parser.parse_args()
+
+    export_shards(args.folder, args.bin, remove=args.remove, index=not args.no_index)
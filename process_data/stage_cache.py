@@ -0,0 +1,153 @@
+import argparse
+import os
+import io
+import gzip
+import time
+import pickle
+import hashlib
+import contextlib
+from typing import List
+
+# Cache of the pipeline stage outputs, keyed by the content of their inputs.
+# An entry is <cache_dir>/<stage>/<key[:2]>/<key>.pkl.gz and holds the result of the stage and what it printed.
+# Entries are touched on every hit, so evicting the oldest ones first drops the least recently used.
+
+HASH_CHUNK = 1 << 20
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+ENTRY_SUFFIX = '.pkl.gz'
+
+
+def file_hash(fpath) -> str:
+    h = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_hash(fnames: List[str]) -> str:
+    # hash of the source files (in this folder) of a stage, so that editing them invalidates its entries
+    h = hashlib.sha256()
+    for fname in fnames:
+        h.update(fname.encode())
+        h.update(file_hash(os.path.join(SRC_DIR, fname)).encode())
+    return h.hexdigest()
+
+
+class StageCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hit = 0
+        self.miss = 0
+
+    def key(self, stage, version, *inputs) -> str:
+        # inputs: hashes of the input files, keys of the upstream stages and the options of the stage
+        h = hashlib.sha256()
+        for item in (stage, version) + inputs:
+            h.update(repr(item).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, stage, key):
+        # return (result, output), None if not cached
+        fpath = self._path(stage, key)
+        try:
+            with gzip.open(fpath, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(fpath)
+        return entry
+
+    def put(self, stage, key, result, output=''):
+        fpath = self._path(stage, key)
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        # write to a temporary file first, other workers may read the same entry
+        tmp_fpath = f'{fpath}.{os.getpid()}.tmp'
+        with gzip.open(tmp_fpath, 'wb', compresslevel=1) as f:
+            pickle.dump((result, output), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fpath, fpath)
+
+    def run(self, stage, key, compute):
+        # return the cached result of the stage, or compute and cache it
+        # the output printed by compute is cached as well and printed again on a hit
+        entry = self.get(stage, key)
+        if entry is not None:
+            self.hit += 1
+            result, output = entry
+            print(output, end='')
+            return result
+
+        self.miss += 1
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            result = compute()
+        output = buf.getvalue()
+        # the result is pickled before the later stages modify it
+        self.put(stage, key, result, output)
+        print(output, end='')
+        return result
+
+
+def run_cached(cache: StageCache, stage, key, compute):
+    if cache is None:
+        return compute()
+    return cache.run(stage, key, compute)
+
+
+def list_entries(cache_dir) -> List:
+    # return [(mtime, size, fpath)] of all entries
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fpath))
+    return entries
+
+
+def evict(cache_dir, max_age_days=None, max_size_gb=None) -> (int, int):
+    # remove the entries not used for max_age_days, then the least recently used ones until the cache fits into max_size_gb
+    # return the number of removed entries and the size of the remaining ones
+    entries = sorted(list_entries(cache_dir))
+    removed = 0
+    now = time.time()
+    keep = []
+    for mtime, size, fpath in entries:
+        # also clean up the temporary files of killed workers
+        expired = max_age_days is not None and now - mtime > max_age_days * 24 * 3600
+        stale_tmp = fpath.endswith('.tmp') and now - mtime > 24 * 3600
+        if expired or stale_tmp:
+            os.remove(fpath)
+            removed += 1
+        else:
+            keep.append((mtime, size, fpath))
+
+    total_size = sum(size for _, size, _ in keep)
+    if max_size_gb is not None:
+        max_size = max_size_gb * 1024 ** 3
+        for mtime, size, fpath in keep:
+            if total_size <= max_size:
+                break
+            os.remove(fpath)
+            removed += 1
+            total_size -= size
+    return removed, total_size
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cache_dir')
+    parser.add_argument('--max_age_days', required=False, default=None, type=float, help='remove the entries not used for this many days')
+    parser.add_argument('--max_size_gb', required=False, default=None, type=float, help='remove the least recently used entries until the cache fits')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.cache_dir):
+        removed, total_size = evict(args.cache_dir, max_age_days=args.max_age_days, max_size_gb=args.max_size_gb)
+        print(f'Removed {removed} cache entries, {total_size / 1024 ** 3:.2f}GB left in {args.cache_dir}')
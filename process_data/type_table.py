@@ -0,0 +1,103 @@
+import os
+from utils import *
+from typing import Dict
+from error import FileAlignException
+
+TYPE_TABLE_DIR = 'types'   # subfolder of the subprogram folder, one type table (type_id -> type_attr) per binary
+
+
+def type_table_path(subprogram_dir, binname) -> str:
+    return os.path.join(subprogram_dir, TYPE_TABLE_DIR, binname + '.json')
+
+
+def compact_attr(attr: Dict) -> Dict:
+    # drop the inlined type_attr of a DIE attribute that can be resolved from the type table
+    if 'type_id' in attr and 'type_attr' in attr:
+        attr = {k: v for k, v in attr.items() if k != 'type_attr'}
+    return attr
+
+
+def compact_align_data(align_data: Dict) -> Dict:
+    # copy of align_data whose aligned variables refer to their types by type_id only
+    ret = dict(align_data)
+    for key in ['argument', 'variable']:
+        if key not in align_data:
+            continue
+        ret[key] = []
+        for var in align_data[key]:
+            if 'aligned' in var and 'Attr' in var['aligned']:
+                var = dict(var)
+                var['aligned'] = dict(var['aligned'])
+                var['aligned']['Attr'] = compact_attr(var['aligned']['Attr'])
+            ret[key].append(var)
+    return ret
+
+
+class TypeTable():
+    # Shared loader of the type tables written by `parse_dwarf.py --type_table`.
+    # Resolves the `type_id` of DIE attributes back to the `type_attr` that parse_dwarf used to inline.
+    # Data in the old layout (with inlined `type_attr`) is left untouched.
+    def __init__(self, subprogram_dir):
+        self.subprogram_dir = subprogram_dir
+        self.tables = {}   # binname -> {type_id -> table entry}
+        self.resolved = {}   # (binname, type_id, skip_recursive) -> type_attr
+
+    def load(self, binname) -> Dict:
+        if binname not in self.tables:
+            fpath = type_table_path(self.subprogram_dir, binname)
+            self.tables[binname] = read_json(fpath) if os.path.exists(fpath) else {}
+        return self.tables[binname]
+
+    def get(self, binname, type_id, skip_recursive=False) -> Dict:
+        # same as DieDecription.attr_dict(skip_recursive) of the type. The returned dict is shared, do not modify it
+        key = (binname, type_id, skip_recursive)
+        if key in self.resolved:
+            return self.resolved[key]
+
+        table = self.load(binname)
+        if not table and self.subprogram_dir is not None:
+            raise FileAlignException(f"Type {type_id}: no type table for {binname} at {type_table_path(self.subprogram_dir, binname)}")
+        if type_id not in table:
+            raise FileAlignException(f"Type {type_id} not found in the type table of {binname}")
+        type_attr = dict(table[type_id])
+        if skip_recursive:
+            type_attr['struct_fields'] = []
+            type_attr['point_to_struct_fileds'] = []
+        else:
+            # fields of the struct are resolved recursively, fields of the pointee struct are not
+            type_attr['struct_fields'] = [self._resolve_field(binname, d, False) for d in type_attr['struct_fields']]
+            type_attr['point_to_struct_fileds'] = [self._resolve_field(binname, d, True) for d in type_attr['point_to_struct_fileds']]
+        self.resolved[key] = type_attr
+        return type_attr
+
+    def _resolve_field(self, binname, field: Dict, skip_recursive) -> Dict:
+        field = dict(field)
+        if isinstance(field['field_attr'], str):
+            field['field_attr'] = self.get(binname, field['field_attr'], skip_recursive)
+        elif skip_recursive:
+            # inlined type
+            field['field_attr'] = dict(field['field_attr'], struct_fields=[], point_to_struct_fileds=[])
+        return field
+
+    def resolve_attr(self, binname, attr: Dict) -> Dict:
+        # modify attr in place
+        if 'type_id' in attr and 'type_attr' not in attr:
+            key = (binname, attr['type_id'], 'attr')
+            if key not in self.resolved:
+                self.resolved[key] = dict(self.get(binname, attr['type_id']), istype=True)
+            attr['type_attr'] = self.resolved[key]
+        return attr
+
+    def resolve_subprogram(self, binname, subprogram: Dict) -> Dict:
+        # resolve all DIEs of a subprogram tree (debuginfo_subprograms) in place
+        self.resolve_attr(binname, subprogram['Attr'])
+        for child in subprogram['child']:
+            self.resolve_subprogram(binname, child)
+        return subprogram
+
+    def resolve_align_data(self, binname, align_data: Dict) -> Dict:
+        # resolve the aligned variables of align data (align_stack output) in place
+        for var in align_data['argument'] + align_data['variable']:
+            if 'aligned' in var and 'Attr' in var['aligned']:
+                self.resolve_attr(binname, var['aligned']['Attr'])
+        return align_data
@@ -1,8 +1,19 @@
 import os
+import re
 import json
 import glob
+import time
 from typing import List, Dict
 
+# JSON backend of read_json/dump_json: orjson when it is installed, the json module otherwise.
+# The files are written compactly, RESYM_PRETTY_JSON=1 writes them with indent=4 for debugging.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+PRETTY_JSON = os.environ.get('RESYM_PRETTY_JSON', '0') not in ('', '0')
+
 
 def init_folder(path, create=True, clean=True, verbose=True):
     if not os.path.exists(path) and create:
@@ -39,6 +50,30 @@ def get_file_list(folder):
     return files
 
 
+# per-binary index of a folder: <folder>/index/<binname> lists the files (<binname>-*) of the binary, one per line,
+# so that --bin does not need to list a folder shared by all binaries
+INDEX_DIR = 'index'
+
+def bin_index_path(folder, binname):
+    return os.path.join(folder, INDEX_DIR, binname)
+
+def write_bin_index(folder, binname, fnames: List[str]):
+    fpath = bin_index_path(folder, binname)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    tmp_fpath = f'{fpath}.{os.getpid()}.tmp'
+    write_file(tmp_fpath, ''.join(f + '\n' for f in fnames))
+    os.replace(tmp_fpath, fpath)
+
+def get_bin_file_list(folder, binname=None) -> List[str]:
+    # the files of binname in folder (all files if binname is None), from the index when there is one
+    if binname is None:
+        return get_file_list(folder)
+    fpath = bin_index_path(folder, binname)
+    if os.path.exists(fpath):
+        return [f for f in read_file(fpath, readlines=False).split('\n') if f]
+    return [f for f in get_file_list(folder) if f.startswith(binname + '-')]
+
+
 def read_file(path, readlines=True) -> str:
     with open(path, "r") as f:
         if readlines:
@@ -53,11 +88,149 @@ def write_file(path, content):
         f.write(content)
 
         
+JSON_CHUNK_SIZE = 1 << 20   # characters read at a time by iter_json_records
+
+
+# orjson reads the integers beyond 64 bits as floats, without an error, and json_dumps writes them with json:
+# a text with a run of 19 digits (which may be such an integer) is read with json
+_LONG_DIGITS = re.compile(r'\d{19}')
+_LONG_DIGITS_BYTES = re.compile(rb'\d{19}')
+
+
+def json_loads(s):
+    # s: str or bytes
+    if orjson is not None:
+        pattern = _LONG_DIGITS_BYTES if isinstance(s, (bytes, bytearray)) else _LONG_DIGITS
+        if pattern.search(s) is None:
+            return orjson.loads(s)
+    return json.loads(s)
+
+
+def json_dumps(data, pretty=None) -> str:
+    # pretty: indent=4, PRETTY_JSON by default
+    if pretty is None:
+        pretty = PRETTY_JSON
+    if pretty:
+        return json.dumps(data, indent=4)
+    if orjson is not None:
+        try:
+            # non-string keys are converted like json does (e.g. 1 -> "1")
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            # e.g. integers beyond 64 bits
+            pass
+    return json.dumps(data, separators=(',', ':'))
+
+
 def read_json(path):
-    with open(path, 'r') as f:
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return json_loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
         data = json.load(f)
     return data
 
-def dump_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=4)
+
+def iter_json_records(path, chunk_size=JSON_CHUNK_SIZE):
+    # yield the elements of a JSON array file one at a time, without loading the whole file,
+    # or the records of a JSONL file (one JSON value per line) if the file does not start with '['
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buf = ''
+        eof = False
+        while not buf and not eof:
+            more = f.read(chunk_size)
+            eof = not more
+            buf = more.lstrip()
+        if not buf.startswith('['):
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        buf = buf[1:]
+        expect_value = True   # after '[' or ','
+        first = True
+        while True:
+            buf = buf.lstrip()
+            if not buf:
+                if eof:
+                    raise json.JSONDecodeError('Unterminated array', buf, 0)
+                more = f.read(chunk_size)
+                eof = not more
+                buf += more
+                continue
+            if not expect_value:
+                if buf[0] == ']':
+                    return
+                if buf[0] != ',':
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buf, 0)
+                buf = buf[1:]
+                expect_value = True
+                continue
+            if first and buf[0] == ']':
+                return
+            try:
+                value, end = decoder.raw_decode(buf)
+                # a number may go on after the end of the buffer (e.g. 1 of 1e5), a value is complete once followed by a delimiter
+                complete = eof or (end < len(buf) and buf[end] in ' \t\n\r,]')
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # the value is cut by the end of the buffer, read as much again
+                more = f.read(max(chunk_size, len(buf)))
+                eof = not more
+                buf += more
+                continue
+            yield value
+            buf = buf[end:]
+            expect_value = False
+            first = False
+
+
+def dump_json(path, data, pretty=None):
+    # orjson does not escape non-ASCII characters
+    with open(path, "w", encoding='utf-8') as f:
+        f.write(json_dumps(data, pretty=pretty))
+
+
+def benchmark_json(folder, max_files=1000, repeat=3):
+    # time reading and writing the .json files of folder (e.g. .../debuginfo_subprograms) with the json module and with the backend
+    fpaths = [os.path.join(folder, f) for f in sorted(get_file_list(folder)) if f.endswith('.json')][:max_files]
+    texts = [read_file(fpath, readlines=False) for fpath in fpaths]
+    datas = [json.loads(text) for text in texts]
+    print(f'{len(fpaths)} files, {sum(len(text) for text in texts) / 1e6:.1f}MB, backend: {"orjson" if orjson is not None else "json"}')
+
+    def _time(fn):
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    results = [
+        ('json.loads', _time(lambda: [json.loads(text) for text in texts])),
+        ('json_loads', _time(lambda: [json_loads(text) for text in texts])),
+        ('json.dumps indent=4', _time(lambda: [json.dumps(data, indent=4) for data in datas])),
+        ('json_dumps', _time(lambda: [json_dumps(data, pretty=False) for data in datas])),
+    ]
+    for name, elapsed in results:
+        print(f'{name:20s} {elapsed:.4f}s, {len(fpaths) / elapsed:.0f} files/s')
+    pretty_size = sum(len(json.dumps(data, indent=4)) for data in datas)
+    compact_size = sum(len(json_dumps(data, pretty=False)) for data in datas)
+    print(f'output size: {pretty_size / 1e6:.1f}MB with indent=4, {compact_size / 1e6:.1f}MB compact')
+
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='benchmark the JSON backend')
+    parser.add_argument('folder', help='a folder of .json files, e.g. .../debuginfo_subprograms')
+    parser.add_argument('--max_files', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    benchmark_json(args.folder, max_files=args.max_files, repeat=args.repeat)
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import torch
+from collections import Counter
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from typing import Callable, Dict, Iterator, List
+
+# Inference helpers shared by vardecoder_inf.py and fielddecoder_inf.py.
+# Batched generation: prompts are read a window at a time, sorted by length and grouped into batches, so that a batch pads little.
+# The prompts are padded on the left, and the results are returned in the order of the input file.
+# Resumable output: the predictions are appended and flushed one by one, and the records already in the output are skipped on restart.
+
+MAX_LEN = 8192
+MAX_NEW_TOKENS = 1024
+BUCKET_WINDOW = 64   # number of batches read ahead and sorted by prompt length
+
+
+def read_jsonl(fpath) -> Iterator[Dict]:
+    with open(fpath, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def record_key(line):
+    return line.get('bin'), line.get('fun_id')
+
+
+def open_output(out_fpath, overwrite=False):
+    # return the output file opened for appending, and the number of predictions already in it per record key
+    # a partially written last line (from an interrupted run) is removed
+    done = Counter()
+    if overwrite or not os.path.exists(out_fpath):
+        return open(out_fpath, 'w'), done
+
+    valid_size = 0
+    with open(out_fpath, 'rb') as fp:
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                done[record_key(json.loads(line))] += 1
+            except ValueError:
+                break
+            valid_size += len(line)
+    if valid_size < os.path.getsize(out_fpath):
+        os.truncate(out_fpath, valid_size)
+    return open(out_fpath, 'a'), done
+
+
+def skip_done(lines: Iterator[Dict], done: Counter) -> Iterator[Dict]:
+    # skip the records already predicted, as many times as they are in the output
+    done = done.copy()
+    for line in lines:
+        key = record_key(line)
+        if done[key] > 0:
+            done[key] -= 1
+            continue
+        yield line
+
+
+class Throughput:
+    # number of predictions and generated tokens per second, printed every report_every predictions
+    def __init__(self, report_every=100):
+        self.report_every = report_every
+        self.start_time = time.time()
+        self.records = 0
+        self.tokens = 0
+
+    def update(self, num_tokens):
+        self.records += 1
+        self.tokens += num_tokens
+        if self.records % self.report_every == 0:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print(f'{self.records} predictions, {self.tokens} tokens in {elapsed:.1f}s: {self.records / elapsed:.2f} predictions/s, {self.tokens / elapsed:.1f} tokens/s', flush=True)
+
+
+def load_model(model_path, hf_key, device='cuda', tokenizer_path='bigcode/starcoderbase-3b'):
+    # device: 'cuda' loads the model in bf16 across the available GPUs, 'cpu' in fp32
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path, use_auth_token=hf_key)
+    tokenizer.padding_side = 'left'
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if device == 'cpu':
+        model = AutoModelForCausalLM.from_pretrained(model_path, use_auth_token=hf_key, torch_dtype=torch.float32)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path, use_auth_token=hf_key,
+            torch_dtype=torch.bfloat16, device_map='auto'
+        )
+    model.eval()
+    return tokenizer, model
+
+
+def length_batches(lengths: List[int], batch_size, max_batch_tokens=None) -> List[List[int]]:
+    # group the indices of the prompts into batches of similar length, longest first
+    # a batch has at most batch_size prompts, and at most max_batch_tokens tokens once padded
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        # the first prompt of a batch is the longest one
+        too_many_tokens = max_batch_tokens is not None and batch and (len(batch) + 1) * lengths[batch[0]] > max_batch_tokens
+        if len(batch) == batch_size or too_many_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pad_left(batch_ids: List[List[int]], pad_token_id) -> (torch.Tensor, torch.Tensor):
+    # input_ids and attention_mask of the prompts padded on the left
+    max_len = max(len(ids) for ids in batch_ids)
+    input_ids = torch.full((len(batch_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+    for i, ids in enumerate(batch_ids):
+        input_ids[i, max_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, max_len - len(ids):] = 1
+    return input_ids, attention_mask
+
+
+def generate_batch(model, tokenizer, batch_ids: List[List[int]], device, num_return_sequences=1, **generate_kwargs) -> (List[List[str]], List[int]):
+    # return the num_return_sequences generated texts of each prompt, best first,
+    # and the number of tokens generated for the best sequence of each prompt
+    input_ids, attention_mask = pad_left(batch_ids, tokenizer.pad_token_id)
+    max_len = input_ids.size(1)
+
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids.to(device), attention_mask=attention_mask.to(device),
+            num_return_sequences=num_return_sequences, **generate_kwargs
+        )
+    new_tokens = output[:, max_len:]
+    texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+    # finished sequences are padded with pad_token_id
+    num_tokens = (new_tokens[::num_return_sequences] != generate_kwargs.get('pad_token_id', tokenizer.pad_token_id)).sum(dim=1).tolist()
+    return [texts[i * num_return_sequences: (i + 1) * num_return_sequences] for i in range(len(batch_ids))], num_tokens
+
+
+def batch_generate(lines: Iterator[Dict], build_prompt: Callable[[Dict], str], tokenizer, model, device='cuda',
+                   batch_size=8, max_batch_tokens=None, num_return_sequences=1, build_logits_processor=None, **generate_kwargs) -> Iterator:
+    # yield (line, generated texts, time, number of generated tokens) for every line, in the input order
+    # time is the time of the batch divided by its number of prompts
+    # build_logits_processor: returns the logits_processor of generate for the lines of a batch (e.g. grammar.grammar_processor)
+    max_prompt_len = MAX_LEN - generate_kwargs.get('max_new_tokens', MAX_NEW_TOKENS)
+    window = []
+    for line in lines:
+        window.append(line)
+        if len(window) == batch_size * BUCKET_WINDOW:
+            yield from _generate_window(window, build_prompt, tokenizer, model, device, batch_size, max_batch_tokens, max_prompt_len, num_return_sequences, build_logits_processor, generate_kwargs)
+            window = []
+    if window:
+        yield from _generate_window(window, build_prompt, tokenizer, model, device, batch_size, max_batch_tokens, max_prompt_len, num_return_sequences, build_logits_processor, generate_kwargs)
+
+
+def _generate_window(window, build_prompt, tokenizer, model, device, batch_size, max_batch_tokens, max_prompt_len, num_return_sequences, build_logits_processor, generate_kwargs):
+    # same truncation as the single prompt inference
+    prompt_ids = [tokenizer.encode(build_prompt(line))[:max_prompt_len] for line in window]
+    results = [None] * len(window)
+    for batch in length_batches([len(ids) for ids in prompt_ids], batch_size, max_batch_tokens):
+        start_time = time.time()
+        batch_kwargs = generate_kwargs
+        if build_logits_processor is not None:
+            batch_kwargs = dict(generate_kwargs, logits_processor=build_logits_processor([window[i] for i in batch]))
+        texts, num_tokens = generate_batch(model, tokenizer, [prompt_ids[i] for i in batch], device, num_return_sequences=num_return_sequences, **batch_kwargs)
+        time_used = (time.time() - start_time) / len(batch)
+        for i, text, n in zip(batch, texts, num_tokens):
+            results[i] = (window[i], text, time_used, n)
+    yield from results
@@ -0,0 +1,122 @@
+import torch
+import transformers
+from packaging import version
+from transformers import Trainer
+from transformers.trainer_pt_utils import LengthGroupedSampler
+from typing import Dict, List
+
+# Batching without padding every sample to max_len, for the datasets of dataset.py created with pad=False:
+# DynamicPaddingCollator pads a batch to its longest sample, LengthGroupedTrainer batches samples of similar length together,
+# PackedDataset concatenates short samples into sequences of at most max_len tokens, which PackedCollator batches with
+# a block-diagonal causal attention mask so that the samples of a sequence stay independent,
+# StreamingTrainer loads the batches of a StreamingDataset.
+
+PAD_TO_MULTIPLE_OF = 8
+# the first transformers version whose GPTBigCode model takes a (batch, 1, len, len) attention mask as it is,
+# the earlier ones flatten the mask to (batch, 1, len) and fail on it
+PACKED_MIN_TRANSFORMERS = '4.54.0'
+
+
+def packing_supported() -> bool:
+    return version.parse(transformers.__version__) >= version.parse(PACKED_MIN_TRANSFORMERS)
+
+
+class DynamicPaddingCollator:
+    # pad the samples of a batch (on the right) to the longest one, rounded up to pad_to_multiple_of
+    PAD_VALUES = {'input_ids': None, 'labels': -100, 'attention_mask': 0, 'position_ids': 0}
+
+    def __init__(self, pad_token_id, pad_to_multiple_of=PAD_TO_MULTIPLE_OF):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        max_len = max(len(feature['input_ids']) for feature in features)
+        if self.pad_to_multiple_of:
+            max_len = (max_len + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+        batch = {}
+        for key, pad_value in self.PAD_VALUES.items():
+            if key not in features[0]:
+                continue
+            if pad_value is None:
+                pad_value = self.pad_token_id
+            batch[key] = torch.stack([
+                torch.cat([feature[key], torch.full((max_len - len(feature[key]),), pad_value, dtype=feature[key].dtype)])
+                for feature in features
+            ])
+        return batch
+
+
+class LengthGroupedTrainer(Trainer):
+    # the training samples are shuffled in groups of similar length (see LengthGroupedSampler), using the lengths of the dataset
+    def _get_train_sampler(self, *args, **kwargs):
+        lengths = getattr(self.train_dataset, 'lengths', None)
+        if lengths is None:
+            return super()._get_train_sampler(*args, **kwargs)
+        return LengthGroupedSampler(
+            self.args.train_batch_size * self.args.gradient_accumulation_steps,
+            lengths=[int(length) for length in lengths],
+        )
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    # sequences of consecutive samples of dataset (created with pad=False), each of at most max_len tokens
+    # the labels of the prompt of every sample stay masked, and the positions start over at every sample,
+    # batched with PackedCollator, which keeps the samples of a sequence from attending to each other
+    def __init__(self, dataset, max_len=2048):
+        self.dataset = dataset
+        self.packs: List[List[int]] = []
+        self.lengths: List[int] = []   # number of tokens of every sequence
+        for index, length in enumerate(dataset.lengths):
+            length = int(length)
+            if not self.packs or self.lengths[-1] + length > max_len:
+                self.packs.append([])
+                self.lengths.append(0)
+            self.packs[-1].append(index)
+            self.lengths[-1] += length
+        if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+            print(f'{len(dataset)} samples packed into {len(self.packs)} sequences of at most {max_len} tokens')
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, index):
+        samples = [self.dataset[i] for i in self.packs[index]]
+        return {
+            'input_ids': torch.cat([sample['input_ids'] for sample in samples]),
+            'labels': torch.cat([sample['labels'] for sample in samples]),
+            'attention_mask': torch.cat([sample['attention_mask'] for sample in samples]),
+            'position_ids': torch.cat([torch.arange(len(sample['input_ids'])) for sample in samples]),
+        }
+
+
+class PackedCollator(DynamicPaddingCollator):
+    # pad the sequences of a PackedDataset, and replace their attention mask by a block-diagonal causal one (batch, 1, len, len):
+    # a token only attends to the previous tokens of its own sample (see packing_supported).
+    # The mask is additive (0 where a token attends, the minimum of dtype elsewhere), the form both the eager and the sdpa attention take
+    def __init__(self, pad_token_id, pad_to_multiple_of=PAD_TO_MULTIPLE_OF, dtype=torch.float32):
+        super().__init__(pad_token_id, pad_to_multiple_of)
+        self.dtype = dtype
+
+    def __call__(self, features: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+        batch = super().__call__(features)
+        # a sample starts where the positions start over, every padding token (position 0) is a sample of its own
+        samples = torch.cumsum(batch['position_ids'] == 0, dim=1)
+        seq_len = samples.size(1)
+        causal = torch.tril(torch.ones((seq_len, seq_len), dtype=torch.bool))
+        attend = ((samples[:, :, None] == samples[:, None, :]) & causal).unsqueeze(1)
+        batch['attention_mask'] = torch.zeros(attend.shape, dtype=self.dtype).masked_fill(~attend, torch.finfo(self.dtype).min)
+        return batch
+
+
+class StreamingTrainer(Trainer):
+    # for a StreamingDataset, which splits the samples between the ranks and the workers itself:
+    # its dataloader is neither sharded nor dispatched from the first rank by accelerate
+    def get_train_dataloader(self):
+        return torch.utils.data.DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            drop_last=self.args.dataloader_drop_last,
+        )
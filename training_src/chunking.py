@@ -0,0 +1,210 @@
+import re
+import json
+import argparse
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+from grammar import vardecoder_keys, fielddecoder_keys
+
+# Chunking of the functions whose prompt does not fit in the context: instead of truncating the prompt (and the variables used at the end),
+# the body of the function is split into overlapping windows of lines, each window is asked about the variables (expressions) it uses,
+# with the signature of the function and the declarations of these variables, and the answers of the windows are merged per variable.
+# The windows are only as long as the context, so the cost of a function grows linearly with its length.
+
+VAR_QUESTION = 'In the following decompiled C program, what are the original variable name and data type of variables '
+FIELD_QUESTION = 'What are the variable name and type for the following memory accesses: '
+CHUNK_OVERLAP = 0.25   # fraction of the lines of a window that are also in the next one
+KEY_TOKENS = 16   # room for the first key of the answer after the input
+
+
+def build_input(keys: List[str], code, field=False):
+    # same prompts as align_stack.gen_vardecoder_data and gen_train_field.gen_prompt
+    if field:
+        return FIELD_QUESTION + ', '.join(keys) + '?\n' + f'```\n{code.strip()}\n```'
+    return VAR_QUESTION + ', '.join([f'`{key}`' for key in keys]) + '?\n' + f'```\n{code.strip()}\n```'
+
+
+def split_input(prompt) -> Tuple[str, str]:
+    # (question, code) of a prompt
+    question, _, code = prompt.partition('\n')
+    code = code.strip()
+    if code.startswith('```'):
+        code = code[3:]
+    if code.endswith('```'):
+        code = code[: -3]
+    return question, code.strip('\n')
+
+
+def key_pattern(key):
+    # a variable as a word, an expression as it is
+    if re.fullmatch(r'\w+', key):
+        return re.compile(r'\b' + re.escape(key) + r'\b')
+    return re.compile(re.escape(key))
+
+
+def function_parts(code) -> Tuple[List[str], List[str], List[str], List[str]]:
+    # (head, declarations, body, tail) lines of a decompiled function:
+    # the head ends with the opening brace, the declarations go up to the first empty line, the tail is the closing brace
+    lines = code.split('\n')
+    open_line = next((i for i, line in enumerate(lines) if '{' in line), None)
+    if open_line is None:
+        return [], [], lines, []
+    head, lines = lines[: open_line + 1], lines[open_line + 1:]
+    tail = []
+    if lines and lines[-1].strip() == '}':
+        lines, tail = lines[: -1], lines[-1:]
+    blank = next((i for i, line in enumerate(lines) if not line.strip()), None)
+    if blank is None:
+        return head, [], lines, tail
+    return head, lines[: blank], lines[blank + 1:], tail
+
+
+def chunk_input(prompt, tokenizer, max_prompt_len, field=False, overlap=CHUNK_OVERLAP) -> Tuple[List[Tuple[str, List[str]]], bool]:
+    # ([(input, keys)] of the windows of a prompt, True), or ([(prompt, keys)], False) if it fits in max_prompt_len tokens (or can't be split),
+    # an over-long prompt may have a single window if the keys are only used in one part of the body
+    keys = fielddecoder_keys(prompt) if field else vardecoder_keys(prompt)
+    if not keys or len(tokenizer.encode(prompt)) + KEY_TOKENS <= max_prompt_len:
+        return [(prompt, keys)], False
+
+    _, code = split_input(prompt)
+    head, decls, body, tail = function_parts(code)
+    if not body:
+        return [(prompt, keys)], False
+    line_tokens = [len(tokenizer.encode(line)) + 1 for line in body]
+    # the room left for the body once the question, the head, all the declarations and the tail are in the prompt
+    fixed = len(tokenizer.encode(build_input(keys, '\n'.join(head + decls + [''] + tail), field=field))) + KEY_TOKENS
+    budget = max(max_prompt_len - fixed, max_prompt_len // 4)
+
+    spans = []
+    start = 0
+    while True:
+        end, tokens = start, 0
+        while end < len(body) and (end == start or tokens + line_tokens[end] <= budget):
+            tokens += line_tokens[end]
+            end += 1
+        spans.append((start, end))
+        if end == len(body):
+            break
+        start = max(start + 1, end - int((end - start) * overlap))
+
+    patterns = {key: key_pattern(key) for key in keys}
+    window_keys = []
+    for start, end in spans:
+        text = '\n'.join(body[start: end])
+        window_keys.append([key for key in keys if patterns[key].search(text)])
+    # the keys that are not used in the body (e.g. only in the signature) are asked with the first window
+    used = {key for w_keys in window_keys for key in w_keys}
+    window_keys[0] = [key for key in keys if key in window_keys[0] or key not in used]
+
+    windows = []
+    for (start, end), w_keys in zip(spans, window_keys):
+        if not w_keys:
+            continue
+        w_decls = [line for line in decls if any(patterns[key].search(line) for key in w_keys)]
+        code = '\n'.join(head + w_decls + ([''] if w_decls else []) + body[start: end] + tail)
+        windows.append((build_input(w_keys, code, field=field), w_keys))
+    return windows, True
+
+
+def parse_answer(text) -> Dict[str, str]:
+    # {key: answer} of the lines `key: answer` of a generated text
+    answers = {}
+    for line in text.strip().split('\n'):
+        key, sep, answer = line.partition(': ')
+        if sep and key not in answers:
+            answers[key] = answer
+    return answers
+
+
+def merge_answers(keys: List[str], texts: List[str]) -> str:
+    # the answer of a key is the most frequent one among the windows that answered it, the first one on ties
+    votes = {}
+    for text in texts:
+        for key, answer in parse_answer(text).items():
+            votes.setdefault(key, Counter())[answer] += 1
+    return '\n'.join(f'{key}: {votes[key].most_common(1)[0][0]}' for key in keys if key in votes)
+
+
+def expand_windows(lines: Iterator[Dict], tokenizer, max_prompt_len, field=False) -> Iterator[Dict]:
+    # the records whose prompt fits, and one record per window of the other ones,
+    # a window record has the input of the window, its first key as output, and the chunk it is part of (see WindowMerger)
+    for line in lines:
+        windows, split = chunk_input(line['input'], tokenizer, max_prompt_len, field=field)
+        if not split:
+            yield line
+            continue
+        keys = fielddecoder_keys(line['input']) if field else vardecoder_keys(line['input'])
+        for i, (window_input, w_keys) in enumerate(windows):
+            yield {
+                'input': window_input,
+                'output': w_keys[0] + ':',
+                'chunk': {'record': line, 'keys': keys, 'index': i, 'count': len(windows)},
+            }
+
+
+class WindowMerger:
+    # collect the predictions of the windows of a record (in order), and merge them once the last one is added
+    def __init__(self):
+        self.texts: List[List[str]] = []
+        self.time = 0
+        self.num_tokens = 0
+
+    def add(self, line, texts: List[str], time_used, num_tokens) -> Optional[Tuple[Dict, List[str], float, int]]:
+        # texts: the predictions of line (the best first), starting with the first key of the output
+        # return (record, merged texts, time, number of tokens) of the record of line, None until its last window is added
+        if 'chunk' not in line:
+            return line, texts, time_used, num_tokens
+        chunk = line['chunk']
+        self.texts.append(texts)
+        self.time += time_used
+        self.num_tokens += num_tokens
+        if chunk['index'] < chunk['count'] - 1:
+            return None
+        # the i-th prediction of the record merges the i-th predictions of the windows
+        merged = [merge_answers(chunk['keys'], [window_texts[i] for window_texts in self.texts]) for i in range(min(map(len, self.texts)))]
+        record = chunk['record']
+        record['chunks'] = chunk['count']
+        result = record, merged, self.time, self.num_tokens
+        self.__init__()
+        return result
+
+
+def chunk_training_file(in_fpath, out_fpath, tokenizer, max_len, field=False, overlap=CHUNK_OVERLAP):
+    # split the training samples longer than max_len tokens into the samples of their windows,
+    # the output of a window is the lines of the output for its keys
+    num_samples, num_chunked, num_out = 0, 0, 0
+    with open(in_fpath, 'r') as fp, open(out_fpath, 'w') as wp:
+        for line in fp:
+            if not line.strip():
+                continue
+            line = json.loads(line)
+            num_samples += 1
+            output_tokens = len(tokenizer.encode(line['output'] + tokenizer.eos_token))
+            max_prompt_len = max(max_len - output_tokens, max_len // 2) + KEY_TOKENS
+            windows, split = chunk_input(line['input'], tokenizer, max_prompt_len, field=field, overlap=overlap)
+            if not split:
+                wp.write(json.dumps(line) + '\n')
+                num_out += 1
+                continue
+            num_chunked += 1
+            answers = parse_answer(line['output'])
+            for window_input, w_keys in windows:
+                output = '\n'.join(f'{key}: {answers[key]}' for key in w_keys if key in answers)
+                if output:
+                    wp.write(json.dumps(dict(line, input=window_input, output=output)) + '\n')
+                    num_out += 1
+    print(f'{in_fpath}: {num_chunked}/{num_samples} samples split, {num_out} samples written to {out_fpath}')
+
+
+if __name__=='__main__':
+    import os
+    from transformers import AutoTokenizer
+    parser = argparse.ArgumentParser(description='split the long training samples into windows instead of truncating them')
+    parser.add_argument('in_fpath', help='the training data (JSONL, `input` and `output` of every sample)')
+    parser.add_argument('out_fpath')
+    parser.add_argument('--max_len', type=int, default=4096, help='max_len of the training Dataset')
+    parser.add_argument('--field', default=False, action='store_true', help='FieldDecoder samples')
+    parser.add_argument('--overlap', type=float, default=CHUNK_OVERLAP)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained('bigcode/starcoderbase-3b', use_auth_token=os.environ['HF_TOKEN'])
+    chunk_training_file(args.in_fpath, args.out_fpath, tokenizer, args.max_len, field=args.field, overlap=args.overlap)
@@ -1,45 +1,299 @@
+import argparse
+import itertools
 import json
+import os
 import torch
 import random
+import numpy as np
+from typing import List
  
 random.seed(1234)
  
+def encode_sample(line, tokenizer, max_len, truncat=True, pad=True):
+    # the tensors of a sample ({'input': ..., 'output': ...}), None if it is longer than max_len and truncat is not set
+    inputs = tokenizer.encode(line['input'])
+    outputs = tokenizer.encode(line['output'] + tokenizer.eos_token)  
+    all_input = inputs+outputs
+    cur_len = len(all_input)
+    if not truncat and cur_len > max_len:
+        return None
+    elif cur_len < max_len and pad:
+        input_id = inputs + outputs + [tokenizer.eos_token_id] * (max_len - cur_len) 
+        label = [-100] * len(inputs) + outputs + [-100] * (max_len - cur_len)
+        attention_mask = [1] * cur_len + [0] * (max_len - cur_len)   
+    else:
+        # truncat output
+        input_id = all_input[:max_len]
+        label = ([-100] * len(inputs) + outputs)[:max_len]
+        attention_mask = [1] * len(input_id)
+ 
+    return {
+        'input_ids': torch.LongTensor(input_id),
+        'labels': torch.LongTensor(label),
+        'attention_mask': torch.tensor(attention_mask)
+    }
+
+
 class Dataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, tokenizer, max_len=2048, shuffle=False, max_cnt=None, truncat=True):
+    def __init__(self, file_path, tokenizer, max_len=2048, shuffle=False, max_cnt=None, truncat=True, pad=True):
+        # pad: pad every sample to max_len, otherwise a sample is only as long as its tokens (see batching.py)
         self.data = []
         with open(file_path, 'r') as fp:
             for line in fp.readlines():
-                line = json.loads(line)
- 
-                inputs = tokenizer.encode(line['input'])
-                outputs = tokenizer.encode(line['output'] + tokenizer.eos_token)  
-                all_input = inputs+outputs
-                cur_len = len(all_input)
-                if not truncat and cur_len > max_len:
-                    continue
-                elif cur_len < max_len:
-                    input_id = inputs + outputs + [tokenizer.eos_token] * (max_len - cur_len) 
-                    label = [-100] * len(inputs) + outputs + [-100] * (max_len - cur_len)
-                    attention_mask = [1] * cur_len + [0] * (max_len - cur_len)   
-                else:
-                    # truncat output
-                    input_id = all_input[:max_len]
-                    label = ([-100] * len(inputs) + outputs)[:max_len]
-                    attention_mask = [1] * max_len
- 
-                self.data.append({
-                        'input_ids': torch.LongTensor(input_id),
-                        'labels': torch.LongTensor(label),
-                        'attention_mask': torch.tensor(attention_mask)
-                    })
+                sample = encode_sample(json.loads(line), tokenizer, max_len, truncat=truncat, pad=pad)
+                if sample is not None:
+                    self.data.append(sample)
         if max_cnt is not None:
             self.data = self.data[: max_cnt]
         if shuffle:
             random.shuffle(self.data)
+        # number of tokens of every sample (before padding)
+        self.lengths = [int(sample['attention_mask'].sum()) for sample in self.data]
         if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
             print(file_path, 'loaded:', len(self.data))
  
     def __len__(self):
         return len(self.data)
     def __getitem__(self, index):
-        return self.data[index]
\ No newline at end of file
+        return self.data[index]
+
+
+# Streaming dataset: the samples are read from the JSONL files (a file, or the *.jsonl shards of a directory) while training,
+# only shuffle_buffer samples are kept in memory. The samples are split between the DDP ranks and the dataloader workers
+# (whole files when there are enough files, every n-th line otherwise), and shuffled within a buffer.
+
+SHUFFLE_BUFFER = 10000   # samples
+SEED = 1234
+
+
+def jsonl_files(path) -> List[str]:
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.jsonl'))
+    return [path]
+
+
+def shard_info():
+    # (index, count) of the reader among all the dataloader workers of all the ranks
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        return rank, world_size
+    return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    # same samples as Dataset, tokenized while they are read
+    # max_cnt: at most max_cnt samples in total, split evenly between the readers
+    def __init__(self, path, tokenizer, max_len=2048, shuffle=False, max_cnt=None, truncat=True, pad=True,
+                 shuffle_buffer=SHUFFLE_BUFFER, seed=SEED):
+        self.files = jsonl_files(path)
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+        self.shuffle = shuffle
+        self.max_cnt = max_cnt
+        self.truncat = truncat
+        self.pad = pad
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+            print(path, 'streamed from', len(self.files), 'files')
+
+    def set_epoch(self, epoch):
+        # another shuffle for every epoch
+        self.epoch = epoch
+
+    def _lines(self, shard_id, num_shards):
+        # the lines of the reader, files are shuffled the same way by all the readers
+        files = list(self.files)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(files)
+        if len(files) >= num_shards:
+            for fpath in files[shard_id::num_shards]:
+                with open(fpath, 'r') as fp:
+                    for line in fp:
+                        yield line
+            return
+        line_no = 0
+        for fpath in files:
+            with open(fpath, 'r') as fp:
+                for line in fp:
+                    if line_no % num_shards == shard_id:
+                        yield line
+                    line_no += 1
+
+    def _samples(self, shard_id, num_shards):
+        for line in self._lines(shard_id, num_shards):
+            if not line.strip():
+                continue
+            sample = encode_sample(json.loads(line), self.tokenizer, self.max_len, truncat=self.truncat, pad=self.pad)
+            if sample is not None:
+                yield sample
+
+    def __iter__(self):
+        shard_id, num_shards = shard_info()
+        samples = self._samples(shard_id, num_shards)
+        if self.max_cnt is not None:
+            cnt = self.max_cnt // num_shards + (1 if shard_id < self.max_cnt % num_shards else 0)
+            samples = itertools.islice(samples, cnt)
+        if not self.shuffle:
+            yield from samples
+            return
+        rng = random.Random(f'{self.seed}-{self.epoch}-{shard_id}')
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            # a random sample of the buffer is replaced by the new one
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+# Pre-tokenized dataset: `python dataset.py <train.jsonl> <prefix>` tokenizes the samples once into flat arrays,
+# <prefix>.ids: the tokens (input + output + eos) of all samples one after the other, not truncated nor padded,
+# <prefix>.offsets.npy: the start of every sample in ids, and the end of the last one,
+# <prefix>.prompt_lens.npy: the number of input tokens of every sample (masked in the labels), <prefix>.meta.json.
+# TokenizedDataset memory-maps them: a sample is read when it is accessed,
+# and the pages are shared by all the processes (DDP ranks, dataloader workers) reading the same files.
+
+TOKENIZE_BATCH = 1000   # samples tokenized at a time
+
+
+def tokenized_paths(prefix):
+    return {
+        'ids': prefix + '.ids',
+        'offsets': prefix + '.offsets.npy',
+        'prompt_lens': prefix + '.prompt_lens.npy',
+        'meta': prefix + '.meta.json',
+    }
+
+
+def pretokenize(file_path, tokenizer, prefix, batch_size=TOKENIZE_BATCH):
+    # same tokens as Dataset, written to the files of prefix
+    paths = tokenized_paths(prefix)
+    ids_dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.int32
+    offsets = [0]
+    prompt_lens = []
+
+    def _write(lines, fp):
+        inputs = tokenizer([line['input'] for line in lines])['input_ids']
+        outputs = tokenizer([line['output'] + tokenizer.eos_token for line in lines])['input_ids']
+        for input_ids, output_ids in zip(inputs, outputs):
+            fp.write(np.asarray(input_ids + output_ids, dtype=ids_dtype).tobytes())
+            offsets.append(offsets[-1] + len(input_ids) + len(output_ids))
+            prompt_lens.append(len(input_ids))
+
+    with open(file_path, 'r') as fin, open(paths['ids'], 'wb') as fp:
+        lines = []
+        for line in fin:
+            if not line.strip():
+                continue
+            lines.append(json.loads(line))
+            if len(lines) == batch_size:
+                _write(lines, fp)
+                lines = []
+        if lines:
+            _write(lines, fp)
+
+    np.save(paths['offsets'], np.asarray(offsets, dtype=np.int64))
+    np.save(paths['prompt_lens'], np.asarray(prompt_lens, dtype=np.int32))
+    meta = {
+        'source': file_path,
+        'tokenizer': tokenizer.name_or_path,
+        'num_samples': len(prompt_lens),
+        'num_tokens': offsets[-1],
+        'dtype': np.dtype(ids_dtype).name,
+        'pad_token_id': tokenizer.eos_token_id,
+    }
+    with open(paths['meta'], 'w') as fp:
+        json.dump(meta, fp, indent=4)
+    print(file_path, 'tokenized:', meta['num_samples'], 'samples,', meta['num_tokens'], 'tokens')
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    # same samples as Dataset, read from the output of pretokenize
+    # pad: pad every sample to max_len like Dataset, otherwise a sample is only as long as its tokens
+    def __init__(self, prefix, max_len=2048, shuffle=False, max_cnt=None, truncat=True, pad=True):
+        self.prefix = prefix
+        self.max_len = max_len
+        self.pad = pad
+        with open(tokenized_paths(prefix)['meta'], 'r') as fp:
+            self.meta = json.load(fp)
+        self._open()
+
+        lengths = np.diff(self.offsets)
+        if truncat:
+            indices = np.arange(len(lengths))
+        else:
+            indices = np.flatnonzero(lengths <= max_len)
+        if max_cnt is not None:
+            indices = indices[: max_cnt]
+        if shuffle:
+            indices = np.random.RandomState(SEED).permutation(indices)
+        self.indices = indices
+        # number of tokens of every sample (before padding), in the order of the dataset
+        self.lengths = np.minimum(lengths[indices], max_len)
+        if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+            print(prefix, 'loaded:', len(self.indices))
+
+    def _open(self):
+        paths = tokenized_paths(self.prefix)
+        if self.meta['num_tokens'] > 0:
+            self.ids = np.memmap(paths['ids'], dtype=self.meta['dtype'], mode='r')
+        else:
+            # an empty file cannot be mapped
+            self.ids = np.zeros(0, dtype=self.meta['dtype'])
+        self.offsets = np.load(paths['offsets'], mmap_mode='r')
+        self.prompt_lens = np.load(paths['prompt_lens'], mmap_mode='r')
+
+    def __getstate__(self):
+        # the files are mapped again by the process the dataset is sent to (e.g. spawned dataloader workers), not copied
+        state = dict(self.__dict__)
+        for key in ['ids', 'offsets', 'prompt_lens']:
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        i = self.indices[index]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        # truncat output
+        input_id = torch.from_numpy(self.ids[start: min(end, start + self.max_len)].astype(np.int64))
+        cur_len = len(input_id)
+        label = input_id.clone()
+        label[: int(self.prompt_lens[i])] = -100
+        attention_mask = torch.ones(cur_len, dtype=torch.long)
+        if self.pad and cur_len < self.max_len:
+            pad_len = self.max_len - cur_len
+            input_id = torch.cat([input_id, torch.full((pad_len,), self.meta['pad_token_id'], dtype=torch.long)])
+            label = torch.cat([label, torch.full((pad_len,), -100, dtype=torch.long)])
+            attention_mask = torch.cat([attention_mask, torch.zeros(pad_len, dtype=torch.long)])
+        return {
+            'input_ids': input_id,
+            'labels': label,
+            'attention_mask': attention_mask
+        }
+
+
+if __name__=='__main__':
+    from transformers import AutoTokenizer
+    parser = argparse.ArgumentParser(description='tokenize a training file once for TokenizedDataset')
+    parser.add_argument('file_path', help='the training data (JSONL, `input` and `output` of every sample)')
+    parser.add_argument('prefix', help='prefix of the output files')
+    parser.add_argument('--batch_size', type=int, default=TOKENIZE_BATCH)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained('bigcode/starcoderbase-3b', use_auth_token=os.environ['HF_TOKEN'])
+    pretokenize(args.file_path, tokenizer, args.prefix, batch_size=args.batch_size)
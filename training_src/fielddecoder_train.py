@@ -1,10 +1,13 @@
 import torch
-from dataset import Dataset
+from dataset import Dataset, TokenizedDataset, StreamingDataset
+from batching import DynamicPaddingCollator, LengthGroupedTrainer, PackedDataset, PackedCollator, StreamingTrainer, packing_supported, PACKED_MIN_TRANSFORMERS
+import transformers
 from transformers import AutoTokenizer, AutoModelForCausalLM, TrainingArguments, Trainer
 import argparse
 from accelerate import Accelerator
 from accelerate.utils import DistributedDataParallelKwargs
 import os
+import math
 
 hf_key = os.environ['HF_TOKEN']
 
@@ -17,7 +20,10 @@ def count_dataset_samples(file_path):
             count += 1
     return count
 
-def train(train_fpath, save_dir):
+def train(train_fpath, save_dir, tokenized=False, dynamic_padding=False, pack=False, streaming=False):
+    # tokenized: train_fpath is the prefix of the files written by `python dataset.py` (see TokenizedDataset)
+    # dynamic_padding: pad a batch to its longest sample and batch samples of similar length, pack: concatenate short samples (see batching.py)
+    # streaming: read the samples of train_fpath (a JSONL file or a directory of them) while training (see StreamingDataset)
     kwargs = DistributedDataParallelKwargs(static_graph=True, find_unused_parameters=True)
     accelerator = Accelerator(kwargs_handlers=[kwargs])
 
@@ -27,9 +33,19 @@ def train(train_fpath, save_dir):
     )
     model.transformer.gradient_checkpointing = True
 
-    train_dataset = Dataset(train_fpath, tokenizer, max_len=4096, shuffle=True)
-
-    dataset_size = count_dataset_samples(train_fpath)
+    pad = not (dynamic_padding or pack)
+    if tokenized:
+        train_dataset = TokenizedDataset(train_fpath, max_len=4096, shuffle=True, pad=pad)
+        dataset_size = train_dataset.meta['num_samples']
+    elif streaming:
+        train_dataset = StreamingDataset(train_fpath, tokenizer, max_len=4096, shuffle=True, pad=pad)
+        dataset_size = sum(count_dataset_samples(fpath) for fpath in train_dataset.files)
+    else:
+        train_dataset = Dataset(train_fpath, tokenizer, max_len=4096, shuffle=True, pad=pad)
+        dataset_size = count_dataset_samples(train_fpath)
+    if pack:
+        train_dataset = PackedDataset(train_dataset, max_len=4096)
+        dataset_size = len(train_dataset)
     num_devices = 4
     per_device_train_batch_size = 4
     total_steps_per_epoch = dataset_size / (per_device_train_batch_size * num_devices)  
@@ -44,6 +60,8 @@ def train(train_fpath, save_dir):
         lr_scheduler_type='cosine',
         warmup_steps=500,
         num_train_epochs=1,
+        # a streamed dataset has no length
+        max_steps=math.ceil(total_steps_per_epoch) if streaming else -1,
         gradient_accumulation_steps=1,
         gradient_checkpointing=True,
         optim='adamw_torch',
@@ -55,9 +73,22 @@ def train(train_fpath, save_dir):
         prediction_loss_only=True,
         bf16=True
     )
-    trainer = Trainer(
-        model=model, args=trainer_args, train_dataset=train_dataset,
-    )
+    if streaming:
+        trainer = StreamingTrainer(
+            model=model, args=trainer_args, train_dataset=train_dataset,
+            data_collator=None if pad else DynamicPaddingCollator(tokenizer.eos_token_id),
+        )
+    elif pad:
+        trainer = Trainer(
+            model=model, args=trainer_args, train_dataset=train_dataset,
+        )
+    else:
+        # the packed sequences are about max_len long already
+        trainer_cls = Trainer if pack else LengthGroupedTrainer
+        trainer = trainer_cls(
+            model=model, args=trainer_args, train_dataset=train_dataset,
+            data_collator=PackedCollator(tokenizer.eos_token_id, dtype=torch.bfloat16) if pack else DynamicPaddingCollator(tokenizer.eos_token_id),
+        )
 
     trainer.train()
 
@@ -66,6 +97,14 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('train_fpath')
     parser.add_argument('save_dir')
+    parser.add_argument('--tokenized', default=False, action='store_true', help='train_fpath is the prefix of the pre-tokenized files (python dataset.py <train.jsonl> <prefix>)')
+    parser.add_argument('--dynamic_padding', default=False, action='store_true', help='pad a batch to its longest sample instead of 4096 tokens, and batch samples of similar length')
+    parser.add_argument('--pack', default=False, action='store_true', help='concatenate short samples into sequences of up to 4096 tokens')
+    parser.add_argument('--streaming', default=False, action='store_true', help='read train_fpath (a JSONL file or a directory of them) while training instead of loading it in memory')
     args = parser.parse_args()
+    if args.streaming and (args.tokenized or args.pack):
+        parser.error('--streaming cannot be used with --tokenized or --pack')
+    if args.pack and not packing_supported():
+        parser.error(f'--pack needs transformers >= {PACKED_MIN_TRANSFORMERS} (block-diagonal attention masks), {transformers.__version__} is installed')
 
-    train(args.train_fpath, args.save_dir)
\ No newline at end of file
+    train(args.train_fpath, args.save_dir, tokenized=args.tokenized, dynamic_padding=args.dynamic_padding, pack=args.pack, streaming=args.streaming)
\ No newline at end of file
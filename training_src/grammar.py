@@ -0,0 +1,175 @@
+import re
+import abc
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+from typing import Dict, List, Optional
+
+# Constrained decoding of the answers: every line is `var: name, type` (VarDecoder) or `expr: name, type -> field name, field type` (FieldDecoder),
+# as parsed by eval_vardecoder.py and eval_fielddecoder.py, and answers a variable (expression) of the question that is not answered yet.
+# Once every variable of the question is answered, only the end of sequence can follow, which ends the generation.
+# GrammarLogitsProcessor checks the top_k tokens of every sequence against the grammar, the other tokens are masked
+# (the fallback_top_k best ones are checked if none of the top_k is valid, then the end of sequence is forced).
+# A name and its type are separated by exactly one ', ' (',' in FieldDecoder answers, on each side of '->'), as the evaluators split them,
+# so a type with ', ' (function pointers, templates) cannot be generated.
+
+TOP_K = 32
+FALLBACK_TOP_K = 1024
+
+_TOKEN_TEXTS: Dict[int, List[str]] = {}   # id of a tokenizer -> the text of every token of its vocabulary
+
+
+def token_texts(tokenizer) -> List[str]:
+    # decoded once per tokenizer, instead of once per token and step
+    key = id(tokenizer)
+    if key not in _TOKEN_TEXTS:
+        _TOKEN_TEXTS[key] = tokenizer.batch_decode([[token_id] for token_id in range(len(tokenizer))])
+    return _TOKEN_TEXTS[key]
+
+
+def vardecoder_keys(prompt) -> List[str]:
+    # the variables of `... data type of variables `v1`, `v2`?` (see align_stack.gen_vardecoder_data)
+    return re.findall(r'`([^`\n]+)`', prompt.split('\n')[0])
+
+
+def fielddecoder_keys(prompt) -> List[str]:
+    # the expressions of `... the following memory accesses: e1, e2?` (see gen_train_field.gen_prompt)
+    question = prompt.split('\n')[0]
+    _, _, accesses = question.partition('memory accesses: ')
+    return [expr for expr in accesses[: -1].split(', ') if expr]
+
+
+class LineGrammar(abc.ABC):
+    # the answer of a key is `key: rest`, the key and the rest must not contain ': '
+    def __init__(self, keys: Optional[List[str]]):
+        # keys: the keys to answer, any key is accepted if None
+        self.keys = keys
+
+    @abc.abstractmethod
+    def rest_partial(self, rest) -> bool:
+        # whether rest can be the beginning of a valid rest
+        pass
+
+    @abc.abstractmethod
+    def rest_complete(self, rest) -> bool:
+        pass
+
+    def remaining(self, done_lines: List[str]) -> Optional[List[str]]:
+        if self.keys is None:
+            return None
+        answered = {line.split(': ')[0] for line in done_lines}
+        return [key for key in self.keys if key not in answered]
+
+    def _split(self, line, remaining):
+        # (key, rest) of line, (None, None) if line is a valid beginning of a key, None if it is invalid
+        if remaining is None:
+            if ': ' not in line:
+                return (None, None) if line != ':' else None
+            key, rest = line.split(': ', 1)
+            return (key, rest) if key else None
+        for key in remaining:
+            if line.startswith(key + ': '):
+                return key, line[len(key) + 2:]
+        if any((key + ': ').startswith(line) for key in remaining):
+            return None, None
+        return None
+
+    def line_partial(self, line, remaining) -> bool:
+        split = self._split(line, remaining)
+        if split is None:
+            return False
+        rest = split[1]
+        return rest is None or (': ' not in rest and self.rest_partial(rest))
+
+    def line_complete(self, line, remaining) -> bool:
+        split = self._split(line, remaining)
+        if split is None or split[1] is None:
+            return False
+        return ': ' not in split[1] and self.rest_complete(split[1])
+
+
+class VarGrammar(LineGrammar):
+    # `var: name, type`
+    def rest_partial(self, rest):
+        # eval_vardecoder splits the rest on ', ' into exactly two parts
+        return rest.count(', ') <= 1
+
+    def rest_complete(self, rest):
+        parts = rest.split(', ')
+        return len(parts) == 2 and all(part.strip() for part in parts)
+
+
+class FieldGrammar(LineGrammar):
+    # `expr: name, type -> field name, field type`, eval_fielddecoder splits the rest on '->' and the parts on ','
+    def rest_partial(self, rest):
+        parts = rest.split('->')
+        return len(parts) <= 2 and all(part.count(',') <= 1 for part in parts)
+
+    def rest_complete(self, rest):
+        parts = rest.split('->')
+        return len(parts) == 2 and all(
+            len(part.split(',')) == 2 and all(piece.strip() for piece in part.split(',')) for part in parts
+        )
+
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    # grammars[i] and prefixes[i] (the beginning of the answer in the prompt, e.g. `v1:`) of the i-th prompt of the batch,
+    # the sequences of a prompt (beams, return sequences) follow each other
+    def __init__(self, tokenizer, grammars: List[LineGrammar], prefixes: List[str], top_k=TOP_K, fallback_top_k=FALLBACK_TOP_K):
+        self.tokenizer = tokenizer
+        self.grammars = grammars
+        self.prefixes = prefixes
+        self.top_k = top_k
+        self.fallback_top_k = fallback_top_k
+        self.eos_token_id = tokenizer.eos_token_id
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.prompt_len = None
+        self.token_texts = token_texts(tokenizer)
+
+    def _valid(self, grammar, done_lines, remaining, line, token_id) -> bool:
+        if token_id == self.eos_token_id:
+            return grammar.line_complete(line, remaining) and not [key for key in remaining or [] if key != line.split(': ')[0]]
+        # the model may have more logits than the tokenizer has tokens
+        if token_id in self.special_ids or token_id >= len(self.token_texts):
+            return False
+        segments = (line + self.token_texts[token_id]).split('\n')
+        for segment in segments[: -1]:
+            if not grammar.line_complete(segment, remaining) or (remaining is not None and len(remaining) == 1):
+                # the last key is followed by the end of sequence
+                return False
+            done_lines = done_lines + [segment]
+            remaining = grammar.remaining(done_lines)
+        return grammar.line_partial(segments[-1], remaining)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.prompt_len is None:
+            # the first call is on the prompts
+            self.prompt_len = input_ids.size(1)
+        rows_per_prompt = input_ids.size(0) // len(self.prefixes)
+        masked = torch.full_like(scores, float('-inf'))
+        for row in range(input_ids.size(0)):
+            grammar, prefix = self.grammars[row // rows_per_prompt], self.prefixes[row // rows_per_prompt]
+            text = prefix + self.tokenizer.decode(input_ids[row, self.prompt_len:])
+            *done_lines, line = text.split('\n')
+            remaining = grammar.remaining(done_lines)
+
+            candidates = torch.topk(scores[row], min(self.top_k, scores.size(1))).indices.tolist()
+            allowed = [token_id for token_id in candidates if self._valid(grammar, done_lines, remaining, line, token_id)]
+            if not allowed:
+                fallback = torch.topk(scores[row], min(self.fallback_top_k, scores.size(1))).indices.tolist()
+                allowed = [next((token_id for token_id in fallback
+                                 if self._valid(grammar, done_lines, remaining, line, token_id)), self.eos_token_id)]
+            masked[row, allowed] = scores[row, allowed]
+        return masked
+
+
+def grammar_processor(tokenizer, prompts: List[str], prefixes: List[str], field=False, top_k=TOP_K) -> LogitsProcessorList:
+    # the logits processor of a batch of VarDecoder (FieldDecoder if field is set) prompts
+    grammars = []
+    for prompt, prefix in zip(prompts, prefixes):
+        keys = fielddecoder_keys(prompt) if field else vardecoder_keys(prompt)
+        # the key list of the question may not split into the keys of the answer (e.g. an expression with ', '),
+        # the keys are then not constrained
+        if prefix.rstrip(':') not in keys:
+            keys = None
+        grammars.append(FieldGrammar(keys) if field else VarGrammar(keys))
+    return LogitsProcessorList([GrammarLogitsProcessor(tokenizer, grammars, prefixes, top_k=top_k)])
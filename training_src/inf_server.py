@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import torch
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List
+from urllib import request as urlrequest
+from batch_inf import load_model, MAX_LEN, MAX_NEW_TOKENS
+from grammar import grammar_processor, vardecoder_keys, fielddecoder_keys
+from prefix_cache import map_cache, cache_class, cache_to_legacy, cache_from_legacy
+
+# Long-lived HTTP inference server: the model is loaded once, and the records (same as the lines of the test files of vardecoder_inf.py
+# and fielddecoder_inf.py) are POSTed to /predict, one per request, the response is the record with its `predict`.
+# Continuous batching: the requests in progress are generated together, step_tokens tokens at a time,
+# after every step the finished requests are answered and the waiting ones join the batch, so a request never waits for a whole batch.
+# The prompt of a request is encoded once when it joins, and each request keeps its key/value states across steps:
+# a step pads the states of the batch on the left, generates its tokens one forward pass at a time, and splits the states again.
+# The server decodes greedily, while vardecoder_inf.py and fielddecoder_inf.py use beam search (4 beams by default),
+# so the predictions of the server can differ from those of the offline scripts.
+# A request that times out is removed from the queue or the batch.
+# GET /metrics returns the queue depth, the batch size and the latencies, GET /health returns ok once the model is loaded.
+#
+#   python inf_server.py <model_path> --task var --port 8000
+#   python inf_server.py bigcode/tiny_starcoder_py --tokenizer bigcode/tiny_starcoder_py --device cpu   (offline testing)
+#   curl -d '{"input": "...", "output": "v1:"}' localhost:8000/predict
+
+MAX_BATCH_SIZE = 8
+STEP_TOKENS = 32   # tokens generated for the batch before new requests join it
+REQUEST_TIMEOUT = 600   # seconds
+LATENCY_WINDOW = 1000   # latencies of the last requests in the metrics
+
+
+def first_key(record, field=False):
+    # the answer starts with the first key of the output like in the inference scripts, or of the question if the record has no output
+    if record.get('output'):
+        return record['output'].split(':')[0]
+    keys = fielddecoder_keys(record['input']) if field else vardecoder_keys(record['input'])
+    return keys[0] if keys else ''
+
+
+class Request:
+    def __init__(self, record, prefix, max_new_tokens):
+        self.record = record
+        self.prefix = prefix   # the beginning of the answer in the prompt, `<first key>:`
+        self.prompt_ids: List[int] = None
+        self.max_new_tokens = max_new_tokens
+        self.new_ids: List[int] = []
+        self.past = None   # key/value states of the prompt and the generated tokens but the last one
+        self.past_len = 0
+        self.next_token = None   # the last generated token, not in past yet
+        self.finished = False
+        self.processor = None   # see grammar.py
+        self.arrival_time = time.time()
+        self.start_time = None   # joined the batch
+        self.cancelled = False   # timed out, no longer generated
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(int(q * len(values)), len(values) - 1)], 4)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.tokens = 0
+        self.steps = 0
+        self.step_rows = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.queue_times = deque(maxlen=LATENCY_WINDOW)
+
+    def step(self, batch_size):
+        with self.lock:
+            self.steps += 1
+            self.step_rows += batch_size
+
+    def done(self, request: Request):
+        with self.lock:
+            now = time.time()
+            self.completed += 1
+            self.tokens += len(request.new_ids)
+            self.latencies.append(now - request.arrival_time)
+            self.queue_times.append(request.start_time - request.arrival_time)
+
+    def fail(self, n=1):
+        with self.lock:
+            self.failed += n
+
+    def snapshot(self, queue_depth, active) -> Dict:
+        with self.lock:
+            uptime = time.time() - self.start_time
+            latencies, queue_times = list(self.latencies), list(self.queue_times)
+            return {
+                'queue_depth': queue_depth,
+                'active': active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'generated_tokens': self.tokens,
+                'tokens_per_second': round(self.tokens / max(uptime, 1e-6), 2),
+                'steps': self.steps,
+                'mean_batch_size': round(self.step_rows / max(self.steps, 1), 2),
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p90': percentile(latencies, 0.9),
+                'latency_p99': percentile(latencies, 0.99),
+                'queue_time_p50': percentile(queue_times, 0.5),
+                'queue_time_p90': percentile(queue_times, 0.9),
+                'uptime': round(uptime, 1),
+            }
+
+
+class Engine:
+    # the scheduler thread: admits the waiting requests into the batch and generates a step of the batch in a loop
+    def __init__(self, model, tokenizer, device='cuda', field=False, max_batch_size=MAX_BATCH_SIZE, step_tokens=STEP_TOKENS, constrained=False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.field = field
+        self.max_batch_size = max_batch_size
+        self.step_tokens = step_tokens
+        self.constrained = constrained
+        self.eos_token_id = tokenizer.eos_token_id
+        self.pending = queue.Queue()
+        self.active: List[Request] = []
+        self.metrics = Metrics()
+        self.cache_cls, self.seq_dims = self._probe_cache()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, record, max_new_tokens=MAX_NEW_TOKENS) -> Request:
+        # called by the request threads
+        request = Request(record, first_key(record, field=self.field) + ':', max_new_tokens)
+        self.pending.put(request)
+        return request
+
+    def cancel(self, request: Request):
+        # called by the request threads, the scheduler drops the request before its next step
+        request.cancelled = True
+        self.metrics.fail()
+
+    def _forward(self, input_ids, past=None, **kwargs):
+        # logits of the last position and past_key_values in the legacy layout (see prefix_cache.cache_to_legacy)
+        if past is not None:
+            past = cache_from_legacy(past, self.cache_cls)
+        with torch.no_grad():
+            output = self.model(input_ids=input_ids, past_key_values=past, use_cache=True, **kwargs)
+        return output.logits[:, -1, :], cache_to_legacy(output.past_key_values)
+
+    def _probe_cache(self):
+        # the cache class of the model (None for tuples), and the sequence dimension of each tensor of its legacy states
+        # (it depends on the architecture), the one that differs between the states of 1 and 2 tokens
+        with torch.no_grad():
+            one = self.model(input_ids=torch.tensor([[self.eos_token_id]], device=self.device), use_cache=True).past_key_values
+            two = self.model(input_ids=torch.tensor([[self.eos_token_id] * 2], device=self.device), use_cache=True).past_key_values
+        cache_cls = cache_class(one)
+        one, two = cache_to_legacy(one), cache_to_legacy(two)
+        seq_dims = map_cache(lambda a, b: next(d for d in range(a.dim()) if a.size(d) != b.size(d)), one, two)
+        return cache_cls, seq_dims
+
+    def _choose(self, request: Request, logits):
+        # the greedy next token of a request, within its grammar if constrained
+        if request.processor is not None:
+            logits = request.processor(torch.tensor([request.new_ids], dtype=torch.long), logits.unsqueeze(0))[0]
+        return int(logits.argmax())
+
+    def _append(self, request: Request, token):
+        request.next_token = token
+        if token == self.eos_token_id:
+            request.finished = True
+            return
+        request.new_ids.append(token)
+        if len(request.new_ids) >= request.max_new_tokens:
+            request.finished = True
+
+    def _admit(self):
+        while len(self.active) < self.max_batch_size:
+            try:
+                # wait for a request only if there is nothing to generate
+                request = self.pending.get(block=not self.active, timeout=None if self.active else 1)
+            except queue.Empty:
+                return
+            if request.cancelled:
+                continue
+            request.start_time = time.time()
+            try:
+                # the tokenizer is only used by the scheduler thread
+                request.prompt_ids = self.tokenizer.encode(request.record['input'] + request.prefix)[: MAX_LEN - request.max_new_tokens]
+                if self.constrained:
+                    request.processor = grammar_processor(self.tokenizer, [request.record['input']], [request.prefix], field=self.field)[0]
+                    # the processor is given the generated tokens only
+                    request.processor.prompt_len = 0
+                # the prompt is encoded once, the first token is generated from its last position
+                logits, request.past = self._forward(torch.tensor([request.prompt_ids], device=self.device))
+                request.past_len = len(request.prompt_ids)
+                self._append(request, self._choose(request, logits[0]))
+            except Exception as e:
+                request.error = f'{type(e).__name__}: {e}'
+                request.done.set()
+                self.metrics.fail()
+                continue
+            if request.finished:
+                self._finish(request)
+            else:
+                self.active.append(request)
+
+    def _merge(self, pasts, lengths):
+        # the states of the batch, each padded on the left to the longest one
+        max_len = max(lengths)
+
+        def merge(dim, *tensors):
+            padded = []
+            for t, n in zip(tensors, lengths):
+                if n < max_len:
+                    shape = list(t.shape)
+                    shape[dim] = max_len - n
+                    t = torch.cat([t.new_zeros(shape), t], dim=dim)
+                padded.append(t)
+            return torch.cat(padded, dim=0)
+        return map_cache(merge, self.seq_dims, *pasts)
+
+    def _split(self, past, row, pad):
+        # the states of a row of the batch without its padding
+        return map_cache(lambda dim, t: t[row: row + 1].narrow(dim, pad, t.size(dim) - pad), self.seq_dims, past)
+
+    def _step(self):
+        batch = self.active
+        lengths = [r.past_len for r in batch]
+        max_len = max(lengths)
+        past = self._merge([r.past for r in batch], lengths)
+        attention_mask = torch.tensor([[0] * (max_len - n) + [1] * n for n in lengths], dtype=torch.long, device=self.device)
+        position_ids = torch.tensor([[n] for n in lengths], dtype=torch.long, device=self.device)
+
+        num_tokens = 0
+        while num_tokens < self.step_tokens and not all(r.finished for r in batch):
+            # the finished requests are fed the end of sequence until the end of the step, their tokens are not used
+            input_ids = torch.tensor([[self.eos_token_id if r.finished else r.next_token] for r in batch], device=self.device)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((len(batch), 1))], dim=1)
+            logits, past = self._forward(input_ids, past, attention_mask=attention_mask, position_ids=position_ids)
+            position_ids = position_ids + 1
+            num_tokens += 1
+            for row, request in enumerate(batch):
+                if not request.finished:
+                    self._append(request, self._choose(request, logits[row]))
+        self.metrics.step(len(batch))
+
+        for row, request in enumerate(batch):
+            if request.finished:
+                request.past = None
+                self._finish(request)
+            else:
+                request.past = self._split(past, row, max_len - lengths[row])
+                request.past_len = lengths[row] + num_tokens
+        self.active = [r for r in batch if not r.done.is_set()]
+
+    def _finish(self, request: Request):
+        text = self.tokenizer.decode(request.new_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        request.result = dict(request.record, predict=request.prefix + text, time=time.time() - request.start_time)
+        self.metrics.done(request)
+        request.done.set()
+
+    def _loop(self):
+        while True:
+            self._admit()
+            # the requests that timed out are dropped with their states
+            self.active = [r for r in self.active if not r.cancelled]
+            if not self.active:
+                continue
+            try:
+                self._step()
+            except Exception as e:
+                # the requests of the batch fail, the server goes on
+                for request in self.active:
+                    request.error = f'{type(e).__name__}: {e}'
+                    request.past = None
+                    request.done.set()
+                self.metrics.fail(len(self.active))
+                self.active = []
+
+    def status(self) -> Dict:
+        return self.metrics.snapshot(self.pending.qsize(), len(self.active))
+
+
+class Handler(BaseHTTPRequestHandler):
+    engine: Engine = None
+    max_new_tokens = MAX_NEW_TOKENS
+    request_timeout = REQUEST_TIMEOUT
+    verbose = False
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send(200, self.engine.status())
+        elif self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        else:
+            self._send(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            record = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(record, dict) or not isinstance(record.get('input'), str):
+                raise ValueError('the record must be a JSON object with an `input`')
+            # max_new_tokens of the record, at most the one of the server
+            max_new_tokens = min(int(record.pop('max_new_tokens', self.max_new_tokens)), self.max_new_tokens)
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        request = self.engine.submit(record, max_new_tokens=max_new_tokens)
+        if not request.done.wait(self.request_timeout):
+            self.engine.cancel(request)
+            self._send(504, {'error': 'timeout'})
+        elif request.error is not None:
+            self._send(500, {'error': request.error})
+        else:
+            self._send(200, request.result)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def predict(url, record, timeout=REQUEST_TIMEOUT) -> Dict:
+    # client: the record with its prediction, e.g. predict('http://localhost:8000', {'input': ...})
+    req = urlrequest.Request(url.rstrip('/') + '/predict', data=json.dumps(record).encode(), headers={'Content-Type': 'application/json'})
+    with urlrequest.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+
+def serve(model_path, host='127.0.0.1', port=8000, task='var', device='cuda', tokenizer_path='bigcode/starcoderbase-3b',
+          max_batch_size=MAX_BATCH_SIZE, step_tokens=STEP_TOKENS, max_new_tokens=MAX_NEW_TOKENS, constrained=False, verbose=False):
+    print('==========start loading model==========')
+    tokenizer, model = load_model(model_path, os.environ.get('HF_TOKEN'), device=device, tokenizer_path=tokenizer_path)
+    Handler.engine = Engine(model, tokenizer, device=device, field=task == 'field', max_batch_size=max_batch_size,
+                            step_tokens=step_tokens, constrained=constrained)
+    Handler.max_new_tokens = max_new_tokens
+    Handler.verbose = verbose
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'serving {task} predictions of {model_path} on http://{host}:{port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='HTTP inference server (greedy decoding, unlike the beam search of the inference scripts)')
+    parser.add_argument('model_path')
+    parser.add_argument('--task', default='var', choices=['var', 'field'], help='VarDecoder or FieldDecoder records')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
+    parser.add_argument('--tokenizer', default='bigcode/starcoderbase-3b', help='e.g. the model path for a small test model')
+    parser.add_argument('--max_batch_size', type=int, default=MAX_BATCH_SIZE, help='requests generated together')
+    parser.add_argument('--step_tokens', type=int, default=STEP_TOKENS, help='tokens generated before the waiting requests join the batch')
+    parser.add_argument('--max_new_tokens', type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument('--constrained', default=False, action='store_true', help='only generate answers in the format of the evaluation (see grammar.py)')
+    parser.add_argument('--verbose', default=False, action='store_true', help='log every HTTP request')
+    args = parser.parse_args()
+
+    serve(args.model_path, host=args.host, port=args.port, task=args.task, device=args.device, tokenizer_path=args.tokenizer,
+          max_batch_size=args.max_batch_size, step_tokens=args.step_tokens, max_new_tokens=args.max_new_tokens,
+          constrained=args.constrained, verbose=args.verbose)
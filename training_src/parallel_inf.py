@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import argparse
+import statistics
+import multiprocessing as mp
+from multiprocessing import connection
+from typing import Dict, List, Optional, Tuple
+
+# Data-parallel inference: one replica of the model per device (a GPU, or the cores of a NUMA node), instead of one model spread over all GPUs.
+# The test file is split into shards of consecutive records, every worker loads the model once and runs the batched inference
+# (vardecoder_inf.batch_inference or fielddecoder_inf.batch_inference) on the shards it is given.
+# A shard that runs straggler_factor times longer than the median shard is given to an idle worker as well, the first output wins,
+# and the worker still running the other copy is stopped and restarted on its device.
+# The outputs of the shards are kept in <out_fpath>.shards (a restarted run only runs the missing shards),
+# and concatenated in the order of the shards, that is in the order of the test file.
+#
+#   python parallel_inf.py var test.jsonl out.jsonl <model_path> --devices 0,1,2,3 --batch_size 8
+#   python parallel_inf.py var test.jsonl out.jsonl <model_path> --devices numa:0,numa:1 --batch_size 4
+
+SHARDS_PER_WORKER = 4
+STRAGGLER_FACTOR = 2.0
+MAX_ATTEMPTS = 3   # failed runs of a shard before giving up
+
+
+def numa_cpus(node) -> List[int]:
+    # the cores of a NUMA node, from its cpulist (e.g. 0-15,32-47)
+    with open(f'/sys/devices/system/node/node{node}/cpulist', 'r') as fp:
+        cpus = []
+        for part in fp.read().strip().split(','):
+            first, _, last = part.partition('-')
+            cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def default_devices() -> List[str]:
+    import torch
+    if torch.cuda.is_available():
+        return [str(i) for i in range(torch.cuda.device_count())]
+    return ['cpu']
+
+
+def _worker(worker_id, device, task, model_path, batch_kwargs, tasks, results):
+    # device: a GPU index, `cpu`, or `numa:<node>`
+    # the devices are set before torch is imported in the worker (started with spawn)
+    if device == 'cpu' or device.startswith('numa:'):
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        torch_device = 'cpu'
+        if device.startswith('numa:'):
+            cpus = numa_cpus(int(device.split(':')[1]))
+            os.sched_setaffinity(0, cpus)
+            os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+        torch_device = 'cuda'
+    import importlib
+    from batch_inf import load_model
+    module = importlib.import_module('fielddecoder_inf' if task == 'field' else 'vardecoder_inf')
+    tokenizer, model = load_model(model_path, module.hf_key, device=torch_device)
+    results.send(('ready', worker_id, None, None))
+
+    while True:
+        item = tasks.get()
+        if item is None:
+            return
+        shard, in_fpath, out_fpath = item
+        start_time = time.time()
+        try:
+            module.batch_inference(in_fpath, out_fpath, model_path, device=torch_device, overwrite=True,
+                                   tokenizer=tokenizer, model=model, **batch_kwargs)
+        except Exception as e:
+            results.send(('error', worker_id, shard, f'{type(e).__name__}: {e}'))
+            continue
+        results.send(('done', worker_id, shard, time.time() - start_time))
+
+
+class ShardSet:
+    # the input and output files of the shards of a test file, in <out_fpath>.shards
+    def __init__(self, test_fpath, out_fpath, shard_size):
+        self.dir = out_fpath + '.shards'
+        os.makedirs(self.dir, exist_ok=True)
+        manifest = {'test_fpath': os.path.abspath(test_fpath), 'size': os.path.getsize(test_fpath),
+                    'mtime': os.path.getmtime(test_fpath), 'shard_size': shard_size}
+        manifest_fpath = os.path.join(self.dir, 'manifest.json')
+        if os.path.exists(manifest_fpath):
+            with open(manifest_fpath, 'r') as fp:
+                if json.load(fp) != manifest:
+                    # another test file or shard size, the outputs of the previous run are not reused
+                    for f in os.listdir(self.dir):
+                        os.remove(os.path.join(self.dir, f))
+        self.num_shards = self._split(test_fpath, shard_size)
+        with open(manifest_fpath, 'w') as fp:
+            json.dump(manifest, fp)
+
+    def input_path(self, shard):
+        return os.path.join(self.dir, f'input-{shard:05d}.jsonl')
+
+    def output_path(self, shard):
+        return os.path.join(self.dir, f'output-{shard:05d}.jsonl')
+
+    def attempt_path(self, shard, worker_id):
+        return os.path.join(self.dir, f'output-{shard:05d}.{worker_id}.tmp')
+
+    def _split(self, test_fpath, shard_size) -> int:
+        num_shards = 0
+        wp = None
+        with open(test_fpath, 'r') as fp:
+            num_lines = 0
+            for line in fp:
+                if not line.strip():
+                    continue
+                if num_lines % shard_size == 0:
+                    if wp is not None:
+                        wp.close()
+                    wp = open(self.input_path(num_shards), 'w')
+                    num_shards += 1
+                wp.write(line if line.endswith('\n') else line + '\n')
+                num_lines += 1
+        if wp is not None:
+            wp.close()
+        return num_shards
+
+    def done(self, shard) -> bool:
+        return os.path.exists(self.output_path(shard))
+
+    def merge(self, out_fpath):
+        tmp_fpath = f'{out_fpath}.{os.getpid()}.tmp'
+        with open(tmp_fpath, 'w') as wp:
+            for shard in range(self.num_shards):
+                with open(self.output_path(shard), 'r') as fp:
+                    for line in fp:
+                        wp.write(line)
+        os.replace(tmp_fpath, out_fpath)
+
+
+class WorkerPool:
+    # one worker process per device, each with its own task queue and result pipe,
+    # so that stopping a worker (even while it sends a result) cannot corrupt the channels of the others
+    def __init__(self, devices: List[str], task, model_path, batch_kwargs):
+        self.devices = devices
+        self.args = (task, model_path, batch_kwargs)
+        self.ctx = mp.get_context('spawn')
+        self.workers: Dict[int, Dict] = {}
+        for worker_id in range(len(devices)):
+            self.start(worker_id)
+
+    def start(self, worker_id):
+        tasks = self.ctx.Queue()
+        receiver, sender = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=_worker, args=(worker_id, self.devices[worker_id], *self.args, tasks, sender), daemon=True)
+        process.start()
+        # the pipe is closed for the coordinator once the worker exits
+        sender.close()
+        self.workers[worker_id] = {'process': process, 'tasks': tasks, 'results': receiver, 'ready': False, 'shard': None, 'start_time': None}
+
+    def stop(self, worker_id):
+        worker = self.workers.pop(worker_id)
+        worker['process'].terminate()
+        worker['process'].join()
+        worker['results'].close()
+        # the tasks not read by the worker are dropped
+        worker['tasks'].cancel_join_thread()
+        worker['tasks'].close()
+
+    def messages(self, timeout) -> List[Tuple]:
+        # the (kind, worker_id, shard, value) messages received within timeout seconds
+        received = []
+        ready = connection.wait([worker['results'] for worker in self.workers.values()], timeout=timeout)
+        for worker in list(self.workers.values()):
+            while worker['results'] in ready and worker['results'].poll():
+                try:
+                    received.append(worker['results'].recv())
+                except (EOFError, OSError):
+                    # the worker exited, see exited
+                    break
+        return received
+
+    def drain(self, worker_id) -> List[Tuple]:
+        # the messages left in the pipe of a worker that exited
+        received = []
+        results = self.workers[worker_id]['results']
+        try:
+            while results.poll():
+                received.append(results.recv())
+        except (EOFError, OSError):
+            pass
+        return received
+
+    def exited(self) -> List[int]:
+        return [worker_id for worker_id, worker in self.workers.items() if not worker['process'].is_alive()]
+
+    def shutdown(self):
+        for worker in self.workers.values():
+            if worker['process'].is_alive():
+                worker['tasks'].put(None)
+        for worker_id in list(self.workers):
+            self.workers[worker_id]['process'].join(timeout=10)
+            self.stop(worker_id)
+
+
+def parallel_inference(task, test_fpath, out_fpath, model_path, devices: Optional[List[str]] = None, shard_size=None,
+                       straggler_factor=STRAGGLER_FACTOR, keep_shards=False, **batch_kwargs):
+    # batch_kwargs: the arguments of batch_inference (batch_size, num_beams, ...)
+    devices = devices or default_devices()
+    if shard_size is None:
+        with open(test_fpath, 'r') as fp:
+            num_lines = sum(1 for line in fp if line.strip())
+        shard_size = max(1, -(-num_lines // (len(devices) * SHARDS_PER_WORKER)))
+    shards = ShardSet(test_fpath, out_fpath, shard_size)
+    pending = [shard for shard in range(shards.num_shards) if not shards.done(shard)]
+    print(f'{shards.num_shards} shards of {shard_size} records, {len(pending)} to run on {len(devices)} workers: {", ".join(devices)}', flush=True)
+
+    pool = WorkerPool(devices, task, model_path, batch_kwargs)
+    workers = pool.workers
+    running: Dict[int, List[int]] = {}   # shard -> the workers running it
+    attempts: Dict[int, int] = {}
+    durations = []
+    start_time = time.time()
+
+    def give_back(shard, worker_id):
+        # a run of shard failed, it is pending again unless another worker runs it
+        attempts[shard] = attempts.get(shard, 0) + 1
+        if attempts[shard] >= MAX_ATTEMPTS:
+            raise RuntimeError(f'shard {shard} failed {attempts[shard]} times')
+        running[shard].remove(worker_id)
+        if not running[shard]:
+            del running[shard]
+            if not shards.done(shard):
+                pending.insert(0, shard)
+
+    def on_message(kind, worker_id, shard, value):
+        worker = workers.get(worker_id)
+        if worker is None:
+            return
+        if kind == 'ready':
+            worker['ready'] = True
+            return
+        worker['shard'] = None
+        if kind == 'error':
+            print(f'shard {shard} failed on worker {worker_id}: {value}', flush=True)
+            give_back(shard, worker_id)
+            return
+        running[shard].remove(worker_id)
+        if not shards.done(shard):
+            # the first output of a shard is kept
+            os.replace(shards.attempt_path(shard, worker_id), shards.output_path(shard))
+            durations.append(value)
+            num_done = sum(1 for s in range(shards.num_shards) if shards.done(s))
+            print(f'shard {shard} done by worker {worker_id} in {value:.1f}s, {num_done}/{shards.num_shards} shards, {time.time() - start_time:.1f}s elapsed', flush=True)
+        # the other runs of the shard are no longer needed, their workers are replaced by new ones on the same devices
+        for other_id in running.pop(shard, []):
+            print(f'worker {other_id} stopped (shard {shard} is done)', flush=True)
+            pool.stop(other_id)
+            if os.path.exists(shards.attempt_path(shard, other_id)):
+                os.remove(shards.attempt_path(shard, other_id))
+            if pending or running:
+                pool.start(other_id)
+
+    try:
+        while pending or running:
+            for message in pool.messages(timeout=1):
+                on_message(*message)
+
+            # a worker that died gives back its shard, and is restarted if it died running a shard (not loading the model)
+            for worker_id in pool.exited():
+                for message in pool.drain(worker_id):
+                    on_message(*message)
+                worker = workers[worker_id]
+                print(f'worker {worker_id} ({devices[worker_id]}) exited with code {worker["process"].exitcode}', flush=True)
+                pool.stop(worker_id)
+                if worker['shard'] is not None:
+                    give_back(worker['shard'], worker_id)
+                if worker['ready'] and (pending or running):
+                    pool.start(worker_id)
+            if not workers:
+                raise RuntimeError('all the workers exited')
+
+            for worker_id, worker in workers.items():
+                if not worker['ready'] or worker['shard'] is not None:
+                    continue
+                shard = None
+                if pending:
+                    shard = pending.pop(0)
+                elif durations:
+                    # the straggler that runs the longest, if it is not run twice already
+                    median = statistics.median(durations)
+                    stragglers = [(workers[ws[0]]['start_time'], s) for s, ws in running.items()
+                                  if len(ws) == 1 and time.time() - workers[ws[0]]['start_time'] > straggler_factor * median]
+                    if stragglers:
+                        shard = min(stragglers)[1]
+                        print(f'shard {shard} re-dispatched to worker {worker_id}', flush=True)
+                if shard is None:
+                    continue
+                worker.update(shard=shard, start_time=time.time())
+                running.setdefault(shard, []).append(worker_id)
+                worker['tasks'].put((shard, shards.input_path(shard), shards.attempt_path(shard, worker_id)))
+    finally:
+        pool.shutdown()
+
+    shards.merge(out_fpath)
+    print(f'{shards.num_shards} shards merged into {out_fpath} in {time.time() - start_time:.1f}s', flush=True)
+    if not keep_shards:
+        for f in os.listdir(shards.dir):
+            os.remove(os.path.join(shards.dir, f))
+        os.rmdir(shards.dir)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='data-parallel batched inference, one model replica per device')
+    parser.add_argument('task', choices=['var', 'field'], help='VarDecoder or FieldDecoder')
+    parser.add_argument('test_fpath')
+    parser.add_argument('out_fpath')
+    parser.add_argument('model_path')
+    parser.add_argument('--devices', default=None, help='comma separated GPU indices, `cpu`, or `numa:<node>` (the cores of a NUMA node), all the GPUs by default')
+    parser.add_argument('--shard_size', type=int, default=None, help=f'records per shard, {SHARDS_PER_WORKER} shards per worker by default')
+    parser.add_argument('--straggler_factor', type=float, default=STRAGGLER_FACTOR, help='re-dispatch a shard that runs this many times longer than the median shard')
+    parser.add_argument('--keep_shards', default=False, action='store_true', help='keep the shard files after merging')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--max_batch_tokens', type=int, default=None)
+    parser.add_argument('--num_beams', type=int, default=4)
+    parser.add_argument('--num_return_sequences', type=int, default=1)
+    parser.add_argument('--constrained', default=False, action='store_true', help='see grammar.py')
+    parser.add_argument('--chunk', default=False, action='store_true', help='see chunking.py')
+    args = parser.parse_args()
+
+    parallel_inference(
+        args.task, args.test_fpath, args.out_fpath, args.model_path,
+        devices=args.devices.split(',') if args.devices else None, shard_size=args.shard_size,
+        straggler_factor=args.straggler_factor, keep_shards=args.keep_shards,
+        batch_size=args.batch_size, max_batch_tokens=args.max_batch_tokens, num_beams=args.num_beams,
+        num_return_sequences=args.num_return_sequences, constrained=args.constrained, chunk=args.chunk,
+    )
@@ -0,0 +1,212 @@
+import os
+import time
+import hashlib
+import itertools
+import argparse
+import torch
+from collections import OrderedDict
+from typing import List, Tuple
+from batch_inf import read_jsonl, MAX_LEN, MAX_NEW_TOKENS
+
+# Reuse of the key/value states of prompt prefixes across generations.
+# The queries of the same function (re-queries, one query per variable) share their input, the question and the decompiled code,
+# only the suffix that starts the answer (e.g. `v1:`) differs.
+# PrefixCache keeps the past_key_values of the encoded prefixes in an LRU bounded in entries and tokens, keyed by a hash of the prefix tokens,
+# CachedGenerator encodes the prefix of a prompt once, the following queries with the same prefix only encode their suffix.
+# The states are copied and expanded per beam through their legacy layout (see cache_to_legacy), which depends on the transformers version,
+# so the first cached generation of each generation setup is checked against the generation of the full prompt,
+# and the cache is turned off if they differ.
+
+PREFIX_CACHE_ENTRIES = 32
+PREFIX_CACHE_TOKENS = 64 * 1024   # tokens of all the cached prefixes
+
+
+def prefix_key(ids: List[int]) -> str:
+    return hashlib.sha1(','.join(map(str, ids)).encode()).hexdigest()
+
+
+def map_cache(fn, past, *others):
+    # apply fn to the tensors of past_key_values in the legacy format (tuples of tensors, or of tuples of tensors),
+    # others: structures of the same shape, their elements are passed along
+    if not isinstance(past, (tuple, list)):
+        return fn(past, *others)
+    return tuple(map_cache(fn, p, *(o[i] for o in others)) for i, p in enumerate(past))
+
+
+def cache_class(past):
+    # the Cache class of past_key_values, None for the tuples of older transformers versions
+    return None if isinstance(past, (tuple, list)) else type(past)
+
+
+def cache_to_legacy(past):
+    # past_key_values as tuples, the layout of the states depends on the transformers version:
+    # tuples (of tensors per layer, of (key, value) for most models) before 4.36,
+    # Cache objects with to_legacy_cache up to 4.x, Cache objects with (keys, values) layers from 5.0
+    if isinstance(past, (tuple, list)):
+        return tuple(past)
+    if hasattr(past, 'to_legacy_cache'):
+        return past.to_legacy_cache()
+    if hasattr(past, 'layers'):
+        return tuple((layer.keys, layer.values) for layer in past.layers)
+    raise TypeError(f'unsupported past_key_values {type(past).__name__}')
+
+
+def cache_from_legacy(legacy, cls):
+    # the inverse of cache_to_legacy, cls: the cache_class of the original past_key_values
+    if cls is None:
+        return legacy
+    if hasattr(cls, 'from_legacy_cache'):
+        return cls.from_legacy_cache(legacy)
+    return cls(legacy)
+
+
+def copy_cache(past, expand_size=1):
+    # a copy of past_key_values (generate may update it in place), with every sequence repeated expand_size times (one per beam),
+    # the batch is the first dimension of the tensors in every layout
+    legacy = map_cache(lambda t: t.repeat_interleave(expand_size, dim=0) if expand_size > 1 else t.clone(), cache_to_legacy(past))
+    return cache_from_legacy(legacy, cache_class(past))
+
+
+class PrefixCache:
+    def __init__(self, max_entries=PREFIX_CACHE_ENTRIES, max_tokens=PREFIX_CACHE_TOKENS):
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.entries = OrderedDict()   # key -> (past_key_values, number of tokens), least recently used first
+        self.num_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0   # prefix tokens not encoded again
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        past, num_tokens = self.entries[key]
+        self.hits += 1
+        self.saved_tokens += num_tokens
+        return past
+
+    def put(self, key, past, num_tokens):
+        if key in self.entries:
+            self.num_tokens -= self.entries.pop(key)[1]
+        self.entries[key] = (past, num_tokens)
+        self.num_tokens += num_tokens
+        # the new entry is kept even if it is larger than max_tokens on its own
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.num_tokens > self.max_tokens):
+            _, (_, evicted_tokens) = self.entries.popitem(last=False)
+            self.num_tokens -= evicted_tokens
+
+    def report(self):
+        total = max(self.hits + self.misses, 1)
+        print(f'prefix cache: {self.hits} hits, {self.misses} misses ({self.hits / total:.1%} hit rate), {self.saved_tokens} prompt tokens reused, '
+              f'{len(self.entries)} entries of {self.num_tokens} tokens', flush=True)
+
+
+class CachedGenerator:
+    # model.generate for prompts made of a prefix and a suffix, with the states of the prefixes in cache
+    def __init__(self, model, tokenizer, device='cuda', cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.cache = cache if cache is not None else PrefixCache()
+        self.enabled = True
+        self.checked = set()   # generation setups checked against the full prompt
+
+    def _prefix_past(self, ids: List[int]):
+        key = prefix_key(ids)
+        past = self.cache.get(key)
+        if past is None:
+            with torch.no_grad():
+                past = self.model(input_ids=torch.tensor([ids], device=self.device), use_cache=True).past_key_values
+            self.cache.put(key, past, len(ids))
+        return past
+
+    def generate(self, prefix, suffix, max_prompt_len=MAX_LEN - MAX_NEW_TOKENS, **generate_kwargs) -> Tuple[str, int]:
+        # return the generated text of prefix + suffix and its number of tokens,
+        # the prompt is tokenized and truncated as a whole like without the cache, so that the outputs are the same
+        ids = self.tokenizer.encode(prefix + suffix)[: max_prompt_len]
+        prefix_ids = self.tokenizer.encode(prefix)
+        # the cached part is the tokens of the prefix that are also the first tokens of the prompt (the tokens may merge across the boundary),
+        # at least one token of the prompt is left to generate from
+        common = 0
+        while common < min(len(prefix_ids), len(ids) - 1) and prefix_ids[common] == ids[common]:
+            common += 1
+
+        input_ids = torch.tensor([ids], device=self.device)
+        kwargs = dict(generate_kwargs)
+        if common > 0 and self.enabled:
+            expand_size = kwargs.get('num_beams', 1) if kwargs.get('num_beams', 1) > 1 else kwargs.get('num_return_sequences', 1)
+            kwargs['past_key_values'] = copy_cache(self._prefix_past(ids[: common]), expand_size)
+        output = self._generate(input_ids, kwargs)
+
+        setup = tuple(sorted((k, v) for k, v in generate_kwargs.items() if isinstance(v, (int, float, bool, str))))
+        if 'past_key_values' in kwargs and setup not in self.checked:
+            self.checked.add(setup)
+            expected = self._generate(input_ids, generate_kwargs)
+            if not torch.equal(output, expected):
+                print(f'[ERROR] (prefix cache) the cached generation differs from the full prompt ({type(kwargs["past_key_values"]).__name__} states), '
+                      'the prefix cache is turned off', flush=True)
+                self.enabled = False
+                output = expected
+        num_tokens = output.size(0) - len(ids)
+        text = self.tokenizer.decode(output[len(ids):], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        return text, num_tokens
+
+    def _generate(self, input_ids, kwargs):
+        with torch.no_grad():
+            return self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **kwargs)[0]
+
+
+def benchmark(model_name, test_fpath, num_functions=8, max_new_tokens=32, num_beams=1, max_prompt_len=1024, hf_key=None):
+    # time the queries of the first num_functions records of test_fpath on CPU, one query per variable (each line of the output),
+    # generated from the full prompt and with the prefix cache, and check that both give the same outputs
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_auth_token=hf_key)
+    model = AutoModelForCausalLM.from_pretrained(model_name, use_auth_token=hf_key, torch_dtype=torch.float32)
+    model.eval()
+    generate_kwargs = dict(
+        max_new_tokens=max_new_tokens, num_beams=num_beams, num_return_sequences=1, do_sample=False,
+        early_stopping=False, pad_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id
+    )
+
+    lines = list(itertools.islice(read_jsonl(test_fpath), num_functions))
+    queries = []
+    for line in lines:
+        for output_line in line['output'].split('\n'):
+            if ':' in output_line:
+                queries.append((line['input'], output_line.split(':')[0] + ':'))
+    print(f'{len(queries)} queries of {len(lines)} functions, model {model_name}, max_prompt_len {max_prompt_len}, {num_beams} beams')
+
+    start_time = time.time()
+    uncached = []
+    for prefix, suffix in queries:
+        input_ids = torch.tensor([tokenizer.encode(prefix + suffix)[: max_prompt_len]])
+        with torch.no_grad():
+            output = model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **generate_kwargs)[0]
+        uncached.append(tokenizer.decode(output[input_ids.size(1):], skip_special_tokens=True, clean_up_tokenization_spaces=True))
+    uncached_time = time.time() - start_time
+
+    generator = CachedGenerator(model, tokenizer, device='cpu')
+    start_time = time.time()
+    cached = [generator.generate(prefix, suffix, max_prompt_len=max_prompt_len, **generate_kwargs)[0] for prefix, suffix in queries]
+    cached_time = time.time() - start_time
+
+    print(f'full prompt:  {uncached_time:.2f}s, {len(queries) / uncached_time:.2f} queries/s')
+    print(f'prefix cache: {cached_time:.2f}s, {len(queries) / cached_time:.2f} queries/s, {uncached_time / cached_time:.2f}x')
+    generator.cache.report()
+    print(f'same outputs: {sum(a == b for a, b in zip(uncached, cached))}/{len(queries)}')
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='benchmark the prefix cache on CPU')
+    parser.add_argument('test_fpath', help='a VarDecoder or FieldDecoder test file (JSONL)')
+    parser.add_argument('--model', default='bigcode/tiny_starcoder_py', help='a small model with the tokenizer of the decoders')
+    parser.add_argument('--num_functions', type=int, default=8)
+    parser.add_argument('--max_new_tokens', type=int, default=32)
+    parser.add_argument('--num_beams', type=int, default=1)
+    parser.add_argument('--max_prompt_len', type=int, default=1024)
+    args = parser.parse_args()
+
+    benchmark(args.model, args.test_fpath, num_functions=args.num_functions, max_new_tokens=args.max_new_tokens,
+              num_beams=args.num_beams, max_prompt_len=args.max_prompt_len, hf_key=os.environ.get('HF_TOKEN'))
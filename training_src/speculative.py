@@ -0,0 +1,96 @@
+import time
+import torch
+from typing import List, Tuple
+from batch_inf import MAX_LEN, MAX_NEW_TOKENS
+
+# Speculative greedy decoding: draft tokens are proposed cheaply and verified by the model in one forward pass,
+# the longest prefix of the draft that matches the greedy tokens of the model is kept, so the outputs are those of greedy decoding.
+# The draft is either a small model with the same tokenizer (assisted generation of transformers),
+# or the tokens that followed the last n-gram in the prompt (prompt lookup), which fits VarDecoder outputs
+# whose variable and type names mostly appear in the decompiled code.
+# SpeculativeGenerator counts the drafted and accepted tokens from the inputs of the model,
+# and every check_every-th prompt is also generated without speculation to measure the speedup and check the outputs.
+
+NUM_DRAFT_TOKENS = 10
+MAX_NGRAM = 3   # longest n-gram matched in the prompt by prompt lookup
+CHECK_EVERY = 50
+
+
+class SpeculativeGenerator:
+    def __init__(self, model, tokenizer, device='cuda', draft_model=None, num_draft_tokens=NUM_DRAFT_TOKENS, check_every=CHECK_EVERY):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.draft_model = draft_model
+        if draft_model is not None:
+            draft_model.generation_config.num_assistant_tokens = num_draft_tokens
+        self.num_draft_tokens = num_draft_tokens
+        self.check_every = check_every
+
+        # number of new tokens fed to the model by each forward pass of the current generation
+        self.forward_lens: List[int] = []
+        model.register_forward_pre_hook(self._count_forward, with_kwargs=True)
+
+        self.records = 0
+        self.tokens = 0
+        self.steps = 0   # forward passes of the model
+        self.drafted = 0
+        self.accepted = 0
+        self.checked = 0
+        self.mismatches = 0
+        self.check_time = 0   # time of the checked prompts with speculation
+        self.baseline_time = 0   # and without
+
+    def _count_forward(self, module, args, kwargs):
+        input_ids = kwargs.get('input_ids', args[0] if args else None)
+        if input_ids is not None:
+            self.forward_lens.append(input_ids.size(1))
+
+    def _generate(self, input_ids, speculative, generate_kwargs):
+        kwargs = dict(generate_kwargs, num_beams=1, do_sample=False)
+        if speculative and self.draft_model is not None:
+            kwargs['assistant_model'] = self.draft_model
+        elif speculative:
+            kwargs['prompt_lookup_num_tokens'] = self.num_draft_tokens
+            kwargs['max_matching_ngram_size'] = MAX_NGRAM
+        self.forward_lens = []
+        start_time = time.time()
+        with torch.no_grad():
+            output = self.model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), **kwargs)[0]
+        return output[input_ids.size(1):], time.time() - start_time
+
+    def generate(self, prompt, max_prompt_len=MAX_LEN - MAX_NEW_TOKENS, **generate_kwargs) -> Tuple[str, int]:
+        # return the text greedily generated from prompt and its number of tokens
+        input_ids = self.tokenizer.encode(prompt, return_tensors='pt').to(self.device)[:, : max_prompt_len]
+        new_tokens, time_used = self._generate(input_ids, True, generate_kwargs)
+        forward_lens = self.forward_lens
+
+        # the first pass feeds the prompt and the draft, the next ones the last generated token and the draft,
+        # each pass generates the accepted draft tokens and one token of the model
+        num_tokens = new_tokens.size(0)
+        self.records += 1
+        self.tokens += num_tokens
+        self.steps += len(forward_lens)
+        for i, n in enumerate(forward_lens):
+            self.drafted += n - (input_ids.size(1) if i == 0 else 1)
+        self.accepted += max(num_tokens - len(forward_lens), 0)
+
+        if self.check_every and (self.records - 1) % self.check_every == 0:
+            baseline_tokens, baseline_time = self._generate(input_ids, False, generate_kwargs)
+            self.checked += 1
+            self.check_time += time_used
+            self.baseline_time += baseline_time
+            if not torch.equal(baseline_tokens, new_tokens):
+                self.mismatches += 1
+
+        text = self.tokenizer.decode(new_tokens, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        return text, num_tokens
+
+    def report(self):
+        draft = 'draft model' if self.draft_model is not None else 'prompt lookup'
+        acceptance = self.accepted / max(self.drafted, 1)
+        print(f'speculative decoding ({draft}): {self.accepted}/{self.drafted} draft tokens accepted ({acceptance:.1%}), '
+              f'{self.tokens / max(self.steps, 1):.2f} tokens per forward pass', flush=True)
+        if self.checked:
+            print(f'checked {self.checked} prompts without speculation: {self.baseline_time / max(self.check_time, 1e-6):.2f}x speedup, '
+                  f'{self.mismatches} different outputs', flush=True)
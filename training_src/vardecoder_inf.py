@@ -5,10 +5,21 @@ from peft import PeftModel
 import argparse
 import time
 import os 
+from batch_inf import load_model, read_jsonl, batch_generate, open_output, skip_done, Throughput, MAX_LEN, MAX_NEW_TOKENS
+from prefix_cache import CachedGenerator, PrefixCache
+from speculative import SpeculativeGenerator, NUM_DRAFT_TOKENS
+from grammar import grammar_processor
+from chunking import expand_windows, WindowMerger
 hf_key = os.environ['HF_TOKEN']
 
 
-def inference(test_fpath, out_fpath, model_path):
+def inference(test_fpath, out_fpath, model_path, overwrite=False, prefix_cache=None, speculative=False, draft_model_path=None, num_draft_tokens=NUM_DRAFT_TOKENS, constrained=False, chunk=False):
+    # the predictions are appended to out_fpath, the records already in it are skipped (see open_output)
+    # prefix_cache: keep the states of the last prefix_cache inputs, a record with the same input as a previous one only encodes `first_token:` (see prefix_cache.py)
+    # speculative: greedy decoding instead of beam search, with the tokens drafted by the model at draft_model_path (same tokenizer),
+    # or looked up in the prompt if it is not given (see speculative.py)
+    # constrained: only generate answers in the format of the evaluation, for the variables of the question (see grammar.py)
+    # chunk: ask about the variables of the functions that do not fit in the context window by window instead of truncating them (see chunking.py)
     print('==========start loading model==========')
 
     tokenizer = AutoTokenizer.from_pretrained('bigcode/starcoderbase-3b', use_auth_token=hf_key)
@@ -17,31 +28,120 @@ def inference(test_fpath, out_fpath, model_path):
         torch_dtype=torch.bfloat16, device_map='auto'
     )
 
-    wp = open(out_fpath, 'w')
+    wp, done = open_output(out_fpath, overwrite=overwrite)
+    if done:
+        print(f'Resuming: {sum(done.values())} predictions already in {out_fpath}')
+    throughput = Throughput()
+    generator = CachedGenerator(model, tokenizer, device='cuda', cache=PrefixCache(max_entries=prefix_cache)) if prefix_cache else None
+    spec_generator = None
+    if speculative:
+        draft_model = None
+        if draft_model_path is not None:
+            draft_model = AutoModelForCausalLM.from_pretrained(draft_model_path, use_auth_token=hf_key, torch_dtype=torch.bfloat16).cuda()
+        spec_generator = SpeculativeGenerator(model, tokenizer, device='cuda', draft_model=draft_model, num_draft_tokens=num_draft_tokens)
 
-    with open(test_fpath, 'r') as fp:
-        for i, line in enumerate(fp.readlines()):
-            line = json.loads(line)
+    lines = skip_done(read_jsonl(test_fpath), done)
+    if chunk:
+        lines = expand_windows(lines, tokenizer, 8192 - 1024, field=False)
+    merger = WindowMerger()
+
+    with wp:
+        for line in lines:
             first_token = line['output'].split(':')[0]
             prompt = line['input'] + first_token + ':'
+            constraint = {}
+            if constrained:
+                constraint['logits_processor'] = grammar_processor(tokenizer, [line['input']], [first_token + ':'], field=False)
 
             start_time = time.time()
 
-            input_ids = tokenizer.encode(prompt, return_tensors='pt').cuda()[:, : 8192 - 1024]
-            output = model.generate(
-                input_ids=input_ids, max_new_tokens=1024, num_beams=4, num_return_sequences=1, do_sample=False,
-                early_stopping=False, pad_token_id=0, eos_token_id=0
-            )[0]
-            output = tokenizer.decode(output[input_ids.size(1): ], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            if spec_generator is not None:
+                output, num_tokens = spec_generator.generate(
+                    prompt, max_prompt_len=8192 - 1024, max_new_tokens=1024, num_return_sequences=1,
+                    pad_token_id=0, eos_token_id=0, **constraint
+                )
+            elif generator is not None:
+                output, num_tokens = generator.generate(
+                    line['input'], first_token + ':', max_prompt_len=8192 - 1024,
+                    max_new_tokens=1024, num_beams=4, num_return_sequences=1, do_sample=False,
+                    early_stopping=False, pad_token_id=0, eos_token_id=0, **constraint
+                )
+            else:
+                input_ids = tokenizer.encode(prompt, return_tensors='pt').cuda()[:, : 8192 - 1024]
+                output = model.generate(
+                    input_ids=input_ids, max_new_tokens=1024, num_beams=4, num_return_sequences=1, do_sample=False,
+                    early_stopping=False, pad_token_id=0, eos_token_id=0, **constraint
+                )[0]
+                num_tokens = output.size(0) - input_ids.size(1)
+                output = tokenizer.decode(output[input_ids.size(1): ], skip_special_tokens=True, clean_up_tokenization_spaces=True)
 
             time_used = time.time() - start_time
             output = first_token + ':' + output
+            merged = merger.add(line, [output], time_used, num_tokens)
+            if merged is None:
+                continue
+            line, outputs, time_used, num_tokens = merged
             save_data = line
-            save_data['predict'] = output
+            save_data['predict'] = outputs[0]
             save_data['time'] = time_used
             wp.write(json.dumps(save_data) + '\n')
+            wp.flush()
+            throughput.update(num_tokens)
+    throughput.report()
+    if generator is not None:
+        generator.cache.report()
+    if spec_generator is not None:
+        spec_generator.report()
+
+
+
+def build_prompt(line):
+    first_token = line['output'].split(':')[0]
+    return line['input'] + first_token + ':'
+
+
+def batch_inference(test_fpath, out_fpath, model_path, batch_size, max_batch_tokens=None, num_beams=4, num_return_sequences=1, device='cuda', overwrite=False, constrained=False, chunk=False, tokenizer=None, model=None):
+    # same outputs as inference, but the prompts are generated in batches (see batch_inf.py)
+    # tokenizer, model: already loaded (see parallel_inf.py), model_path is loaded otherwise
+    if model is None:
+        print('==========start loading model==========')
+        tokenizer, model = load_model(model_path, hf_key, device=device)
 
+    wp, done = open_output(out_fpath, overwrite=overwrite)
+    if done:
+        print(f'Resuming: {sum(done.values())} predictions already in {out_fpath}')
+    throughput = Throughput()
+    build_logits_processor = None
+    if constrained:
+        build_logits_processor = lambda lines: grammar_processor(tokenizer, [line['input'] for line in lines], [build_prompt(line)[len(line['input']):] for line in lines], field=False)
 
+    lines = skip_done(read_jsonl(test_fpath), done)
+    if chunk:
+        lines = expand_windows(lines, tokenizer, MAX_LEN - MAX_NEW_TOKENS, field=False)
+    merger = WindowMerger()
+
+    with wp:
+        results = batch_generate(
+            lines, build_prompt, tokenizer, model, device=device,
+            batch_size=batch_size, max_batch_tokens=max_batch_tokens, num_return_sequences=num_return_sequences, build_logits_processor=build_logits_processor,
+            max_new_tokens=MAX_NEW_TOKENS, num_beams=num_beams, do_sample=False,
+            early_stopping=False, pad_token_id=0, eos_token_id=0
+        )
+        for line, outputs, time_used, num_tokens in results:
+            first_token = line['output'].split(':')[0]
+            merged = merger.add(line, [first_token + ':' + output for output in outputs], time_used, num_tokens)
+            if merged is None:
+                continue
+            line, outputs, time_used, num_tokens = merged
+            save_data = line
+            save_data['predict'] = outputs[0]
+            if num_return_sequences > 1:
+                save_data['candidates'] = outputs[1:]
+            save_data['time'] = time_used
+            wp.write(json.dumps(save_data) + '\n')
+            wp.flush()
+            throughput.update(num_tokens)
+    throughput.report()
 
 
 if __name__=='__main__':
@@ -49,6 +149,25 @@ if __name__=='__main__':
     parser.add_argument('test_fpath')
     parser.add_argument('out_fpath')
     parser.add_argument('model_path')
+    parser.add_argument('--batch_size', type=int, default=None, help='batched mode: generate this many prompts at a time, grouped by length')
+    parser.add_argument('--max_batch_tokens', type=int, default=None, help='batched mode: at most this many (padded) prompt tokens per batch')
+    parser.add_argument('--num_beams', type=int, default=4, help='batched mode: number of beams')
+    parser.add_argument('--num_return_sequences', type=int, default=1, help='batched mode: the other sequences are saved in `candidates`')
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'], help='batched mode: device to run the model on')
+    parser.add_argument('--overwrite', default=False, action='store_true', help='start over instead of skipping the records already in out_fpath')
+    parser.add_argument('--prefix_cache', type=int, default=None, help='single prompt mode: cache the states of the inputs of this many functions for the records that share their input')
+    parser.add_argument('--speculative', default=False, action='store_true', help='single prompt mode: greedy speculative decoding instead of beam search (see speculative.py)')
+    parser.add_argument('--draft_model', default=None, help='speculative mode: the draft model, the drafts are looked up in the prompt if not given')
+    parser.add_argument('--num_draft_tokens', type=int, default=NUM_DRAFT_TOKENS, help='speculative mode: number of tokens drafted at a time')
+    parser.add_argument('--constrained', default=False, action='store_true', help='only generate answers in the format of the evaluation, and stop once every variable of the question is answered (see grammar.py)')
+    parser.add_argument('--chunk', default=False, action='store_true', help='split the functions that do not fit in the context into overlapping windows instead of truncating them (see chunking.py)')
     args = parser.parse_args()
+    if args.speculative and args.prefix_cache:
+        parser.error('--speculative cannot be used with --prefix_cache')
 
-    inference(args.test_fpath, args.out_fpath, args.model_path)
+    if args.batch_size:
+        batch_inference(args.test_fpath, args.out_fpath, args.model_path, args.batch_size, max_batch_tokens=args.max_batch_tokens,
+            num_beams=args.num_beams, num_return_sequences=args.num_return_sequences, device=args.device, overwrite=args.overwrite, constrained=args.constrained, chunk=args.chunk)
+    else:
+        inference(args.test_fpath, args.out_fpath, args.model_path, overwrite=args.overwrite, prefix_cache=args.prefix_cache,
+            speculative=args.speculative, draft_model_path=args.draft_model, num_draft_tokens=args.num_draft_tokens, constrained=args.constrained, chunk=args.chunk)